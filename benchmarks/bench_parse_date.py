@@ -0,0 +1,92 @@
+# micro-benchmark: dates.parse_date vs the old dateparser-only parse_date, after checking
+# that both give the same result for the inputs in SAME_AS_LEGACY
+# usage: python benchmarks/bench_parse_date.py [--number 200]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dates import parse_date, parse_date_legacy, cache_info
+
+SAMPLES = [
+    "завтра о 15:00",
+    "сьогодні 18:30",
+    "25.12",
+    "25.12.2030 18:00",
+    "через 2 години",
+    "через 30 хв",
+    "in 3 days",
+    "tomorrow at 9",
+    "2030-01-05 10:20",
+    "21:45",
+    #these fall through to dateparser
+    "1 листопада о 10:00",
+    "december 25 at 5pm",
+]
+#absolute dates the fast path does not take (or rejects as day.month) must still parse like before
+SAME_AS_LEGACY = [
+    "12/25",
+    "12/25/2026",
+    "2026-13-01",
+    "1 листопада о 10:00",
+    "december 25 at 5pm",
+    "25 грудня",
+    "2026-02-30",
+]
+
+
+def check() -> bool:
+    ok = True
+    for sample in SAME_AS_LEGACY:
+        expected, actual = parse_date_legacy(sample), parse_date(sample)
+        if expected != actual:
+            print(f"MISMATCH {sample!r}: legacy {expected}, parse_date {actual}")
+            ok = False
+    return ok
+
+
+def bench(func, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        for sample in SAMPLES:
+            func(sample)
+    return (time.perf_counter() - start) / (number * len(SAMPLES))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    if not check():
+        sys.exit(1)
+    #first call pays for dateparser's language data, keep it out of the numbers
+    parse_date_legacy(SAMPLES[0])
+    parse_date(SAMPLES[-1])
+
+    legacy = bench(parse_date_legacy, args.number)
+    layered = bench(parse_date, args.number)
+
+    print(f"samples:        {len(SAMPLES)} x {args.number}")
+    print(f"legacy:         {legacy * 1e6:10.1f} us/call")
+    print(f"fast path+LRU:  {layered * 1e6:10.1f} us/call")
+    print(f"speedup:        {legacy / layered:10.1f}x")
+    print(f"fallback cache: {cache_info()}")
+
+    print("\nper input (us/call):")
+    for sample in SAMPLES:
+        start = time.perf_counter()
+        for _ in range(args.number):
+            parse_date_legacy(sample)
+        legacy = (time.perf_counter() - start) / args.number
+        start = time.perf_counter()
+        for _ in range(args.number):
+            parse_date(sample)
+        layered = (time.perf_counter() - start) / args.number
+        print(f"  {sample:<22} {legacy * 1e6:10.1f} {layered * 1e6:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+# load test: the real Application and handlers against a seeded database, with a fake Bot
+# that answers every API call after a simulated network delay instead of talking to Telegram.
+# --storage memory runs the same handlers on the in-memory repository, i.e. without disk I/O.
+# --flooders N adds users who send /list nonstop while the sessions run, to see what flood
+# protection keeps from them and how much the sessions' tail latency still grows.
+# usage: python benchmarks/load_test.py [--users 10000] [--tasks 1000000] [--sessions 2000] [--storage memory] [--flooders 20]
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_DB = os.path.join(tempfile.gettempdir(), "todo_load_test.db")
+SEED_BATCH = 50000
+DEADLINE_FORMAT = "%Y-%m-%d %H:%M:%S"
+#updates each flooder sends, one every FLOOD_INTERVAL seconds
+FLOOD_UPDATES = 500
+FLOOD_INTERVAL = 0.002
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--tasks", type=int, default=1000000)
+    parser.add_argument("--reseed", action="store_true", help="drop the database and seed it again")
+    parser.add_argument("--sessions", type=int, default=2000, help="simulated user sessions")
+    parser.add_argument("--concurrency", type=int, default=100, help="sessions running at the same time")
+    parser.add_argument("--flooders", type=int, default=0, help="users sending updates nonstop during the sessions")
+    parser.add_argument("--due", type=int, default=2000, help="reminders due for check_deadlines")
+    parser.add_argument("--latency-ms", type=float, default=50, help="simulated Bot API latency")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+args = parse_args()
+#must be set before database.py is imported
+os.environ["DB_NAME"] = args.db
+if args.reseed:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+import logging
+
+from telegram import Bot, InlineKeyboardMarkup, Update
+from telegram.ext import CallbackContext
+
+import main as bot_main
+from repository import create_repository
+from metrics import UPDATES_SHED
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+class FakeBot(Bot):
+    # every request "succeeds" after latency +- jitter; calls are counted per endpoint
+    # and the last inline keyboard per chat is kept so sessions can press its buttons
+    def __init__(self, latency: float, jitter: float):
+        super().__init__(token="123456:LOAD-TEST")
+        self._latency = latency
+        self._jitter = jitter
+        self._message_ids = itertools.count(1)
+        self._calls = Counter()
+        self._keyboards = {}
+
+    @property
+    def calls(self) -> Counter:
+        return self._calls
+
+    def last_keyboard(self, chat_id: int) -> InlineKeyboardMarkup | None:
+        return self._keyboards.get(chat_id)
+
+    async def _do_post(self, endpoint: str, data: dict, *args, **kwargs):
+        self._calls[endpoint] += 1
+        await asyncio.sleep(max(self._latency + random.uniform(-self._jitter, self._jitter), 0))
+        if endpoint == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_test_bot"}
+        if endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(data["chat_id"])
+            if isinstance(data.get("reply_markup"), InlineKeyboardMarkup):
+                self._keyboards[chat_id] = data["reply_markup"]
+            return {
+                "message_id": data.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+
+def task_rows(users: int, tasks: int, rng: random.Random, now: datetime):
+    # a pending/done mix, deadlines +-30 days around now
+    for number in range(tasks):
+        created = now - timedelta(seconds=rng.randrange(90 * 86400))
+        deadline = None
+        if rng.random() < 0.7:
+            deadline = now + timedelta(seconds=rng.randrange(-30 * 86400, 30 * 86400))
+        yield (
+            rng.randrange(1, users + 1),
+            f"Завдання {number}",
+            deadline.strftime(DEADLINE_FORMAT) if deadline else None,
+            int(deadline.timestamp()) if deadline else None,
+            created.strftime(DEADLINE_FORMAT),
+            "pending" if rng.random() < 0.6 else "done",
+        )
+
+
+def seed(db_name: str, users: int, tasks: int, rng: random.Random):
+    # bulk insert straight through sqlite3
+    now = datetime.now()
+    start = time.perf_counter()
+    with sqlite3.connect(db_name) as conn:
+        conn.execute("PRAGMA synchronous=OFF")
+        insert_query = """
+        INSERT INTO tasks (user_id, task_text, deadline, deadline_at, created_at, status, reminder_offset)
+        VALUES (?, ?, ?, ?, ?, ?, 30)
+        """
+        batch = task_rows(users, tasks, rng, now)
+        while chunk := list(itertools.islice(batch, SEED_BATCH)):
+            conn.executemany(insert_query, chunk)
+        #past reminders count as already sent, arm_due_reminders re-opens a few of them
+        conn.execute("""
+        INSERT INTO reminders (task_id, fire_at, kind, sent)
+        SELECT id, deadline_at - 1800, 'before', deadline_at - 1800 < ?
+        FROM tasks
+        WHERE status = 'pending' AND deadline_at IS NOT NULL
+        """, (int(now.timestamp()),))
+        conn.execute("ANALYZE")
+    print(f"Засіяно {tasks} завдань для {users} користувачів за {time.perf_counter() - start:.1f} с")
+
+
+async def seed_memory(repo, users: int, tasks: int, due: int, rng: random.Random):
+    # the same tasks through the repository, one import per user; reminders already in the past
+    # are not created at all, `due` tasks whose reminder is due now stand in for arm_due_reminders
+    start = time.perf_counter()
+    by_user = defaultdict(list)
+    for user_id, task_text, deadline, _, _, status in task_rows(users, tasks, rng, datetime.now()):
+        by_user[user_id].append((task_text, deadline, status))
+    for user_id, user_tasks in by_user.items():
+        await repo.import_tasks(user_id, user_tasks)
+    soon = (datetime.now() + timedelta(minutes=10)).strftime(DEADLINE_FORMAT)
+    for number in range(due):
+        await repo.add_task(rng.randrange(1, users + 1), f"Нагадування {number}", soon, 30)
+    print(f"Засіяно {tasks} завдань для {users} користувачів у пам'яті за {time.perf_counter() - start:.1f} с")
+
+
+def arm_due_reminders(db_name: str, count: int):
+    with sqlite3.connect(db_name) as conn:
+        conn.execute("""
+        UPDATE reminders SET sent = 0, claimed_until = NULL, attempts = 0
+        WHERE id IN (
+            SELECT r.id FROM reminders r JOIN tasks t ON t.id = r.task_id
+            WHERE r.fire_at < ? AND t.status = 'pending'
+            ORDER BY r.fire_at DESC
+            LIMIT ?
+        )
+        """, (int(time.time()), count))
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+
+    async def timed(self, name: str, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    def report(self, title: str, wall: float):
+        print(f"\n{title} ({wall:.1f} с)")
+        print(f"{'крок':<28}{'к-сть':>8}{'оп/с':>10}{'p50, мс':>10}{'p99, мс':>10}")
+        for name, samples in self.latencies.items():
+            samples = sorted(samples)
+            p50 = samples[len(samples) // 2]
+            p99 = samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+            print(f"{name:<28}{len(samples):>8}{len(samples) / wall:>10.1f}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+
+
+class UpdateFactory:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def message(self, user_id: int, text: str) -> Update:
+        data = {"update_id": next(self._update_ids), "message": self._message(user_id, text)}
+        if text.startswith("/"):
+            command = text.split()[0]
+            data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json(data, self.bot)
+
+    def callback(self, user_id: int, callback_data: str) -> Update:
+        data = {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": callback_data,
+                "message": self._message(user_id, "list"),
+            },
+        }
+        return Update.de_json(data, self.bot)
+
+
+def find_button(keyboard: InlineKeyboardMarkup | None, prefix: str) -> str | None:
+    if keyboard is None:
+        return None
+    for row in keyboard.inline_keyboard:
+        for button in row:
+            if button.callback_data and button.callback_data.startswith(prefix):
+                return button.callback_data
+    return None
+
+
+async def run_session(application, factory: UpdateFactory, recorder: Recorder, user_id: int, number: int):
+    bot = application.bot
+
+    async def send(name: str, update: Update):
+        #through the update processor like updates from Telegram, flood protection included
+        await recorder.timed(name, application.update_processor.process_update(
+            update, application.process_update(update)
+        ))
+
+    #new task dialog
+    await send("new_task_start", factory.message(user_id, "Нове завдання 📝"))
+    await send("receive_task_text", factory.message(user_id, f"Навантажувальне завдання {number}"))
+    await send("receive_deadline", factory.message(user_id, "завтра о 15:00"))
+    await send("receive_reminder_offset", factory.message(user_id, "За 1 год"))
+
+    await send("list_tasks", factory.message(user_id, "Список завдань 📋"))
+    edit_data = find_button(bot.last_keyboard(user_id), "task:edit:")
+    if edit_data:
+        await send("edit_menu", factory.callback(user_id, edit_data))
+        await send("edit_cancel", factory.callback(user_id, "edit:cancel"))
+
+    next_page = find_button(bot.last_keyboard(user_id), "list:list:next:")
+    if next_page:
+        await send("list_page_callback", factory.callback(user_id, next_page))
+
+    done_data = find_button(bot.last_keyboard(user_id), "task:done:")
+    if done_data:
+        await send("task_button_callback", factory.callback(user_id, done_data))
+
+    await send("upcoming_tasks", factory.message(user_id, "/upcoming"))
+
+
+async def flood(application, factory: UpdateFactory, user_id: int):
+    # one update after another without waiting for the answers, as a client stuck in a loop would
+    processor = application.update_processor
+    pending = []
+    for _ in range(FLOOD_UPDATES):
+        update = factory.message(user_id, "/list")
+        pending.append(asyncio.create_task(processor.process_update(update, application.process_update(update))))
+        await asyncio.sleep(FLOOD_INTERVAL)
+    await asyncio.gather(*pending)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    repo = create_repository(args.storage)
+    if args.storage == "memory":
+        await seed_memory(repo, args.users, args.tasks, args.due, rng)
+    else:
+        fresh = not os.path.exists(args.db)
+        repo.init_db()
+        if fresh:
+            seed(args.db, args.users, args.tasks, rng)
+            #reopen the pool so its connections plan with the ANALYZE statistics
+            repo.close_db()
+        arm_due_reminders(args.db, args.due)
+
+    bot = FakeBot(args.latency_ms / 1000, args.jitter_ms / 1000)
+    application = bot_main.build_application(bot=bot, repo=repo)
+    factory = UpdateFactory(bot)
+
+    await application.initialize()
+    await application.post_init(application)
+    try:
+        recorder = Recorder()
+        semaphore = asyncio.Semaphore(args.concurrency)
+        #consecutive sessions get different users, two dialogs of one user would clash
+        user_ids = list(range(1, args.users + 1))
+        rng.shuffle(user_ids)
+
+        async def session(number: int):
+            async with semaphore:
+                await run_session(application, factory, recorder, user_ids[number % len(user_ids)], number)
+
+        #the flooders are the last users of the shuffled list, the sessions never get to them
+        flooders = [
+            asyncio.create_task(flood(application, factory, user_id))
+            for user_id in user_ids[len(user_ids) - args.flooders:]
+        ]
+        start = time.perf_counter()
+        await asyncio.gather(*(session(number) for number in range(args.sessions)))
+        recorder.report(
+            f"Сесії: {args.sessions}, одночасно {args.concurrency}, затримка API {args.latency_ms:.0f} мс"
+            + (f", флудерів {args.flooders}" if args.flooders else ""),
+            time.perf_counter() - start,
+        )
+        await asyncio.gather(*flooders)
+        if args.flooders:
+            shed = {reason: int(count) for (reason,), count in UPDATES_SHED._values.items()}
+            print(f"відкинуто оновлень: {shed} з {args.flooders * FLOOD_UPDATES} від флудерів")
+
+        #the jobs are called directly, the job queue itself is never started
+        context = CallbackContext(application)
+        jobs = Recorder()
+        sent_before = bot.calls["sendMessage"]
+        start = time.perf_counter()
+        await jobs.timed("check_deadlines", bot_main.check_deadlines(context))
+        #the jobs only queue messages, the outbox started by post_init sends them
+        await jobs.timed("outbox", bot_main.get_outbox(context).wait_idle())
+        reminders_sent = bot.calls["sendMessage"] - sent_before
+        sent_before = bot.calls["sendMessage"]
+        #today's digest for users on server time, whatever the clock says now
+        await jobs.timed("send_morning_digest", bot_main.send_zone_digest(context, None, datetime.now().date()))
+        await jobs.timed("outbox", bot_main.get_outbox(context).wait_idle())
+        digests_sent = bot.calls["sendMessage"] - sent_before
+        jobs.report("Фонові задачі", time.perf_counter() - start)
+        print(f"нагадувань надіслано: {reminders_sent}, дайджестів: {digests_sent}")
+        print(f"виклики Bot API: {dict(bot.calls)}")
+    finally:
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(args))
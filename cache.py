@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TaskCache:
+    # per-user LRU of read results with a TTL. every entry of a user is dropped
+    # together on any write for that user. generations stop a read that raced
+    # with a write from putting stale rows back.
+    def __init__(self, max_users: int = 10000, ttl: float = 300):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._writes = 0
+        self._invalidated_at = {}
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int, key):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._users[user_id]
+                self.evictions += 1
+                entry = None
+            if entry is None or key not in entry[1]:
+                self.misses += 1
+                return MISSING
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return entry[1][key]
+
+    def generation(self) -> int:
+        # take this before reading from the database, pass it to put()
+        with self._lock:
+            return self._writes
+
+    def put(self, user_id: int, key, value, generation: int):
+        with self._lock:
+            if max(self._floor, self._invalidated_at.get(user_id, 0)) > generation:
+                return
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = (time.monotonic() + self.ttl, {})
+                self._users[user_id] = entry
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+                    self.evictions += 1
+            self._users.move_to_end(user_id)
+            entry[1][key] = value
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._writes += 1
+            self._invalidated_at[user_id] = self._writes
+            if len(self._invalidated_at) > 4 * self.max_users:
+                #forget per-user history, reads that started before now are simply not cached
+                self._invalidated_at.clear()
+                self._floor = self._writes
+            if self._users.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._writes += 1
+            self._invalidated_at.clear()
+            self._floor = self._writes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
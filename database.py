@@ -1,250 +1,1327 @@
+import asyncio
+import os
+import queue
 import sqlite3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta
+from functools import partial, wraps
+from time import perf_counter
+
+from cache import MISSING, TaskCache
+from dates import from_epoch, next_occurrence, to_epoch
+from tasks_model import (
+    DEADLINE_FORMAT, HIGHLIGHT_END, HIGHLIGHT_START, SEARCH_WORD_RE,
+    deadline_to_epoch, reminder_offsets, reminder_times, with_occurrences,
+)
+from metrics import DB_SECONDS, DB_WAIT_SECONDS, DB_COMMIT_BATCH
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-DB_NAME = 'todo.db'
+DB_NAME = os.getenv("DB_NAME", "todo.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BUSY_TIMEOUT = 30
+STATEMENT_CACHE_SIZE = 256
+#group commit: at most this many writes per transaction, kept open at most this long
+GROUP_COMMIT_MAX_OPS = int(os.getenv("GROUP_COMMIT_MAX_OPS", "32"))
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "5")) / 1000
+TASK_CACHE_USERS = int(os.getenv("TASK_CACHE_USERS", "10000"))
+TASK_CACHE_TTL = int(os.getenv("TASK_CACHE_TTL", "300"))
+EXPORT_BATCH_SIZE = 500
+ARCHIVE_BATCH_SIZE = 1000
+#pages handed back to the filesystem per maintenance run, the rest stays on the freelist for reuse
+VACUUM_MAX_PAGES = 10000
 
-def init_db():
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        logger.info("Успішно підключено до бази даних SQLite")
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            task_text TEXT NOT NULL,
-            deadline TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'pending',
-            reminder_sent BOOLEAN DEFAULT 0
-        );
-        """
-        cursor.execute(create_table_query)
+
+class _WriteBatch:
+    # one open transaction shared by the writer() callers that joined it
+    def __init__(self):
+        self.size = 0
+        self.opened_at = perf_counter()
+        self.done = threading.Event()
+        self.error = None
+
+
+class ConnectionPool:
+    # one writer (sqlite serializes writes anyway) + several WAL readers
+    def __init__(self, db_name: str, readers: int = DB_READERS):
+        self.db_name = db_name
+        self._writer = self._connect()
+        self._writer_lock = threading.Lock()
+        self._batch = None
+        #threads waiting for the writer lock, guarded by _queued_lock
+        self._queued = 0
+        self._queued_lock = threading.Lock()
+        self._readers = queue.Queue()
+        for _ in range(max(readers, 1)):
+            self._readers.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=DB_BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        #only takes effect for a new database file, see archive_done_tasks
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @contextmanager
+    def writer(self):
+        # group commit: a caller arriving while a transaction is open joins it inside its own
+        # savepoint, so an exception still undoes only that caller's changes. Everyone returns
+        # after the shared COMMIT, i.e. as durable as before, but one fsync covers the whole batch.
+        # The batch commits as soon as nobody else is waiting for the writer, so a lone write
+        # is not delayed; under load callers pile up behind the lock and share the next commit.
+        with self._queued_lock:
+            self._queued += 1
+        with self._writer_lock:
+            with self._queued_lock:
+                self._queued -= 1
+            conn = self._writer
+            batch = self._batch
+            if batch is None:
+                conn.execute("BEGIN IMMEDIATE")
+                batch = self._batch = _WriteBatch()
+            conn.execute("SAVEPOINT write")
+            try:
+                yield conn
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                else:
+                    #sqlite aborted the whole transaction (disk full, I/O error ...), the other callers' writes too
+                    self._finish(batch, sqlite3.OperationalError("transaction was rolled back"))
+                raise
+            else:
+                conn.execute("RELEASE write")
+                batch.size += 1
+            finally:
+                if self._batch is batch and (
+                    not self._queued
+                    or batch.size >= GROUP_COMMIT_MAX_OPS
+                    or perf_counter() - batch.opened_at >= GROUP_COMMIT_WINDOW
+                ):
+                    self._commit(batch)
+        batch.done.wait()
+        if batch.error is not None:
+            raise sqlite3.OperationalError(f"group commit failed: {batch.error}")
+
+    def _commit(self, batch: _WriteBatch):
+        error = None
         try:
-            cursor.execute("ALTER TABLE tasks ADD COLUMN reminder_offset INTEGER DEFAULT 30")
-        except sqlite3.OperationalError:
-            pass
-        conn.commit()
-        logger.info("Таблицю tasks успішно створено (або вона вже існує)")
+            self._writer.execute("COMMIT")
+        except sqlite3.Error as e:
+            error = e
+            if self._writer.in_transaction:
+                self._writer.execute("ROLLBACK")
+        self._finish(batch, error)
+
+    def _finish(self, batch: _WriteBatch, error: Exception | None):
+        self._batch = None
+        batch.error = error
+        DB_COMMIT_BATCH.observe(batch.size)
+        batch.done.set()
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def close(self):
+        with self._writer_lock:
+            if self._batch is not None:
+                self._commit(self._batch)
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+
+TASK_PAGE_QUERY = """
+SELECT *
+FROM tasks
+WHERE user_id = ? AND status = 'pending'{filters}
+ORDER BY {column} {order}, id {order}
+LIMIT ?
+"""
+#keyset pagination: a cursor is (sort value, id) of a task on the page boundary
+PAGE_DIRECTIONS = {
+    None: ("", "ASC"),
+    "from": (" AND ({column}, id) >= (?, ?)", "ASC"),
+    "after": (" AND ({column}, id) > (?, ?)", "ASC"),
+    "before": (" AND ({column}, id) < (?, ?)", "DESC"),
+}
+
+def _task_page_query(column: str, direction: str | None) -> str:
+    cursor_filter, order = PAGE_DIRECTIONS[direction]
+    filters = cursor_filter.format(column=column)
+    if column == "deadline_at":
+        filters = " AND deadline_at IS NOT NULL" + filters
+    return TASK_PAGE_QUERY.format(filters=filters, column=column, order=order)
+
+GET_SINGLE_TASK_QUERY = "SELECT * FROM tasks WHERE id = ? AND user_id = ?"
+#bulk actions: any number of ids in one statement, RETURNING tells which ones were really changed
+MARK_TASKS_DONE_QUERY = """
+UPDATE tasks
+SET status = 'done', completed_at = ?
+WHERE user_id = ? AND status = 'pending' AND id IN ({placeholders})
+RETURNING id, deadline_at, reminder_offset, rrule
+"""
+DELETE_TASKS_QUERY = "DELETE FROM tasks WHERE user_id = ? AND id IN ({placeholders}) RETURNING id"
+#reminders.sent: 0 = waiting, 1 = sent, -1 = given up
+CLAIM_REMINDERS_QUERY = """
+UPDATE reminders
+SET claimed_until = :lease_until, attempts = attempts + 1
+WHERE id IN (
+    SELECT r.id
+    FROM reminders r
+    JOIN tasks t ON t.id = r.task_id
+    WHERE r.sent = 0 AND r.fire_at <= :now
+      AND (r.claimed_until IS NULL OR r.claimed_until <= :now)
+      AND r.kind != 'rollover' AND t.status = 'pending'{shards}
+    ORDER BY r.fire_at
+    LIMIT :limit
+)
+RETURNING id
+"""
+CLAIMED_REMINDERS_QUERY = """
+SELECT r.id AS reminder_id, r.fire_at, r.kind, r.attempts,
+       t.id, t.user_id, t.task_text, t.deadline, t.deadline_at
+FROM reminders r
+JOIN tasks t ON t.id = r.task_id
+WHERE r.id IN ({placeholders})
+ORDER BY r.fire_at
+"""
+UPCOMING_REMINDERS_QUERY = """
+SELECT r.id, r.task_id, MAX(r.fire_at, COALESCE(r.claimed_until, 0)) AS fire_at
+FROM reminders r
+JOIN tasks t ON t.id = r.task_id
+WHERE r.sent = 0 AND r.fire_at <= ? AND t.status = 'pending'{shards}
+"""
+TASKS_DUE_BETWEEN_QUERY = """
+SELECT id, user_id, task_text, deadline, deadline_at, rrule
+FROM tasks
+WHERE status = 'pending' AND deadline_at >= ? AND deadline_at < ? AND rrule IS NULL{users}{shards}
+ORDER BY user_id, deadline_at
+"""
+#recurring tasks store only their current occurrence, later ones are expanded in python
+RECURRING_DUE_QUERY = """
+SELECT id, user_id, task_text, deadline, deadline_at, rrule
+FROM tasks
+WHERE status = 'pending' AND rrule IS NOT NULL AND deadline_at < ?{users}{shards}
+"""
+#the digest goes out per timezone: users who chose this zone, or (tz NULL) everybody on server time
+USERS_IN_ZONE = " AND user_id IN (SELECT user_id FROM users WHERE tz = ?)"
+USERS_WITHOUT_ZONE = " AND user_id NOT IN (SELECT user_id FROM users)"
+#a 'rollover' reminder moves a recurring task nobody completed on to its next occurrence
+ROLLOVER_DUE_QUERY = """
+SELECT r.id AS reminder_id, t.id, t.user_id, t.deadline_at, t.reminder_offset, t.rrule, u.tz
+FROM reminders r
+JOIN tasks t ON t.id = r.task_id
+LEFT JOIN users u ON u.user_id = t.user_id
+WHERE r.sent = 0 AND r.kind = 'rollover' AND r.fire_at <= ? AND t.status = 'pending'{shards}
+"""
+#the lease is a send_after in the future: a claimed message is not due again until it runs out
+CLAIM_OUTBOX_QUERY = """
+UPDATE outbox
+SET send_after = :lease_until, attempts = attempts + 1
+WHERE id IN (
+    SELECT id
+    FROM outbox
+    WHERE sent = 0 AND send_after <= :now{shards}
+    ORDER BY send_after
+    LIMIT :limit
+)
+RETURNING id, key, kind, chat_id, text, parse_mode, due_at, attempts
+"""
+#index order (user_id, status, created_at), so sqlite streams rows without a sort step
+EXPORT_TASKS_QUERY = """
+SELECT task_text, deadline, status, created_at
+FROM tasks
+WHERE user_id = ?
+ORDER BY status, created_at
+"""
+EXPORT_ARCHIVE_QUERY = """
+SELECT task_text, deadline, 'done' AS status, created_at
+FROM tasks_archive
+WHERE user_id = ?
+ORDER BY created_at
+"""
+#one batch per transaction: rows are copied and deleted under the same write lock
+ARCHIVE_TASKS_QUERY = """
+INSERT INTO tasks_archive (id, user_id, task_text, deadline, deadline_at, created_at, completed_at, archived_at)
+SELECT id, user_id, task_text, deadline, deadline_at, created_at, completed_at, :now
+FROM tasks
+WHERE status = 'done' AND completed_at < :cutoff
+ORDER BY completed_at
+LIMIT :limit
+RETURNING id
+"""
+#owner is indexed too: "owner:42 AND ..." intersects with that user's posting list
+#instead of ranking every matching task of every user
+SEARCH_TASKS_QUERY = f"""
+SELECT t.id, t.task_text, t.deadline,
+       highlight(tasks_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}') AS highlighted
+FROM tasks_fts
+JOIN tasks t ON t.id = tasks_fts.rowid
+WHERE tasks_fts MATCH ? AND t.status = 'pending'
+ORDER BY bm25(tasks_fts, 1.0, 0.0), t.id
+LIMIT ? OFFSET ?
+"""
+
+def _shard_filter(column: str, shards: tuple[int, tuple[int, ...]] | None) -> str:
+    # shards is (shard_count, owned shards) of a sharded worker, None means every user.
+    # only ints end up in the sql, so they are inlined instead of bound
+    if shards is None:
+        return ""
+    count, owned = shards
+    return f" AND {column} % {int(count)} IN ({', '.join(str(int(shard)) for shard in owned)})"
+
+HOT_QUERIES = {
+    "get_tasks": (_task_page_query("created_at", "after"), (0, "", 0, 0)),
+    "get_upcoming_tasks": (_task_page_query("deadline_at", "after"), (0, 0, 0, 0)),
+    "get_single_task": (GET_SINGLE_TASK_QUERY, (0, 0)),
+    "mark_tasks_done": (MARK_TASKS_DONE_QUERY.format(placeholders="?, ?"), (0, 0, 0, 0)),
+    "claim_due_reminders": (CLAIM_REMINDERS_QUERY.format(shards=""), {"lease_until": 0, "now": 0, "limit": 0}),
+    "get_upcoming_reminders": (UPCOMING_REMINDERS_QUERY.format(shards=""), (0,)),
+    "get_tasks_due_between": (TASKS_DUE_BETWEEN_QUERY.format(users=USERS_IN_ZONE, shards=""), (0, 0, "")),
+    "get_tasks_due_between_server_time": (TASKS_DUE_BETWEEN_QUERY.format(users=USERS_WITHOUT_ZONE, shards=""), (0, 0)),
+    "get_tasks_due_between_recurring": (RECURRING_DUE_QUERY.format(users=USERS_IN_ZONE, shards=""), (0, "")),
+    "roll_over_recurring": (ROLLOVER_DUE_QUERY.format(shards=""), (0,)),
+    "iter_user_tasks": (EXPORT_TASKS_QUERY, (0,)),
+    "iter_user_tasks_archive": (EXPORT_ARCHIVE_QUERY, (0,)),
+    "archive_done_tasks": (ARCHIVE_TASKS_QUERY, {"now": 0, "cutoff": 0, "limit": 0}),
+    "claim_outbox": (CLAIM_OUTBOX_QUERY.format(shards=""), {"lease_until": 0, "now": 0, "limit": 0}),
+}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+#pending tasks of active users, see get_tasks / get_single_task and the write paths
+task_cache = TaskCache(max_users=TASK_CACHE_USERS, ttl=TASK_CACHE_TTL)
+#enough threads for a full group commit batch to queue behind the writer while readers keep going
+_executor = ThreadPoolExecutor(max_workers=DB_READERS + GROUP_COMMIT_MAX_OPS, thread_name_prefix="db")
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_NAME)
+                logger.info(f"Відкрито пул з'єднань SQLite ({DB_NAME}, readers={DB_READERS})")
+    return _pool
+
+
+def close_db():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+            logger.info("Пул з'єднань SQLite закрито")
+
+
+def _migration_base_schema(conn: sqlite3.Connection):
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        task_text TEXT NOT NULL,
+        deadline TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT DEFAULT 'pending',
+        reminder_sent BOOLEAN DEFAULT 0
+    );
+    """
+    conn.execute(create_table_query)
+    #databases created before versioning may already have this column
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(tasks)")}
+    if "reminder_offset" not in columns:
+        conn.execute("ALTER TABLE tasks ADD COLUMN reminder_offset INTEGER DEFAULT 30")
+
+def _migration_hot_query_indexes(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_user_status_created
+    ON tasks (user_id, status, created_at)
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_pending_unreminded
+    ON tasks (deadline)
+    WHERE status = 'pending' AND reminder_sent = 0 AND deadline IS NOT NULL
+    """)
+
+def _migration_reminders_table(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE tasks ADD COLUMN deadline_at INTEGER")
+    rows = conn.execute("SELECT id, deadline FROM tasks WHERE deadline IS NOT NULL").fetchall()
+    conn.executemany(
+        "UPDATE tasks SET deadline_at = ? WHERE id = ?",
+        [(deadline_to_epoch(row["deadline"]), row["id"]) for row in rows],
+    )
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER NOT NULL REFERENCES tasks (id) ON DELETE CASCADE,
+        fire_at INTEGER NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'before',
+        sent INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (fire_at) WHERE sent = 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_task ON reminders (task_id)")
+    conn.execute("""
+    INSERT INTO reminders (task_id, fire_at, kind)
+    SELECT id, deadline_at - reminder_offset * 60, 'before'
+    FROM tasks
+    WHERE status = 'pending' AND reminder_sent = 0
+      AND deadline_at IS NOT NULL AND reminder_offset > 0
+    """)
+    #the sweep reads reminders now
+    conn.execute("DROP INDEX IF EXISTS idx_tasks_pending_unreminded")
+
+def _migration_reminder_leases(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE reminders ADD COLUMN claimed_until INTEGER")
+    conn.execute("ALTER TABLE reminders ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+def _migration_pending_deadline_index(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_pending_deadline_at
+    ON tasks (deadline_at)
+    WHERE status = 'pending'
+    """)
+
+def _migration_upcoming_index(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_user_status_deadline
+    ON tasks (user_id, status, deadline_at)
+    """)
+
+def _migration_shard_leases(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS shard_leases (
+        shard INTEGER PRIMARY KEY,
+        owner TEXT,
+        expires_at INTEGER NOT NULL DEFAULT 0,
+        wanted_by TEXT,
+        digest_date TEXT
+    )
+    """)
+
+def _migration_dialog_state(conn: sqlite3.Connection):
+    #conversation persistence, see persistence.py
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    ) WITHOUT ROWID
+    """)
+
+def _migration_task_search(conn: sqlite3.Connection):
+    #external content through a view, so the owner column needs no copy of the data
+    conn.execute("""
+    CREATE VIEW IF NOT EXISTS tasks_fts_source AS
+    SELECT id, task_text, user_id AS owner FROM tasks
+    """)
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        task_text, owner,
+        content = 'tasks_fts_source', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts (rowid, task_text, owner) VALUES (new.id, new.task_text, new.user_id);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, task_text, owner)
+        VALUES ('delete', old.id, old.task_text, old.user_id);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF task_text, user_id ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, task_text, owner)
+        VALUES ('delete', old.id, old.task_text, old.user_id);
+        INSERT INTO tasks_fts (rowid, task_text, owner) VALUES (new.id, new.task_text, new.user_id);
+    END
+    """)
+    conn.execute("INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')")
+
+def _migration_task_archive(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE tasks ADD COLUMN completed_at INTEGER")
+    #unknown for tasks finished before this column existed, creation time is the closest guess
+    conn.execute("""
+    UPDATE tasks SET completed_at = CAST(strftime('%s', created_at) AS INTEGER)
+    WHERE status = 'done'
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_done_completed_at
+    ON tasks (completed_at)
+    WHERE status = 'done'
+    """)
+    #done tasks past ARCHIVE_AFTER_DAYS, out of the hot table and its indexes
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tasks_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        task_text TEXT NOT NULL,
+        deadline TEXT,
+        deadline_at INTEGER,
+        created_at TIMESTAMP,
+        completed_at INTEGER,
+        archived_at INTEGER NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_user ON tasks_archive (user_id, created_at)")
+
+def _migration_recurring_tasks(conn: sqlite3.Connection):
+    #RRULE without DTSTART, the current occurrence is in deadline / deadline_at
+    conn.execute("ALTER TABLE tasks ADD COLUMN rrule TEXT")
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_pending_recurring
+    ON tasks (deadline_at)
+    WHERE status = 'pending' AND rrule IS NOT NULL
+    """)
+
+def _migration_user_timezones(conn: sqlite3.Connection):
+    #IANA zone per user; users without a row keep server local time
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        tz TEXT NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_tz ON users (tz)")
+
+def _migration_outbox(conn: sqlite3.Connection):
+    #background messages (reminders, digests) waiting to be sent; key makes enqueueing idempotent.
+    #sent: 0 waiting, 1 sent, -1 dropped
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY,
+        key TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        due_at INTEGER NOT NULL,
+        send_after INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        sent_at INTEGER
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_waiting ON outbox (send_after) WHERE sent = 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_finished ON outbox (sent_at) WHERE sent != 0")
+
+#append only: position in the list is the schema version (PRAGMA user_version)
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_hot_query_indexes,
+    _migration_reminders_table,
+    _migration_reminder_leases,
+    _migration_pending_deadline_index,
+    _migration_upcoming_index,
+    _migration_shard_leases,
+    _migration_dialog_state,
+    _migration_task_search,
+    _migration_task_archive,
+    _migration_recurring_tasks,
+    _migration_user_timezones,
+    _migration_outbox,
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
 
+def run_migrations(pool: ConnectionPool) -> int:
+    with pool.reader() as conn:
+        version = get_schema_version(conn)
+    if version > len(MIGRATIONS):
+        raise RuntimeError(
+            f"Схема бази даних (v{version}) новіша за код (v{len(MIGRATIONS)})"
+        )
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+        migration = MIGRATIONS[number - 1]
+        with pool.writer() as conn:
+            #another process may have migrated while we were waiting for the lock
+            if get_schema_version(conn) >= number:
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        logger.info(f"Міграцію v{number} ({migration.__name__}) застосовано")
+    return len(MIGRATIONS)
+
+def _plan_uses_index(plan: list) -> bool:
+    for row in plan:
+        detail = row["detail"]
+        if detail.startswith("SCAN") and "INDEX" not in detail:
+            return False
+    return True
+
+def check_query_plans() -> dict:
+    # EXPLAIN QUERY PLAN for every hot query; False means a full table scan.
+    # fresh connection: pooled ones may still hold the pre-migration schema for EXPLAIN
+    results = {}
+    with closing(sqlite3.connect(DB_NAME)) as conn:
+        conn.row_factory = sqlite3.Row
+        for name, (query, params) in HOT_QUERIES.items():
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+            results[name] = _plan_uses_index(plan)
+            if not results[name]:
+                details = "; ".join(row["detail"] for row in plan)
+                logger.warning(f"Запит {name} не використовує індекс: {details}")
+    return results
+
+def init_db():
+    try:
+        version = run_migrations(get_pool())
+        logger.info(f"Схема бази даних актуальна (v{version})")
+        check_query_plans()
     except sqlite3.Error as e:
         logger.error(f"Помилка при роботі з SQLite: {e}")
-    finally:
-        if conn:
-            conn.close()
-            logger.info("З'єднання з SQLite закрито")
-
-def add_task(user_id: int, task_text: str, deadline: str = None, reminder_offset: int = 30) -> bool:
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        insert_query = """
-        INSERT INTO tasks (user_id, task_text, deadline, reminder_offset) 
-        VALUES (?, ?, ?, ?)
-        """
-        cursor.execute(insert_query, (user_id, task_text, deadline, reminder_offset))
-        conn.commit()
-        return True
-    except sqlite3.Error as e:
-        logger.error(f"Помилка при додаванні завдання: {e}")
-        return False
-    finally:
-        if conn: conn.close()
 
-def get_tasks(user_id: int) -> list:
-    tasks = []
+def _user_timezone(conn: sqlite3.Connection, user_id: int) -> str | None:
+    row = conn.execute("SELECT tz FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def _insert_reminders(conn: sqlite3.Connection, task_id: int, deadline_at: int | None, offsets: list[int],
+                      rrule: str | None = None, tz: str | None = None):
+    conn.executemany(
+        "INSERT INTO reminders (task_id, fire_at, kind) VALUES (?, ?, ?)",
+        [(task_id, fire_at, kind) for fire_at, kind in reminder_times(deadline_at, offsets, rrule, tz)],
+    )
+
+def _task_offsets(conn: sqlite3.Connection, task_id: int, deadline_at: int | None, reminder_offset: int | None) -> list[int]:
+    #the set of offsets the task was created with, read back from its reminders
+    offsets = [
+        row[0] // 60 for row in conn.execute(
+            "SELECT ? - fire_at FROM reminders WHERE task_id = ? AND kind = 'before'",
+            (deadline_at, task_id)
+        ) if row[0] is not None
+    ] or [reminder_offset or 0]
+    return reminder_offsets(offsets)
+
+def _advance_recurring(conn: sqlite3.Connection, task, now_ts: int, tz: str | None) -> str | None:
+    # moves a recurring task to its next occurrence with fresh reminders, the row stays the same;
+    # -> the new deadline, None when the rule has ended. the rule runs on the owner's wall clock,
+    # so "every day at 9:00" stays at 9:00 across DST changes
+    current = from_epoch(task["deadline_at"], tz)
+    occurrence = next_occurrence(task["rrule"], current, from_epoch(now_ts, tz))
+    if occurrence is None:
+        return None
+    offsets = _task_offsets(conn, task["id"], task["deadline_at"], task["reminder_offset"])
+    deadline, next_at = occurrence.strftime(DEADLINE_FORMAT), to_epoch(occurrence, tz)
+    conn.execute("""
+    UPDATE tasks
+    SET status = 'pending', completed_at = NULL, deadline = ?, deadline_at = ?, reminder_sent = 0
+    WHERE id = ?
+    """, (deadline, next_at, task["id"]))
+    conn.execute("DELETE FROM reminders WHERE task_id = ?", (task["id"],))
+    _insert_reminders(conn, task["id"], next_at, offsets, task["rrule"], tz)
+    return deadline
+
+def add_task(user_id: int, task_text: str, deadline: str = None, reminder_offset: int | list[int] = 30,
+             rrule: str | None = None) -> int | None:
+    # with rrule the deadline is the first occurrence, see parse_recurrence
+    offsets = reminder_offsets(reminder_offset)
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_pool().writer() as conn:
+            tz = _user_timezone(conn, user_id)
+            deadline_at = deadline_to_epoch(deadline, tz)
+            rrule = rrule if deadline_at is not None else None
+            insert_query = """
+            INSERT INTO tasks (user_id, task_text, deadline, deadline_at, reminder_offset, rrule)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """
+            cursor = conn.execute(
+                insert_query,
+                (user_id, task_text, deadline, deadline_at, offsets[-1] if offsets else 0, rrule)
+            )
+            _insert_reminders(conn, cursor.lastrowid, deadline_at, offsets, rrule, tz)
+        task_cache.invalidate(user_id)
+        return cursor.lastrowid
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при додаванні завдання: {e}")
+        return None
 
-        select_query = """
-        SELECT id, task_text, deadline 
-        FROM tasks 
-        WHERE user_id = ? AND status = 'pending' 
-        ORDER BY created_at ASC
-        """
+def _get_task_page(column: str, user_id: int, cursor: tuple | None, direction: str | None, limit: int) -> list:
+    if cursor is None:
+        direction = None
+    key = ("page", column, cursor, direction, limit)
+    tasks = task_cache.get(user_id, key)
+    if tasks is not MISSING:
+        return tasks
 
-        cursor.execute(select_query, (user_id, ))
-        tasks = cursor.fetchall()
+    generation = task_cache.generation()
+    params = (user_id, *(cursor if direction else ()), limit)
+    with get_pool().reader() as conn:
+        tasks = conn.execute(_task_page_query(column, direction), params).fetchall()
+    task_cache.put(user_id, key, tasks, generation)
+    #the user usually opens one of these next (edit_menu)
+    for task in tasks:
+        task_cache.put(user_id, ("task", task["id"]), task, generation)
+    return tasks
 
+def get_tasks(user_id: int, cursor: tuple | None = None, direction: str | None = "after", limit: int = -1) -> list:
+    # pending tasks in creation order; cursor is (created_at, id)
+    tasks = []
+    try:
+        tasks = _get_task_page("created_at", user_id, cursor, direction, limit)
     except sqlite3.Error as e:
         logger.error(f"Помилка при отриманні завдань: {e}")
-    finally:
-        if conn:
-            conn.close()
     return tasks
 
-def mark_task_done(user_id: int, task_id: int) -> int:
-    row_count = 0
+def get_upcoming_tasks(user_id: int, cursor: tuple | None = None, direction: str | None = "after", limit: int = -1) -> list:
+    # pending tasks with a deadline, nearest first; cursor is (deadline_at, id)
+    tasks = []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        update_query = """
-        UPDATE tasks 
-        SET status = 'done' 
-        WHERE id = ? AND user_id = ? AND status = 'pending'
-        """
-        cursor.execute(update_query, (task_id, user_id))
-        conn.commit()
-        row_count = cursor.rowcount
-
+        tasks = _get_task_page("deadline_at", user_id, cursor, direction, limit)
     except sqlite3.Error as e:
-        logger.error(f"Помилка при оновленні завдання: {e}")
-    finally:
-        if conn:
-            conn.close()
-    return row_count
+        logger.error(f"Помилка при отриманні найближчих завдань: {e}")
+    return tasks
 
-def delete_task_db(user_id: int, task_id: int) -> int:
-    row_count = 0
+def _placeholders(values) -> str:
+    return ", ".join("?" * len(values))
+
+def mark_tasks_done(user_id: int, task_ids: list[int]) -> list[tuple[int, str | None]]:
+    # -> (id, next deadline or None) for every pending task of this user that was completed;
+    # a recurring task moves to its next occurrence instead of staying done
+    task_ids = sorted(set(task_ids))
+    if not task_ids:
+        return []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        with get_pool().writer() as conn:
+            query = MARK_TASKS_DONE_QUERY.format(placeholders=_placeholders(task_ids))
+            now_ts = int(datetime.now().timestamp())
+            completed = []
+            rows = conn.execute(query, (now_ts, user_id, *task_ids)).fetchall()
+            tz = _user_timezone(conn, user_id) if any(row["rrule"] for row in rows) else None
+            for row in rows:
+                next_deadline = _advance_recurring(conn, row, now_ts, tz) if row["rrule"] else None
+                completed.append((row["id"], next_deadline))
+            done_ids = [task_id for task_id, next_deadline in completed if next_deadline is None]
+            if done_ids:
+                conn.execute(
+                    f"DELETE FROM reminders WHERE sent = 0 AND task_id IN ({_placeholders(done_ids)})",
+                    done_ids
+                )
+        task_cache.invalidate(user_id)
+        return completed
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при оновленні завдань: {e}")
+        return []
 
-        delete_query = "DELETE FROM tasks WHERE id = ? AND user_id = ?"
+def delete_tasks(user_id: int, task_ids: list[int]) -> list[int]:
+    # -> ids of this user's tasks that were deleted; reminders go with ON DELETE CASCADE
+    task_ids = sorted(set(task_ids))
+    if not task_ids:
+        return []
+    try:
+        with get_pool().writer() as conn:
+            query = DELETE_TASKS_QUERY.format(placeholders=_placeholders(task_ids))
+            deleted_ids = [row["id"] for row in conn.execute(query, (user_id, *task_ids)).fetchall()]
+        task_cache.invalidate(user_id)
+        return deleted_ids
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при видаленні завдань: {e}")
+        return []
 
-        cursor.execute(delete_query, (task_id, user_id))
-        conn.commit()
-        row_count = cursor.rowcount
+def roll_over_recurring(now_ts: int, shards: tuple | None = None) -> list[int]:
+    # recurring tasks whose rollover reminder is due move on to their next occurrence;
+    # -> ids of the tasks that got new reminders
+    rolled = []
+    try:
+        with get_pool().writer() as conn:
+            query = ROLLOVER_DUE_QUERY.format(shards=_shard_filter("t.user_id", shards))
+            tasks = conn.execute(query, (now_ts,)).fetchall()
+            for task in tasks:
+                if _advance_recurring(conn, task, now_ts, task["tz"]) is None:
+                    conn.execute("DELETE FROM reminders WHERE id = ?", (task["reminder_id"],))
+                else:
+                    rolled.append(task["id"])
+        for user_id in {task["user_id"] for task in tasks}:
+            task_cache.invalidate(user_id)
     except sqlite3.Error as e:
-        logger.error(f"Помилка при видаленні завдання: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Помилка roll_over_recurring: {e}")
+        return []
+    return rolled
+
+def mark_task_done(user_id: int, task_id: int) -> int:
+    return len(mark_tasks_done(user_id, [task_id]))
 
-    return row_count
+def delete_task_db(user_id: int, task_id: int) -> int:
+    return len(delete_tasks(user_id, [task_id]))
 
-def set_reminder_sent(task_id: int):
+def claim_due_reminders(now_ts: int, limit: int, lease_seconds: int = 120, shards: tuple | None = None) -> list:
+    # atomically leases up to `limit` due reminders, so a crashed or parallel
+    # sender cannot send the same reminder twice before the lease runs out
+    reminders = []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tasks SET reminder_sent = 1 WHERE id = ?", (task_id,))
-        conn.commit()
+        with get_pool().writer() as conn:
+            params = {"lease_until": now_ts + lease_seconds, "now": now_ts, "limit": limit}
+            claim_query = CLAIM_REMINDERS_QUERY.format(shards=_shard_filter("t.user_id", shards))
+            ids = [row[0] for row in conn.execute(claim_query, params).fetchall()]
+            if ids:
+                query = CLAIMED_REMINDERS_QUERY.format(placeholders=", ".join("?" * len(ids)))
+                reminders = conn.execute(query, ids).fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Помилка set_reminder_sent: {e}")
-    finally:
-        if conn: conn.close()
+        logger.error(f"Помилка claim_due_reminders: {e}")
+    return reminders
 
-def get_all_pending_tasks_with_deadline():
-    tasks = []
+def get_upcoming_reminders(until_ts: int, shards: tuple | None = None) -> list:
+    reminders = []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_pool().reader() as conn:
+            query = UPCOMING_REMINDERS_QUERY.format(shards=_shard_filter("t.user_id", shards))
+            reminders = conn.execute(query, (until_ts,)).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_upcoming_reminders: {e}")
+    return reminders
 
-        query = """
-                SELECT * \
-                FROM tasks
-                WHERE status = 'pending'
-                  AND deadline IS NOT NULL
-                  AND reminder_sent = 0
-                """
-        cursor.execute(query)
-        tasks = cursor.fetchall()
+def get_task_reminders(task_id: int) -> list:
+    reminders = []
+    try:
+        with get_pool().reader() as conn:
+            select_query = """
+            SELECT id, task_id, MAX(fire_at, COALESCE(claimed_until, 0)) AS fire_at
+            FROM reminders
+            WHERE task_id = ? AND sent = 0
+            """
+            reminders = conn.execute(select_query, (task_id,)).fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Помилка get_all_pending_tasks: {e}")
-    finally:
-        if conn: conn.close()
-    return tasks
+        logger.error(f"Помилка get_task_reminders: {e}")
+    return reminders
 
 
 def get_single_task(user_id: int, task_id: int):
+    task = task_cache.get(user_id, ("task", task_id))
+    if task is not MISSING:
+        return task
     task = None
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        select_query = "SELECT * FROM tasks WHERE id = ? AND user_id = ?"
-        cursor.execute(select_query, (task_id, user_id))
-        task = cursor.fetchone()
+        generation = task_cache.generation()
+        with get_pool().reader() as conn:
+            task = conn.execute(GET_SINGLE_TASK_QUERY, (task_id, user_id)).fetchone()
+        task_cache.put(user_id, ("task", task_id), task, generation)
     except sqlite3.Error as e:
         logger.error(f"Помилка при отриманні одного завдання: {e}")
-    finally:
-        if conn:
-            conn.close()
     return task
 
 def update_task_text(user_id: int, task_id: int, new_text: str) -> bool:
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        update_query = """
-        UPDATE tasks 
-        SET task_text = ? 
-        WHERE id = ? AND user_id = ?
-        """
-
-        cursor.execute(update_query, (new_text, task_id, user_id))
-        conn.commit()
-        return cursor.rowcount > 0
+        with get_pool().writer() as conn:
+            update_query = """
+            UPDATE tasks
+            SET task_text = ?
+            WHERE id = ? AND user_id = ?
+            """
+            updated = conn.execute(update_query, (new_text, task_id, user_id)).rowcount > 0
+        task_cache.invalidate(user_id)
+        return updated
     except sqlite3.Error as e:
         logger.error(f"Помилка при оновленні тексту завдання: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
-def update_task_deadline(user_id: int, task_id: int, new_deadline: str | None) -> bool:
+def update_task_deadline(user_id: int, task_id: int, new_deadline: str | None, rrule: str | None = None) -> bool:
+    # a plain deadline also turns a recurring task into a one-off one
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-
-        update_query = """
-        UPDATE tasks 
-        SET deadline = ? 
-        WHERE id = ? AND user_id = ?
-        """
-        cursor.execute(update_query, (new_deadline, task_id, user_id))
-        conn.commit()
+        with get_pool().writer() as conn:
+            tz = _user_timezone(conn, user_id)
+            deadline_at = deadline_to_epoch(new_deadline, tz)
+            rrule = rrule if deadline_at is not None else None
+            task = conn.execute(
+                "SELECT deadline_at, reminder_offset FROM tasks WHERE id = ? AND user_id = ?",
+                (task_id, user_id)
+            ).fetchone()
+            if not task:
+                return False
+            #keep the same set of offsets the task was created with
+            offsets = _task_offsets(conn, task_id, task["deadline_at"], task["reminder_offset"])
 
+            update_query = """
+            UPDATE tasks
+            SET deadline = ?, deadline_at = ?, rrule = ?, reminder_sent = 0
+            WHERE id = ? AND user_id = ?
+            """
+            conn.execute(update_query, (new_deadline, deadline_at, rrule, task_id, user_id))
+            conn.execute("DELETE FROM reminders WHERE task_id = ?", (task_id,))
+            _insert_reminders(conn, task_id, deadline_at, offsets, rrule, tz)
+        task_cache.invalidate(user_id)
+        return True
     except sqlite3.Error as e:
         logger.error(f"Помилка при оновленні дедлайну: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
-def get_all_users_with_tasks() -> list:
-    users = []
+def get_tasks_due_between(start_ts: int, end_ts: int, tz: str | None, shards: tuple | None = None) -> list:
+    # tasks of the users in timezone tz (None: users on server time): one range query over the
+    # pending-deadline index, plus every occurrence of recurring tasks in the range expanded on
+    # the fly; rows come grouped by user, ordered by time
+    tasks = []
+    users, zone_params = (USERS_WITHOUT_ZONE, ()) if tz is None else (USERS_IN_ZONE, (tz,))
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT user_id FROM tasks")
-        users = [row[0] for row in cursor.fetchall()]
+        with get_pool().reader() as conn:
+            shard_filter = _shard_filter("user_id", shards)
+            tasks = conn.execute(
+                TASKS_DUE_BETWEEN_QUERY.format(users=users, shards=shard_filter), (start_ts, end_ts, *zone_params)
+            ).fetchall()
+            recurring = conn.execute(
+                RECURRING_DUE_QUERY.format(users=users, shards=shard_filter), (end_ts, *zone_params)
+            ).fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Помилка get_all_users: {e}")
-    finally:
-        if conn: conn.close()
-    return users
-def get_tasks_for_today(user_id: int) -> list:
+        logger.error(f"Помилка get_tasks_due_between: {e}")
+        return tasks
+    return with_occurrences(tasks, recurring, start_ts, end_ts, tz)
+
+def heartbeat_shard_leases(owner: str, home_shard: int, shard_count: int, ttl: int) -> list[int] | None:
+    # renews the caller's leases and returns the shards it owns now, None if the database failed.
+    # a worker always claims its home shard back; foreign shards are only taken once their lease ran out
+    now = int(datetime.now().timestamp())
+    params = {"owner": owner, "home": home_shard, "count": shard_count, "now": now, "expires": now + ttl, "ttl": ttl}
+    try:
+        with get_pool().writer() as conn:
+            #hand foreign shards back to a home worker that asked for them
+            conn.execute("""
+            UPDATE shard_leases SET owner = NULL, expires_at = :now
+            WHERE owner = :owner AND shard != :home AND wanted_by IS NOT NULL
+            """, params)
+            conn.execute("""
+            INSERT INTO shard_leases (shard, owner, expires_at) VALUES (:home, :owner, :expires)
+            ON CONFLICT (shard) DO UPDATE
+            SET owner = excluded.owner, expires_at = excluded.expires_at, wanted_by = NULL
+            WHERE shard_leases.owner IS excluded.owner OR shard_leases.owner IS NULL
+               OR shard_leases.expires_at < :now
+            """, params)
+            conn.execute(
+                "UPDATE shard_leases SET wanted_by = :owner WHERE shard = :home AND owner IS NOT :owner",
+                params
+            )
+            #a wanted shard is left to its home worker unless that one is gone for a whole ttl too
+            conn.execute("""
+            UPDATE shard_leases
+            SET owner = :owner, expires_at = :expires,
+                wanted_by = CASE WHEN owner IS :owner THEN wanted_by END
+            WHERE shard < :count AND (
+                owner IS :owner
+                OR (expires_at < :now AND wanted_by IS NULL)
+                OR expires_at < :now - :ttl
+            )
+            """, params)
+            rows = conn.execute(
+                "SELECT shard FROM shard_leases WHERE owner = :owner AND shard < :count ORDER BY shard",
+                params
+            ).fetchall()
+        return [row[0] for row in rows]
+    except sqlite3.Error as e:
+        logger.error(f"Помилка heartbeat_shard_leases: {e}")
+        return None
+
+def release_shard_leases(owner: str):
+    try:
+        with get_pool().writer() as conn:
+            conn.execute("UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE owner = ?", (owner,))
+    except sqlite3.Error as e:
+        logger.error(f"Помилка release_shard_leases: {e}")
+
+def get_shard_owners() -> dict:
+    owners = {}
+    try:
+        with get_pool().reader() as conn:
+            rows = conn.execute(
+                "SELECT shard, owner FROM shard_leases WHERE owner IS NOT NULL AND expires_at >= ?",
+                (int(datetime.now().timestamp()),)
+            ).fetchall()
+        owners = {row["shard"]: row["owner"] for row in rows}
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_shard_owners: {e}")
+    return owners
+
+def claim_shard_digest(owner: str, shards: list[int], day: str) -> list[int]:
+    # marks a digest run as taken for the owned shards that have not had it yet;
+    # day is the run's key, the digest_date column predates per-timezone runs
+    claimed = []
+    if not shards:
+        return claimed
+    try:
+        with get_pool().writer() as conn:
+            placeholders = ", ".join("?" * len(shards))
+            rows = conn.execute(f"""
+            UPDATE shard_leases SET digest_date = ?
+            WHERE owner = ? AND shard IN ({placeholders}) AND digest_date IS NOT ?
+            RETURNING shard
+            """, (day, owner, *shards, day)).fetchall()
+        claimed = sorted(row[0] for row in rows)
+    except sqlite3.Error as e:
+        logger.error(f"Помилка claim_shard_digest: {e}")
+    return claimed
+
+def import_tasks(user_id: int, tasks: list[tuple[str, str | None, str]], reminder_offset: int = 30) -> int:
+    # tasks are (task_text, deadline, status); everything goes in with one executemany in
+    # one transaction. reminders only for pending tasks whose reminder is still ahead
+    now_ts = int(datetime.now().timestamp())
+    try:
+        with get_pool().writer() as conn:
+            tz = _user_timezone(conn, user_id)
+            #we hold the write lock, so every id above this one is ours
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM tasks").fetchone()[0]
+            conn.executemany(
+                """
+                INSERT INTO tasks (user_id, task_text, deadline, deadline_at, status, reminder_offset, completed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    (
+                        user_id, task_text, deadline, deadline_to_epoch(deadline, tz), status, reminder_offset,
+                        now_ts if status == "done" else None,
+                    )
+                    for task_text, deadline, status in tasks
+                )
+            )
+            if reminder_offset > 0:
+                conn.execute("""
+                INSERT INTO reminders (task_id, fire_at, kind)
+                SELECT id, deadline_at - :offset, 'before'
+                FROM tasks
+                WHERE id > :last_id AND user_id = :user_id AND status = 'pending'
+                  AND deadline_at - :offset > :now
+                """, {
+                    "offset": reminder_offset * 60,
+                    "last_id": last_id,
+                    "user_id": user_id,
+                    "now": now_ts,
+                })
+        task_cache.invalidate(user_id)
+        return len(tasks)
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при імпорті завдань: {e}")
+        return 0
+
+def iter_user_tasks(user_id: int, batch_size: int = EXPORT_BATCH_SIZE):
+    # all tasks of a user (archived, done, then pending), fetched batch by batch;
+    # keeps a reader connection until the generator is exhausted or closed
+    with get_pool().reader() as conn:
+        for query in (EXPORT_ARCHIVE_QUERY, EXPORT_TASKS_QUERY):
+            cursor = conn.execute(query, (user_id,))
+            while rows := cursor.fetchmany(batch_size):
+                yield from rows
+
+def archive_done_tasks(older_than_days: int, batch_size: int = ARCHIVE_BATCH_SIZE,
+                       max_vacuum_pages: int = VACUUM_MAX_PAGES) -> dict:
+    # moves tasks done more than older_than_days ago into tasks_archive, batch_size rows per
+    # transaction so handlers get the write lock in between; then gives freed pages back and
+    # lets sqlite refresh its statistics. -> counters for the log and metrics
+    now_ts = int(datetime.now().timestamp())
+    cutoff = now_ts - older_than_days * 86400
+    stats = {"archived": 0, "batches": 0, "pages_freed": 0, "pages_left": 0, "incremental": False}
+    pool = get_pool()
+    try:
+        while True:
+            with pool.writer() as conn:
+                ids = [row[0] for row in conn.execute(
+                    ARCHIVE_TASKS_QUERY, {"now": now_ts, "cutoff": cutoff, "limit": batch_size}
+                ).fetchall()]
+                #reminders go with ON DELETE CASCADE, the fts index with its trigger
+                conn.executemany("DELETE FROM tasks WHERE id = ?", ((task_id,) for task_id in ids))
+            if not ids:
+                break
+            stats["archived"] += len(ids)
+            stats["batches"] += 1
+
+        with pool.writer() as conn:
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            #databases created before auto_vacuum was set need one full VACUUM to switch modes,
+            #until then freed pages are only reused by new rows
+            stats["incremental"] = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+            if stats["incremental"]:
+                conn.execute(f"PRAGMA incremental_vacuum({int(max_vacuum_pages)})").fetchall()
+            stats["pages_freed"] = page_count - conn.execute("PRAGMA page_count").fetchone()[0]
+            stats["pages_left"] = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при архівації завдань: {e}")
+    return stats
+
+def _search_expression(user_id: int, text: str) -> str | None:
+    # every word becomes a quoted prefix term, so user input is never parsed as fts5 syntax
+    # and "хліб" also finds "хліба"
+    words = SEARCH_WORD_RE.findall(text.lower())
+    if not words:
+        return None
+    terms = " ".join(f'"{word}"*' for word in words)
+    return f"owner:{int(user_id)} AND task_text:({terms})"
+
+def search_tasks(user_id: int, text: str, limit: int = -1, offset: int = 0) -> list:
+    # pending tasks matching every word of text, best match first
     tasks = []
+    expression = _search_expression(user_id, text)
+    if expression is None:
+        return tasks
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_pool().reader() as conn:
+            tasks = conn.execute(SEARCH_TASKS_QUERY, (expression, limit, offset)).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при пошуку завдань: {e}")
+    return tasks
 
-        today_str = datetime.now().strftime("%Y/%m/%d")
-        query = """
-        SELECT * FROM tasks 
-        WHERE user_id = ? 
-          AND status = 'pending'
-          AND deadline LIKE ?
-        """
+def enqueue_messages(messages: list[tuple], reminder_ids: list[int] = ()) -> int | None:
+    # messages are (key, kind, chat_id, text, parse_mode, due_at); a key already in the
+    # outbox is skipped. reminder_ids are marked sent in the same transaction, so a reminder
+    # is either still due or has its message queued. -> messages added, None on failure
+    now_ts = int(datetime.now().timestamp())
+    try:
+        with get_pool().writer() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                """
+                INSERT INTO outbox (key, kind, chat_id, text, parse_mode, due_at, send_after)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO NOTHING
+                """,
+                [(*message, now_ts) for message in messages]
+            )
+            added = conn.total_changes - before
+            conn.executemany(
+                "UPDATE reminders SET sent = 1, claimed_until = NULL WHERE id = ?",
+                [(reminder_id,) for reminder_id in reminder_ids]
+            )
+        return added
+    except sqlite3.Error as e:
+        logger.error(f"Помилка enqueue_messages: {e}")
+        return None
 
-        cursor.execute(query, (user_id, f"%{today_str}%"))
-        tasks = cursor.fetchall()
+def claim_outbox(now_ts: int, limit: int, lease_seconds: int = 120, shards: tuple | None = None) -> list:
+    # leases up to `limit` due messages, oldest first
+    messages = []
+    try:
+        with get_pool().writer() as conn:
+            params = {"lease_until": now_ts + lease_seconds, "now": now_ts, "limit": limit}
+            query = CLAIM_OUTBOX_QUERY.format(shards=_shard_filter("chat_id", shards))
+            messages = conn.execute(query, params).fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Помилка get_tasks_for_today: {e}")
+        logger.error(f"Помилка claim_outbox: {e}")
+    #RETURNING gives no order guarantee
+    return sorted(messages, key=lambda row: row["due_at"])
+
+def finish_outbox(message_id: int, sent: int, send_after: int | None = None) -> bool:
+    # sent: 1 sent, -1 dropped, 0 retry at send_after
+    try:
+        with get_pool().writer() as conn:
+            conn.execute("""
+            UPDATE outbox
+            SET sent = :sent, send_after = COALESCE(:send_after, send_after),
+                sent_at = CASE WHEN :sent != 0 THEN :now END
+            WHERE id = :id
+            """, {"sent": sent, "send_after": send_after, "now": int(datetime.now().timestamp()), "id": message_id})
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Помилка finish_outbox: {e}")
+        return False
+
+def get_outbox_depth(now_ts: int, shards: tuple | None = None) -> dict:
+    # waiting messages that are due now vs. scheduled later (retries, leased ones)
+    depth = {"due": 0, "scheduled": 0}
+    try:
+        with get_pool().reader() as conn:
+            row = conn.execute(f"""
+            SELECT COUNT(*) FILTER (WHERE send_after <= ?) AS due, COUNT(*) FILTER (WHERE send_after > ?) AS scheduled
+            FROM outbox
+            WHERE sent = 0{_shard_filter("chat_id", shards)}
+            """, (now_ts, now_ts)).fetchone()
+        depth = {"due": row["due"], "scheduled": row["scheduled"]}
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_outbox_depth: {e}")
+    return depth
+
+def get_next_outbox_send(shards: tuple | None = None) -> int | None:
+    try:
+        with get_pool().reader() as conn:
+            row = conn.execute(
+                f"SELECT MIN(send_after) FROM outbox WHERE sent = 0{_shard_filter('chat_id', shards)}"
+            ).fetchone()
+        return row[0]
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_next_outbox_send: {e}")
+        return None
+
+def purge_outbox(older_than_days: int) -> int:
+    # finished messages are kept for a while so their keys still deduplicate
+    cutoff = int((datetime.now() - timedelta(days=older_than_days)).timestamp())
+    try:
+        with get_pool().writer() as conn:
+            return conn.execute("DELETE FROM outbox WHERE sent != 0 AND sent_at < ?", (cutoff,)).rowcount
+    except sqlite3.Error as e:
+        logger.error(f"Помилка purge_outbox: {e}")
+        return 0
+
+def get_user_timezone(user_id: int) -> str | None:
+    try:
+        with get_pool().reader() as conn:
+            return _user_timezone(conn, user_id)
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_user_timezone: {e}")
+        return None
+
+def set_user_timezone(user_id: int, tz: str) -> bool:
+    # deadline_at stays put, the deadline strings of pending tasks are rewritten for the new zone:
+    # a task due at 18:00 in Kyiv shows 16:00 after switching to London
+    try:
+        with get_pool().writer() as conn:
+            conn.execute(
+                "INSERT INTO users (user_id, tz) VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET tz = excluded.tz",
+                (user_id, tz)
+            )
+            rows = conn.execute(
+                "SELECT id, deadline_at FROM tasks WHERE user_id = ? AND status = 'pending' AND deadline_at IS NOT NULL",
+                (user_id,)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET deadline = ? WHERE id = ?",
+                [(from_epoch(row["deadline_at"], tz).strftime(DEADLINE_FORMAT), row["id"]) for row in rows]
+            )
+        task_cache.invalidate(user_id)
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Помилка при зміні часового поясу: {e}")
+        return False
+
+def get_timezones() -> list[str]:
+    # distinct zones users have chosen, read from idx_users_tz
+    zones = []
+    try:
+        with get_pool().reader() as conn:
+            zones = [row[0] for row in conn.execute("SELECT DISTINCT tz FROM users")]
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_timezones: {e}")
+    return zones
+
+def get_user_data(user_id: int) -> str | None:
+    try:
+        with get_pool().reader() as conn:
+            row = conn.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return row["data"] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_user_data: {e}")
+        return None
+
+def get_conversations(name: str) -> list:
+    rows = []
+    try:
+        with get_pool().reader() as conn:
+            rows = conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Помилка get_conversations: {e}")
+    return rows
+
+def save_dialog_state(users: list[tuple[int, str | None]], conversations: list[tuple[str, str, str | None]]) -> bool:
+    # one transaction for a whole batch; None removes the row
+    try:
+        with get_pool().writer() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(user_id, data) for user_id, data in users if data is not None]
+            )
+            conn.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in users if data is None]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [row for row in conversations if row[2] is not None]
+            )
+            conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for name, key, state in conversations if state is None]
+            )
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Помилка save_dialog_state: {e}")
+        return False
+
+def get_cache_stats() -> dict:
+    return task_cache.stats()
+
+def clear_cache():
+    # for a sharded worker that took shards over: their users' rows were written by another process
+    task_cache.clear()
+
+
+
+#async api: the same functions, executed on the db thread pool instead of the event loop
+
+def _timed_call(func, submitted_at: float, *args, **kwargs):
+    started_at = perf_counter()
+    #time spent queued behind other calls means the pool is too small
+    DB_WAIT_SECONDS.observe(started_at - submitted_at)
+    try:
+        return func(*args, **kwargs)
     finally:
-        if conn: conn.close()
-    return tasks
+        DB_SECONDS.observe(perf_counter() - started_at, function=func.__name__)
+
+def _to_async(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, partial(_timed_call, func, perf_counter(), *args, **kwargs))
+    return wrapper
+
+init_db_async = _to_async(init_db)
+add_task_async = _to_async(add_task)
+get_tasks_async = _to_async(get_tasks)
+get_upcoming_tasks_async = _to_async(get_upcoming_tasks)
+mark_task_done_async = _to_async(mark_task_done)
+delete_task_db_async = _to_async(delete_task_db)
+mark_tasks_done_async = _to_async(mark_tasks_done)
+roll_over_recurring_async = _to_async(roll_over_recurring)
+delete_tasks_async = _to_async(delete_tasks)
+claim_due_reminders_async = _to_async(claim_due_reminders)
+get_upcoming_reminders_async = _to_async(get_upcoming_reminders)
+get_task_reminders_async = _to_async(get_task_reminders)
+get_single_task_async = _to_async(get_single_task)
+update_task_text_async = _to_async(update_task_text)
+update_task_deadline_async = _to_async(update_task_deadline)
+get_tasks_due_between_async = _to_async(get_tasks_due_between)
+heartbeat_shard_leases_async = _to_async(heartbeat_shard_leases)
+release_shard_leases_async = _to_async(release_shard_leases)
+get_shard_owners_async = _to_async(get_shard_owners)
+claim_shard_digest_async = _to_async(claim_shard_digest)
+import_tasks_async = _to_async(import_tasks)
+search_tasks_async = _to_async(search_tasks)
+archive_done_tasks_async = _to_async(archive_done_tasks)
+get_user_timezone_async = _to_async(get_user_timezone)
+set_user_timezone_async = _to_async(set_user_timezone)
+get_timezones_async = _to_async(get_timezones)
+enqueue_messages_async = _to_async(enqueue_messages)
+claim_outbox_async = _to_async(claim_outbox)
+finish_outbox_async = _to_async(finish_outbox)
+get_next_outbox_send_async = _to_async(get_next_outbox_send)
+purge_outbox_async = _to_async(purge_outbox)
+get_user_data_async = _to_async(get_user_data)
+get_conversations_async = _to_async(get_conversations)
+save_dialog_state_async = _to_async(save_dialog_state)
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    init_db()
@@ -0,0 +1,341 @@
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from time import perf_counter
+
+from metrics import PARSE_DATE_SECONDS
+
+#dateparser (with regex, tzlocal and its language data) is imported on first use, see _get_parser,
+#dateutil.rrule only once a recurring task shows up, see _rule
+
+logger = logging.getLogger(__name__)
+
+DATE_LANGUAGES = [lang.strip() for lang in os.getenv("DATE_LANGUAGES", "uk,en").split(",") if lang.strip()]
+PARSE_CACHE_SIZE = 2048
+#relative inputs ("через 2 години") are cached per bucket, so they can drift by up to this much
+CACHE_BUCKET_SECONDS = 60
+#parsers for the buckets in use: one per timezone offset that is active at the moment
+BASE_PARSER_CACHE_SIZE = 64
+
+ISO_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})(?:[ t](\d{1,2}):(\d{2})(?::(\d{2}))?)?$")
+DOTTED_RE = re.compile(
+    r"^(\d{1,2})[./](\d{1,2})(?:[./](\d{4}|\d{2}))?(?: (?:о |об |в |at )?(\d{1,2})(?::(\d{2}))?)?$"
+)
+DAY_WORD_RE = re.compile(
+    r"^(сьогодні|завтра|післязавтра|today|tomorrow|day after tomorrow)"
+    r"(?: (?:о|об|в|at) (\d{1,2})(?::(\d{2}))?| (\d{1,2}):(\d{2}))?$"
+)
+RELATIVE_RE = re.compile(r"^(?:через|in) (?:(\d+|пів|an?) )?([a-zа-яіїєґ']+)$")
+TIME_RE = re.compile(r"^(?:(?:о|об|в|at) )?(\d{1,2}):(\d{2})$")
+#"щопонеділка о 9:00", "кожного дня о 8", "every friday at 18:30", "по буднях 9:15", "rrule:freq=..."
+RECURRENCE_RE = re.compile(
+    r"^(?:(?:що|кож[а-яіїє]* |every )([a-zа-яіїєґ']+)|(daily|weekly|monthly|yearly|weekdays|по буднях))"
+    r"(?: (?:о|об|в|at) (\d{1,2})(?::(\d{2}))?| (\d{1,2}):(\d{2}))?$"
+)
+RRULE_PREFIXES = ("rrule:", "freq=")
+#every rollover rewrites the task and its reminders, so raw rules may repeat at most hourly
+RRULE_FREQUENCIES = ("HOURLY", "DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+#"+3", "utc+3", "gmt-5"; whole hours only, other offsets need a city ("asia/kolkata")
+UTC_OFFSET_RE = re.compile(r"^(?:utc|gmt)? ?([+-])(\d{1,2})(?::00)?$")
+
+DAY_WORDS = {
+    "сьогодні": 0, "today": 0,
+    "завтра": 1, "tomorrow": 1,
+    "післязавтра": 2, "day after tomorrow": 2,
+}
+#unit stems: "хвилину/хвилини/хвилин", "годину/години/годин", "день/дні/днів/дня" ...
+RELATIVE_UNITS = [
+    ("хв", "minutes"), ("min", "minutes"),
+    ("год", "hours"), ("hour", "hours"), ("h", "hours"),
+    ("ден", "days"), ("дн", "days"), ("day", "days"),
+    ("тиж", "weeks"), ("week", "weeks"),
+]
+WEEKDAYS_RULE = "FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR"
+#word stems after "що"/"кожен"/"every", weekday names first so "понеділок" is not taken for "день"
+RECURRENCE_UNITS = [
+    ("понеділ", "FREQ=WEEKLY;BYDAY=MO"), ("monday", "FREQ=WEEKLY;BYDAY=MO"),
+    ("вівтор", "FREQ=WEEKLY;BYDAY=TU"), ("tuesday", "FREQ=WEEKLY;BYDAY=TU"),
+    ("серед", "FREQ=WEEKLY;BYDAY=WE"), ("wednesday", "FREQ=WEEKLY;BYDAY=WE"),
+    ("четвер", "FREQ=WEEKLY;BYDAY=TH"), ("thursday", "FREQ=WEEKLY;BYDAY=TH"),
+    ("п'ятниц", "FREQ=WEEKLY;BYDAY=FR"), ("friday", "FREQ=WEEKLY;BYDAY=FR"),
+    ("субот", "FREQ=WEEKLY;BYDAY=SA"), ("saturday", "FREQ=WEEKLY;BYDAY=SA"),
+    ("неділ", "FREQ=WEEKLY;BYDAY=SU"), ("sunday", "FREQ=WEEKLY;BYDAY=SU"),
+    ("будн", WEEKDAYS_RULE), ("weekday", WEEKDAYS_RULE),
+    ("годин", "FREQ=HOURLY"), ("hour", "FREQ=HOURLY"),
+    ("дн", "FREQ=DAILY"), ("ден", "FREQ=DAILY"), ("day", "FREQ=DAILY"),
+    ("тиж", "FREQ=WEEKLY"), ("week", "FREQ=WEEKLY"),
+    ("місяц", "FREQ=MONTHLY"), ("month", "FREQ=MONTHLY"),
+    ("рок", "FREQ=YEARLY"), ("рік", "FREQ=YEARLY"), ("year", "FREQ=YEARLY"),
+]
+RECURRENCE_WORDS = {
+    "daily": "FREQ=DAILY", "weekly": "FREQ=WEEKLY", "monthly": "FREQ=MONTHLY", "yearly": "FREQ=YEARLY",
+    "weekdays": WEEKDAYS_RULE, "по буднях": WEEKDAYS_RULE,
+}
+DEFAULT_RECURRENCE_HOUR = 9
+TIMEZONE_ALIASES = {
+    "київ": "Europe/Kyiv", "kyiv": "Europe/Kyiv", "kiev": "Europe/Kyiv", "україна": "Europe/Kyiv",
+    "львів": "Europe/Kyiv", "одеса": "Europe/Kyiv", "харків": "Europe/Kyiv", "дніпро": "Europe/Kyiv",
+    "варшава": "Europe/Warsaw", "берлін": "Europe/Berlin", "прага": "Europe/Prague",
+    "лондон": "Europe/London", "лісабон": "Europe/Lisbon", "нью-йорк": "America/New_York",
+    "торонто": "America/Toronto", "utc": "UTC", "gmt": "UTC",
+}
+
+
+def normalize(date_string: str) -> str:
+    return " ".join(date_string.lower().replace("’", "'").split()).rstrip(".")
+
+
+def _at(day: datetime, hour: str | None, minute: str | None, now: datetime) -> datetime:
+    if hour is None:
+        #dateparser keeps the current time of day when only a date is given
+        return day.replace(hour=now.hour, minute=now.minute, second=now.second, microsecond=0)
+    return day.replace(hour=int(hour), minute=int(minute or 0), second=0, microsecond=0)
+
+
+def _parse_fast(text: str, now: datetime) -> datetime | None:
+    match = DAY_WORD_RE.match(text)
+    if match:
+        word, hour, minute, hour2, minute2 = match.groups()
+        day = now + timedelta(days=DAY_WORDS[word])
+        return _at(day, hour or hour2, minute or minute2, now)
+
+    match = TIME_RE.match(text)
+    if match:
+        result = _at(now, *match.groups(), now)
+        return result if result > now else result + timedelta(days=1)
+
+    match = RELATIVE_RE.match(text)
+    if match:
+        amount, unit = match.groups()
+        if amount in (None, "a", "an"):
+            value = 1
+        elif amount == "пів":
+            value = 0.5
+        else:
+            value = int(amount)
+        for stem, name in RELATIVE_UNITS:
+            if unit.startswith(stem):
+                return (now + timedelta(**{name: value})).replace(microsecond=0)
+
+    match = ISO_RE.match(text)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+        result = datetime(int(year), int(month), int(day))
+        if hour is None:
+            return _at(result, None, None, now)
+        return result.replace(hour=int(hour), minute=int(minute), second=int(second or 0))
+
+    match = DOTTED_RE.match(text)
+    if match:
+        day, month, year, hour, minute = match.groups()
+        if year is None:
+            result = _at(datetime(now.year, int(month), int(day)), hour, minute, now)
+            #prefer the future like dateparser does: "25.12" in late december means next year
+            if result < now:
+                result = result.replace(year=now.year + 1)
+            return result
+        year = int(year) + 2000 if len(year) == 2 else int(year)
+        return _at(datetime(year, int(month), int(day)), hour, minute, now)
+
+    return None
+
+
+_parser = None
+_parser_lock = threading.Lock()
+
+def _get_parser():
+    global _parser
+    if _parser is None:
+        with _parser_lock:
+            if _parser is None:
+                from dateparser.date import DateDataParser
+                _parser = DateDataParser(
+                    languages=DATE_LANGUAGES,
+                    settings={'PREFER_DATES_FROM': 'future'}
+                )
+    return _parser
+
+def warm_up() -> float:
+    # imports dateparser and loads the language data ahead of the first user
+    start = perf_counter()
+    _get_parser().get_date_data("наступної п'ятниці")
+    elapsed = perf_counter() - start
+    logger.info(f"dateparser прогріто за {elapsed:.2f} с")
+    return elapsed
+
+
+@lru_cache(maxsize=BASE_PARSER_CACHE_SIZE)
+def _parser_for(base: datetime):
+    # RELATIVE_BASE is a parser setting, not an argument of get_date_data: one parser per
+    # bucketed base, shared by every text and every user whose clock shows that minute
+    from dateparser.date import DateDataParser
+    return DateDataParser(
+        languages=DATE_LANGUAGES,
+        settings={'PREFER_DATES_FROM': 'future', 'RELATIVE_BASE': base}
+    )
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_fallback(text: str, base: datetime) -> datetime | None:
+    # relative phrases count from base, the caller's (user-local) now; _get_parser's
+    # parser would take the server clock
+    return _parser_for(base).get_date_data(text).date_obj
+
+
+def parse_date(date_string: str, now: datetime | None = None) -> datetime | None:
+    # hand-written fast path for the common forms, cached dateparser for the rest
+    start = perf_counter()
+    now = now or datetime.now()
+    text = normalize(date_string)
+    if not text:
+        return None
+    try:
+        result = _parse_fast(text, now)
+    except ValueError:
+        #"12/25", "2026-13-01": not a valid day.month, dateparser may still read it month first
+        result = None
+    if result is not None:
+        PARSE_DATE_SECONDS.observe(perf_counter() - start, path="fast")
+        return result
+    #the whole wall-clock base is the key, users in other timezones get their own entries
+    into_bucket = (now.hour * 3600 + now.minute * 60 + now.second) % CACHE_BUCKET_SECONDS
+    result = _parse_fallback(text, now.replace(microsecond=0) - timedelta(seconds=into_bucket))
+    PARSE_DATE_SECONDS.observe(perf_counter() - start, path="dateparser")
+    return result
+
+
+def parse_date_legacy(date_string: str) -> datetime | None:
+    # the previous implementation, kept for benchmarks and comparisons
+    import dateparser
+    return dateparser.parse(date_string, settings={'PREFER_DATES_FROM': 'future'})
+
+
+def cache_info():
+    return _parse_fallback.cache_info()
+
+
+def _rule(rule: str, start: datetime):
+    from dateutil.rrule import rrulestr
+    return rrulestr(rule, dtstart=start)
+
+
+def _rule_too_frequent(rule: str) -> bool:
+    # sub-hour rules: FREQ=SECONDLY/MINUTELY, a bad INTERVAL, several BYMINUTE/BYSECOND values
+    parts = dict(part.partition("=")[::2] for part in rule.split(";"))
+    interval = parts.get("INTERVAL", "1")
+    return (
+        parts.get("FREQ") not in RRULE_FREQUENCIES
+        or not interval.isdigit() or int(interval) < 1
+        or "," in parts.get("BYMINUTE", "") or "," in parts.get("BYSECOND", "")
+    )
+
+
+def parse_recurrence(date_string: str, now: datetime | None = None) -> tuple[str, datetime] | None:
+    # -> (RRULE without DTSTART, first occurrence after now) or None when the text is not a recurrence
+    now = (now or datetime.now()).replace(microsecond=0)
+    text = normalize(date_string)
+    if text.startswith(RRULE_PREFIXES):
+        rule = text.upper().removeprefix("RRULE:")
+        if "COUNT=" in rule:
+            #occurrences are counted from the current one each time, a count would never run out
+            return None
+        if _rule_too_frequent(rule):
+            return None
+        start = now.replace(second=0)
+    else:
+        match = RECURRENCE_RE.match(text)
+        if not match:
+            return None
+        word, bare_word, hour, minute, hour2, minute2 = match.groups()
+        rule = RECURRENCE_WORDS.get(bare_word) or next(
+            (unit_rule for stem, unit_rule in RECURRENCE_UNITS if word.startswith(stem)), None
+        )
+        if rule is None:
+            return None
+        hour, minute = int(hour or hour2 or DEFAULT_RECURRENCE_HOUR), int(minute or minute2 or 0)
+        if hour > 23 or minute > 59:
+            #"щодня о 25:00"
+            return None
+        start = now.replace(hour=hour, minute=minute, second=0)
+    try:
+        first = _rule(rule, start).after(now)
+    except (ValueError, TypeError):
+        return None
+    return (rule, first) if first else None
+
+
+def next_occurrence(rule: str, current: datetime, now: datetime) -> datetime | None:
+    # the first occurrence after both the current one and now, missed occurrences are skipped;
+    # None once the rule has ended (UNTIL)
+    return _rule(rule, current).after(max(current, now))
+
+
+def occurrences_between(rule: str, current: datetime, start: datetime, end: datetime, limit: int) -> list[datetime]:
+    # occurrences in [start, end) counting from the current one, at most limit of them
+    occurrences = []
+    for occurrence in _rule(rule, current).xafter(max(current, start), count=limit, inc=True):
+        if occurrence >= end:
+            break
+        occurrences.append(occurrence)
+    return occurrences
+
+
+#user timezones are IANA names; None is the server's local time, which is what every
+#deadline meant before timezones existed. Times are passed around as naive wall-clock
+#datetimes of the user plus unix time for storage and comparisons.
+
+@lru_cache(maxsize=None)
+def get_zone(name: str | None):
+    if name is None:
+        return None
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(name)
+
+
+@lru_cache(maxsize=1)
+def _zone_names() -> dict:
+    # "europe/kyiv" and "kyiv" -> "Europe/Kyiv"
+    from zoneinfo import available_timezones
+    names = {}
+    for name in sorted(available_timezones()):
+        names.setdefault(name.rsplit("/", 1)[-1].lower(), name)
+        names[name.lower()] = name
+    return names
+
+
+def parse_timezone(text: str) -> str | None:
+    key = normalize(text)
+    if key in TIMEZONE_ALIASES:
+        return TIMEZONE_ALIASES[key]
+    match = UTC_OFFSET_RE.match(key)
+    if match:
+        sign, hours = match.groups()
+        if int(hours) > 14:
+            return None
+        if int(hours) == 0:
+            return "UTC"
+        #the Etc zones have the sign inverted: UTC+3 is Etc/GMT-3
+        return f"Etc/GMT{'-' if sign == '+' else '+'}{int(hours)}"
+    return _zone_names().get(key.replace(" ", "_"))
+
+
+def to_epoch(moment: datetime, tz: str | None) -> int:
+    # naive wall-clock time in tz -> unix time
+    zone = get_zone(tz)
+    return int((moment.replace(tzinfo=zone) if zone else moment).timestamp())
+
+
+def from_epoch(timestamp: float, tz: str | None) -> datetime:
+    # unix time -> naive wall-clock time in tz
+    zone = get_zone(tz)
+    if zone is None:
+        return datetime.fromtimestamp(timestamp)
+    return datetime.fromtimestamp(timestamp, zone).replace(tzinfo=None)
+
+
+def local_now(tz: str | None) -> datetime:
+    zone = get_zone(tz)
+    return datetime.now(zone).replace(tzinfo=None) if zone else datetime.now()
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, BaseUpdateProcessor, ContextTypes
+
+from metrics import UPDATES_SHED, UPDATE_WAIT_SECONDS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+#updates a second one user may send, with short bursts (ticking several tasks in selection mode); 0 - no limit
+USER_RATE = float(os.getenv("FLOOD_USER_RATE", "2"))
+USER_BURST = int(os.getenv("FLOOD_USER_BURST", "10"))
+#updates handled at the same time; one user's updates always run one after another
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+#beyond this many waiting updates new ones are dropped, waiting longer than MAX_UPDATE_DELAY too
+MAX_WAITING_UPDATES = int(os.getenv("MAX_WAITING_UPDATES", "1000"))
+MAX_UPDATE_DELAY = 10
+#a flooding client fills its own queue, not the shared one
+USER_QUEUE_LIMIT = 10
+#at most one "too many requests" message per user this often, the notices must not become a flood
+NOTICE_INTERVAL = 10
+#buckets of users idle this long are full again and can be forgotten
+USER_IDLE_SECONDS = 60
+
+NOTICES = {
+    "user_rate": "⏳ Забагато запитів. Зачекай кілька секунд і спробуй ще раз.",
+    "user_queue": "⏳ Забагато запитів. Зачекай кілька секунд і спробуй ще раз.",
+    "overload": "⏳ Бот зараз перевантажений, спробуй ще раз за хвилину.",
+    "stale": "⏳ Бот зараз перевантажений, спробуй ще раз за хвилину.",
+}
+
+
+class FloodGuard:
+    # per-user token buckets, checked by limit_update in handler group -1 before any
+    # other handler: an update over the limit stops there with ApplicationHandlerStop
+    # and never gets to parse_date or the database
+    def __init__(self, rate: float = USER_RATE, burst: int = USER_BURST):
+        self._rate = rate
+        self._burst = burst
+        self._buckets = {}
+        self._noticed = {}
+        self._prune_at = 1000
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self._prune_at:
+                self._prune()
+            bucket = self._buckets[user_id] = TokenBucket(self._rate, self._burst)
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items()
+            if now - bucket.updated < USER_IDLE_SECONDS
+        }
+        self._noticed = {
+            user_id: noticed_at for user_id, noticed_at in self._noticed.items()
+            if now - noticed_at < NOTICE_INTERVAL
+        }
+        self._prune_at = max(1000, len(self._buckets) * 2)
+
+    async def limit_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if not self._rate or user is None or self._bucket(user.id).take():
+            return
+        await self.shed(update, "user_rate")
+        raise ApplicationHandlerStop
+
+    async def shed(self, update: object, reason: str) -> None:
+        # counts a dropped update and tells the user, unless they were told a moment ago
+        UPDATES_SHED.inc(reason=reason)
+        if not isinstance(update, Update) or update.effective_user is None:
+            return
+        user_id = update.effective_user.id
+        now = time.monotonic()
+        if now - self._noticed.get(user_id, -NOTICE_INTERVAL) < NOTICE_INTERVAL:
+            return
+        self._noticed[user_id] = now
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(NOTICES[reason])
+            elif update.message:
+                await update.message.reply_text(NOTICES[reason])
+        except TelegramError as e:
+            logger.warning(f"Не вдалося надіслати попередження про перевантаження {user_id}: {e}")
+
+
+class SheddingUpdateProcessor(BaseUpdateProcessor):
+    # concurrent update processing with bounded waiting. Updates of one user run one at a time
+    # and in order (dialogs, selection mode); at most `running` run at once. What cannot be
+    # served in time is dropped with a notice instead of making everybody wait: a user who
+    # already has USER_QUEUE_LIMIT updates waiting, anything beyond `waiting` updates overall,
+    # and updates that waited longer than MAX_UPDATE_DELAY.
+    def __init__(self, guard: FloodGuard, running: int = MAX_CONCURRENT_UPDATES,
+                 waiting: int = MAX_WAITING_UPDATES):
+        #admission is decided here; PTB's own semaphore gets room for as many updates again,
+        #so that the ones to be dropped reach do_process_update instead of queueing in front of it
+        super().__init__(2 * (running + waiting))
+        self._guard = guard
+        self._running = asyncio.Semaphore(running)
+        self._max_waiting = waiting
+        self._waiting = 0
+        self._active = 0
+        self._user_locks = {}
+        self._user_pending = Counter()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {("running",): self._active, ("waiting",): self._waiting}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        user_id = user.id if user else None
+        reason = None
+        if self._waiting >= self._max_waiting:
+            reason = "overload"
+        elif user_id is not None and self._user_pending[user_id] >= USER_QUEUE_LIMIT:
+            reason = "user_queue"
+        if reason:
+            coroutine.close()
+            await self._guard.shed(update, reason)
+            return
+
+        arrived = time.monotonic()
+        self._waiting += 1
+        if user_id is not None:
+            self._user_pending[user_id] += 1
+            lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        else:
+            lock = nullcontext()
+        waiting = True
+        try:
+            async with lock, self._running:
+                self._waiting -= 1
+                waiting = False
+                waited = time.monotonic() - arrived
+                UPDATE_WAIT_SECONDS.observe(waited)
+                if waited > MAX_UPDATE_DELAY:
+                    coroutine.close()
+                    await self._guard.shed(update, "stale")
+                    return
+                self._active += 1
+                try:
+                    await coroutine
+                finally:
+                    self._active -= 1
+        finally:
+            if waiting:
+                #cancelled while waiting
+                self._waiting -= 1
+                coroutine.close()
+            if user_id is not None:
+                self._user_pending[user_id] -= 1
+                if not self._user_pending[user_id]:
+                    del self._user_pending[user_id], self._user_locks[user_id]
@@ -1,18 +1,30 @@
+from time import perf_counter
+#taken before the imports below so the startup breakdown can include them
+STARTED_AT = perf_counter()
+
+import asyncio
+import html
 import logging
 import os
+import signal
+import tempfile
+import threading
+from contextlib import contextmanager
 from http.client import responses
-import dateparser
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from datetime import time
+from itertools import groupby
+from operator import itemgetter
 
 
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
+    TypeHandler,
     ContextTypes,
     #for dialog
     ConversationHandler,
@@ -21,17 +33,75 @@ from telegram.ext import (
     CallbackQueryHandler
     )
 
-from database import init_db, add_task, get_tasks, mark_task_done, delete_task_db, get_single_task, update_task_text, update_task_deadline, get_all_pending_tasks_with_deadline, set_reminder_sent, get_all_users_with_tasks, get_tasks_for_today
+from repository import STORAGE_BACKEND, Repository, create_repository
+from tasks_model import HIGHLIGHT_START, HIGHLIGHT_END
+from dates import from_epoch, local_now, parse_date, parse_recurrence, parse_timezone, to_epoch, warm_up
+import metrics
+from metrics import InstrumentedRequest, JOB_SECONDS, JOB_BATCH_SIZE, REMINDERS
+from metrics import ARCHIVED_TASKS, VACUUM_PAGES
+from scheduler import ReminderScheduler
+from outbox import Outbox
+from ratelimit import TelegramRateLimiter
+from floodguard import FloodGuard, SheddingUpdateProcessor
+from webhook import WebhookServer
+from sharding import ShardSet, Supervisor
+from persistence import RepositoryPersistence
+from tasks_io import MAX_IMPORT_TASKS, parse_import, resolve_deadlines, write_csv
+
+IMPORTS_DONE_AT = perf_counter()
 
 load_dotenv()
 TOKEN = os.getenv("TG_TOKEN")
+WARMUP_PARSER = os.getenv("WARMUP_PARSER", "1") == "1"
+#keep unfinished dialogs and user_data in the database across restarts
+PERSIST_DIALOGS = os.getenv("PERSIST_DIALOGS", "1") == "1"
+#polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+#public https url telegram posts to; without it setWebhook is skipped (local testing)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+#required in webhook mode, the listener is public and anything else could post fake updates
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+#more than 1: a supervisor process plus this many workers, users split by user_id % SHARDS
+SHARDS = int(os.getenv("SHARDS", "1"))
+#prometheus metrics: an http port (0 = off) and/or a file rewritten every METRICS_DUMP_INTERVAL
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+#local only by default, the metrics show handler timings and queue depths
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_FILE = os.getenv("METRICS_FILE")
+#done tasks older than this many days move to tasks_archive every night (0 = never)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+#Bot API calls per second for the whole bot (split between shard workers), 0 = no rate limiter
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", "30"))
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+logging.getLogger().addHandler(metrics.ErrorLogCounter())
+
+REMINDER_BATCH_SIZE = 500
+REMINDER_LEASE = 120
+#sent and dropped outbox rows are kept this long, their keys still deduplicate
+OUTBOX_KEEP_DAYS = 2
+#local time of every user; the job runs every DIGEST_INTERVAL seconds (all utc offsets are
+#multiples of 15 minutes) and sends to the timezones where DIGEST_TIME falls into the run
+DIGEST_TIME = time(hour=7, minute=0)
+DIGEST_INTERVAL = 15 * 60
+ARCHIVE_TIME = time(hour=3, minute=30)
+TASKS_PAGE_SIZE = 8
+SEARCH_PAGE_SIZE = 8
+#ids per /done, /delete command (ranges included)
+MAX_BULK_TASKS = 500
+MAX_IMPORT_FILE_SIZE = 5 * 1024 * 1024
+CACHE_STATS_INTERVAL = 600
+METRICS_DUMP_INTERVAL = 60
+TELEGRAM_POOL_SIZE = 256
 
 GET_TASK_TEXT, GET_DEADLINE, GET_REMINDER = range(3)
 EDIT_MENU, EDIT_GET_TEXT, EDIT_GET_DEADLINE = range(2, 5)
+IMPORT_FILE = 5
 
 MAIN_KEYBOARD_LAYOUT = [
     ["Нове завдання 📝"],
@@ -42,10 +112,45 @@ MAIN_KEYBOARD_MARKUP = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
+EMPTY_VIEW_TEXT = {
+    "list": "🎉 Чудова робота! У вас немає активних завдань.",
+    "up": "🎉 Немає завдань з дедлайном.",
+}
+
+startup_timings = {"imports": IMPORTS_DONE_AT - STARTED_AT}
+
+@contextmanager
+def startup_phase(name: str):
+    start = perf_counter()
+    yield
+    startup_timings[name] = perf_counter() - start
+
+async def record_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #runs in the last handler group, i.e. after the update was served
+    if "first_update" in startup_timings:
+        return
+    startup_timings["first_update"] = perf_counter() - STARTED_AT
+    breakdown = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in startup_timings.items())
+    logger.info(f"Час запуску: {breakdown}")
+
+async def start_parser_warmup(context: ContextTypes.DEFAULT_TYPE) -> None:
+    threading.Thread(target=warm_up, name="dateparser-warmup", daemon=True).start()
+
 #Logic bot
 
-def parse_date(date_string):
-    return dateparser.parse(date_string, settings={'PREFER_DATES_FROM': 'future'})
+def get_repo(context: ContextTypes.DEFAULT_TYPE) -> Repository:
+    return context.application.bot_data["repo"]
+
+def get_reminder_scheduler(context: ContextTypes.DEFAULT_TYPE) -> ReminderScheduler:
+    return context.application.bot_data["reminder_scheduler"]
+
+def get_outbox(context: ContextTypes.DEFAULT_TYPE) -> Outbox:
+    return context.application.bot_data["outbox"]
+
+def get_shard_key(context: ContextTypes.DEFAULT_TYPE) -> tuple | None:
+    #None when not sharded: the jobs then cover every user
+    shard_set = context.application.bot_data.get("shard_set")
+    return shard_set.key if shard_set else None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -80,9 +185,19 @@ async def receive_task_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def receive_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_input = update.message.text
-
-    parsed_date = parse_date(user_input)
-    if not parsed_date or parsed_date < datetime.now():
+    #"завтра о 15:00" is the user's own clock
+    now = local_now(await get_repo(context).get_user_timezone(update.effective_user.id))
+
+    #"щопонеділка о 9:00": one task, the deadline is its next occurrence
+    recurrence = parse_recurrence(user_input, now)
+    if recurrence:
+        rrule, parsed_date = recurrence
+        context.user_data['current_rrule'] = rrule
+        context.user_data['current_recurrence'] = user_input
+    else:
+        parsed_date = parse_date(user_input, now)
+        context.user_data.pop('current_rrule', None)
+    if not parsed_date or parsed_date < now:
         await update.message.reply_text("❌ Некоректна дата або дата в минулому.")
         return GET_DEADLINE
 
@@ -96,8 +211,9 @@ async def receive_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         ["Без нагадування"]
     ]
 
+    recurrence_info = "🔁 Повторюване завдання, перше — " if recurrence else "Дедлайн розпізнано: "
     await update.message.reply_text(
-        f"✅ Дедлайн розпізнано: {formatted_date}\n\n"
+        f"✅ {recurrence_info}{formatted_date}\n\n"
         "<b>За скільки часу до кінця надіслати нагадування?</b>",
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, resize_keyboard=True
@@ -111,7 +227,7 @@ async def receive_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def skip_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     task_text = context.user_data["current_task_text"]
-    add_task(user.id, task_text, None, 0)
+    await get_repo(context).add_task(user.id, task_text, None, 0)
 
     await update.message.reply_text(
         f"✅ Завдання додано:\n<b>{task_text}</b> (без дедлайну)",
@@ -125,37 +241,47 @@ async def receive_reminder_offset(update: Update, context: ContextTypes.DEFAULT_
     text = update.message.text
     user = update.effective_user
 
-    offest_minutes = 30
-
     if text == "За 15 хв":
-        offset_minutes = 15
+        offsets = [15]
     elif text == "За 1 год":
-        offset_minutes = 60
+        offsets = [60]
     elif text == "За 3 год":
-        offset_minutes = 180
+        offsets = [180]
     elif text == "За 1 день":
-        offset_minutes = 1440
+        offsets = [1440]
     elif text == "Без нагадування":
-        offset_minutes = 0
+        offsets = []
     else:
-
+        #several reminders: "1440, 60"
         try:
-            offset_minutes = int(text)
+            offsets = [int(part) for part in text.replace(",", " ").split()]
         except ValueError:
-            await update.message.reply_text("Будь ласка, оберіть варіант з кнопок або введіть число хвилин.")
+            offsets = None
+        if not offsets or min(offsets) < 0:
+            await update.message.reply_text(
+                "Будь ласка, оберіть варіант з кнопок або введіть число хвилин "
+                "(можна кілька через кому, наприклад '1440, 60')."
+            )
             return GET_REMINDER
 
     task_text = context.user_data["current_task_text"]
     deadline = context.user_data["current_deadline"]
 
-    add_task(user.id, task_text, deadline, offset_minutes)
+    rrule = context.user_data.get("current_rrule")
 
-    reminder_info = "Без нагадування" if offset_minutes == 0 else f"За {offset_minutes} хв"
+    task_id = await get_repo(context).add_task(user.id, task_text, deadline, offsets, rrule)
+    if task_id:
+        await get_reminder_scheduler(context).sync_task(task_id)
+
+    offsets = sorted(set(offset for offset in offsets if offset > 0), reverse=True)
+    reminder_info = "Без нагадування" if not offsets else ", ".join(f"За {offset} хв" for offset in offsets)
+    recurrence_info = f"🔁 Повторення: {html.escape(context.user_data['current_recurrence'])}\n" if rrule else ""
 
     await update.message.reply_text(
         f"✅ Завдання успішно створено!\n"
         f"📝 <b>{task_text}</b>\n"
         f"⏰ {deadline}\n"
+        f"{recurrence_info}"
         f"🔔 Нагадування: {reminder_info}",
         parse_mode="HTML",
         reply_markup=MAIN_KEYBOARD_MARKUP
@@ -179,7 +305,7 @@ async def edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     task_id = int(task_id_str)
     user_id = query.from_user.id
 
-    task = get_single_task(user_id, task_id)
+    task = await get_repo(context).get_single_task(user_id, task_id)
     if not task:
         await query.message.reply_text("Помилка: це завдання вже не існує.")
         return ConversationHandler.END
@@ -205,9 +331,10 @@ async def edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         ]
     ]
 
+    recurring = " 🔁" if task['rrule'] else ""
     await query.edit_message_text(
         text=f"<b>Редагування завдання:</b>\n{task['task_text']}\n"
-             f"<i>Дедлайн: {task['deadline'] or 'немає'}</i>\n\n"
+             f"<i>Дедлайн: {task['deadline'] or 'немає'}</i>{recurring}\n\n"
              "Що хочете змінити?",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode="HTML"
@@ -231,7 +358,7 @@ async def edit_receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     task_id = context.user_data['edit_task_id']
 
-    success = update_task_text(user.id, task_id, new_text)
+    success = await get_repo(context).update_task_text(user.id, task_id, new_text)
 
     if success:
         await update.message.reply_html(
@@ -253,7 +380,7 @@ async def edit_deadline_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     reply_keyboard = [["Видалити дедлайн"]]
     await query.message.reply_text(
-        "Надішли мені <b>новий дедлайн</b> (наприклад, 'завтра о 10')\n"
+        "Надішли мені <b>новий дедлайн</b> (наприклад, 'завтра о 10' або 'щопонеділка о 9:00')\n"
         "або натисни 'Видалити дедлайн' (чи /cancel).",
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, resize_keyboard=True
@@ -266,75 +393,99 @@ async def edit_deadline_start(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def edit_receive_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     user_input = update.message.text
+    now = local_now(await get_repo(context).get_user_timezone(user.id))
 
-    parsed_date = parse_date(user_input)
+    rrule = None
+    recurrence = parse_recurrence(user_input, now)
+    if recurrence:
+        rrule, parsed_date = recurrence
+    else:
+        parsed_date = parse_date(user_input, now)
 
     if not parsed_date:
         await update.message.reply_text("❌ Незрозуміла дата. Спробуйте ще раз.")
         return EDIT_GET_DEADLINE
 
-    if parsed_date < datetime.now():
+    if parsed_date < now:
         await update.message.reply_text("⏳ Дата в минулому! Спробуйте ще раз.")
         return EDIT_GET_DEADLINE
 
     formatted_date = parsed_date.strftime('%Y-%m-%d %H:%M:%S')
     task_id = context.user_data['edit_task_id']
 
-    update_task_text(user.id, task_id, formatted_date)
+    await get_repo(context).update_task_deadline(user.id, task_id, formatted_date, rrule)
+    await get_reminder_scheduler(context).sync_task(task_id)
 
     await update.message.reply_text(
-        f"✅ Дедлайн оновлено на: {formatted_date}",
+        f"✅ Дедлайн оновлено на: {formatted_date}" + (" 🔁" if rrule else ""),
         reply_markup=MAIN_KEYBOARD_MARKUP
     )
     context.user_data.clear()
     return ConversationHandler.END
 
 
-async def check_deadlines(context: ContextTypes.DEFAULT_TYPE):
-    tasks = get_all_pending_tasks_with_deadline()
-    now = datetime.now()
-
-    for task in tasks:
-        try:
-            deadline_dt = datetime.strptime(task['deadline'], '%Y-%m-%d %H:%M:%S')
-            offset_minutes = task['reminder_offset']
-
-            if offset_minutes == 0:
-                continue
-
-            time_left = deadline_dt - now
-
-            if timedelta(minutes=0) < time_left <= timedelta(minutes=offset_minutes):
-
-                await context.bot.send_message(
-                    chat_id=task['user_id'],
-                    text=f"🔔 <b>НАГАДУВАННЯ!</b>\n"
-                         f"Залишилось менше {offset_minutes} хв до дедлайну!\n\n"
-                         f"📝 <b>{task['task_text']}</b>\n"
-                         f"⏰ Дедлайн: {task['deadline']}",
-                    parse_mode="HTML"
-                )
-                set_reminder_sent(task['id'])
+def format_reminder(reminder, now_ts: int) -> str:
+    if now_ts < reminder['deadline_at']:
+        offset_minutes = (reminder['deadline_at'] - reminder['fire_at']) // 60
+        return (
+            f"🔔 <b>НАГАДУВАННЯ!</b>\n"
+            f"Залишилось менше {offset_minutes} хв до дедлайну!\n\n"
+            f"📝 <b>{reminder['task_text']}</b>\n"
+            f"⏰ Дедлайн: {reminder['deadline']}"
+        )
+    return (
+        f"🔥 <b>ДЕДЛАЙН ПРОСТРОЧЕНО!</b>\n\n"
+        f"Завдання: <b>{reminder['task_text']}</b>\n"
+        f"Мало бути виконано: {reminder['deadline']}"
+    )
 
-            elif time_left < timedelta(minutes=0):
-                await context.bot.send_message(
-                    chat_id=task['user_id'],
-                    text=f"🔥 <b>ДЕДЛАЙН ПРОСТРОЧЕНО!</b>\n\n"
-                         f"Завдання: <b>{task['task_text']}</b>\n"
-                         f"Мало бути виконано: {task['deadline']}",
-                    parse_mode="HTML"
 
-                )
-                set_reminder_sent(task['id'])
+async def check_deadlines(context: ContextTypes.DEFAULT_TYPE):
+    with JOB_SECONDS.time(job="check_deadlines"):
+        await _check_deadlines(context)
+
+async def _check_deadlines(context: ContextTypes.DEFAULT_TYPE):
+    # due reminders become outbox messages, the outbox sends them
+    repo = get_repo(context)
+    scheduler = get_reminder_scheduler(context)
+
+    #recurring tasks left undone move on first, their new reminders may be due right away
+    for task_id in await repo.roll_over_recurring(int(datetime.now().timestamp()), shards=get_shard_key(context)):
+        await scheduler.sync_task(task_id)
+
+    while True:
+        now_ts = int(datetime.now().timestamp())
+        batch = await repo.claim_due_reminders(
+            now_ts, REMINDER_BATCH_SIZE, REMINDER_LEASE, shards=get_shard_key(context)
+        )
+        JOB_BATCH_SIZE.observe(len(batch), job="check_deadlines")
+        if not batch:
+            break
+
+        #a batch claimed again after a crash here finds its keys taken and adds nothing
+        messages = [
+            (f"reminder:{reminder['reminder_id']}", "reminder", reminder['user_id'],
+             format_reminder(reminder, now_ts), "HTML", reminder['fire_at'])
+            for reminder in batch
+        ]
+        queued = await repo.enqueue_messages(messages, [reminder['reminder_id'] for reminder in batch])
+        if queued is None:
+            #the leases run out and the reminders are claimed again
+            for reminder in batch:
+                scheduler.schedule(reminder['reminder_id'], reminder['id'], now_ts + REMINDER_LEASE)
+            break
+        REMINDERS.inc(queued, outcome="queued")
+        get_outbox(context).wake()
 
-        except ValueError:
-            continue
+        if len(batch) < REMINDER_BATCH_SIZE:
+            break
 
 
 async def edit_remove_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     task_id = context.user_data['edit_task_id']
-    update_task_deadline(user.id, task_id, None)
+    await get_repo(context).update_task_deadline(user.id, task_id, None)
+    get_reminder_scheduler(context).discard_task(task_id)
 
     await update.message.reply_text(
         f"✅ Дедлайн для завдання (ID: {task_id}) видалено.",
@@ -347,190 +498,658 @@ async def edit_remove_deadline(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def edit_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    await query.answer("Редагування скасовано.")
 
-    await query.message.reply_text(
-        "Редагування скасовано.",
-        reply_markup=MAIN_KEYBOARD_MARKUP
-    )
+    #the edit menu replaced the list message, put the list back
+    await show_task_page(get_repo(context), query, query.from_user.id, "list")
 
     context.user_data.clear()
     return ConversationHandler.END
 
-async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def page_cursor(view: str, task) -> tuple:
+    return (task['created_at'] if view == "list" else task['deadline_at'], task['id'])
+
+def encode_cursor(view: str, cursor: tuple) -> str:
+    #callback_data is limited to 64 bytes and ":" is our separator
+    value, task_id = cursor
+    if view == "list":
+        value = "".join(ch for ch in value if ch.isdigit())
+    return f"{value}_{task_id}"
+
+def decode_cursor(view: str, raw: str) -> tuple:
+    value, task_id = raw.split("_")
+    if view == "list":
+        value = f"{value[0:4]}-{value[4:6]}-{value[6:8]} {value[8:10]}:{value[10:12]}:{value[12:14]}"
+    else:
+        value = int(value)
+    return value, int(task_id)
+
+async def load_task_page(repo: Repository, user_id: int, view: str, direction: str | None = None,
+                         cursor: tuple | None = None):
+    fetch = repo.get_tasks if view == "list" else repo.get_upcoming_tasks
+
+    if direction == "before":
+        rows = await fetch(user_id, cursor, "before", TASKS_PAGE_SIZE + 1)
+        tasks = list(reversed(rows[:TASKS_PAGE_SIZE]))
+        has_prev = len(rows) > TASKS_PAGE_SIZE
+        has_next = True
+    else:
+        rows = await fetch(user_id, cursor, direction, TASKS_PAGE_SIZE + 1)
+        tasks = rows[:TASKS_PAGE_SIZE]
+        has_next = len(rows) > TASKS_PAGE_SIZE
+        has_prev = bool(cursor and tasks and await fetch(user_id, page_cursor(view, tasks[0]), "before", 1))
+
+    if not tasks and cursor is not None:
+        #everything on this page is gone, fall back to the first page
+        return await load_task_page(repo, user_id, view)
+    return tasks, has_prev, has_next
+
+def render_task_page(view: str, tasks: list, has_prev: bool, has_next: bool, selected: list | None = None):
+    # selected is None for the normal list, otherwise the ids picked in selection mode
+    title = "📋 <b>Ваші активні завдання:</b>" if view == "list" else "⏳ <b>Найближчі дедлайни:</b>"
+    anchor = encode_cursor(view, page_cursor(view, tasks[0]))
+    lines = [title, ""]
+    keyboard = []
+    toggles = []
+
+    for number, task in enumerate(tasks, start=1):
+        lines.append(f"{number}. {html.escape(task['task_text'])} <code>#{task['id']}</code>")
+        if task['deadline']:
+            recurring = " 🔁" if task['rrule'] else ""
+            lines.append(f"    <i>Дедлайн: {task['deadline']}</i>{recurring}")
+        if selected is not None:
+            mark = "☑️" if task['id'] in selected else "⬜"
+            toggles.append(InlineKeyboardButton(
+                f"{mark} {number}", callback_data=f"sel:toggle:{task['id']}:{view}:{anchor}"
+            ))
+            continue
+        keyboard.append([
+            InlineKeyboardButton(f"✅ {number}", callback_data=f"task:done:{task['id']}:{view}:{anchor}"),
+            InlineKeyboardButton(f"✏️ {number}", callback_data=f"task:edit:{task['id']}"),
+            InlineKeyboardButton(f"🗑️ {number}", callback_data=f"task:del:{task['id']}:{view}:{anchor}"),
+        ])
+    keyboard.extend(toggles[i:i + 4] for i in range(0, len(toggles), 4))
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=f"list:{view}:prev:{anchor}"
+        ))
+    if has_next:
+        last = encode_cursor(view, page_cursor(view, tasks[-1]))
+        navigation.append(InlineKeyboardButton(
+            "Далі ➡️", callback_data=f"list:{view}:next:{last}"
+        ))
+    if navigation:
+        keyboard.append(navigation)
+
+    if selected is None:
+        keyboard.append([InlineKeyboardButton("☑️ Вибрати кілька", callback_data=f"sel:start:{view}:{anchor}")])
+    else:
+        #the selection may span pages, the counters show all of it
+        keyboard.append([
+            InlineKeyboardButton(f"✅ Виконати ({len(selected)})", callback_data=f"sel:done:{view}:{anchor}"),
+            InlineKeyboardButton(f"🗑️ Видалити ({len(selected)})", callback_data=f"sel:del:{view}:{anchor}"),
+        ])
+        keyboard.append([InlineKeyboardButton("✖️ Скасувати вибір", callback_data=f"sel:cancel:{view}:{anchor}")])
+
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def show_task_page(repo: Repository, query, user_id: int, view: str, direction: str | None = None,
+                         cursor: tuple | None = None, selected: list | None = None):
+    tasks, has_prev, has_next = await load_task_page(repo, user_id, view, direction, cursor)
+    if not tasks:
+        await query.edit_message_text(EMPTY_VIEW_TEXT[view])
+        return
+    text, keyboard = render_task_page(view, tasks, has_prev, has_next, selected)
+    try:
+        await query.edit_message_text(text=text, reply_markup=keyboard, parse_mode="HTML")
+    except BadRequest as e:
+        #"message is not modified" when the page did not change
+        if "not modified" not in str(e):
+            raise
+
+async def send_task_view(repo: Repository, update: Update, view: str) -> None:
     user = update.effective_user
-    tasks = get_tasks(user.id)
+    tasks, has_prev, has_next = await load_task_page(repo, user.id, view)
 
     if not tasks:
         await update.message.reply_text(
-            "🎉 Чудова робота! У вас немає активних завдань.",
+            EMPTY_VIEW_TEXT[view],
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
         return
 
-    await update.message.reply_text(
-        "Ось ваші активні завдання:",
-        reply_markup=MAIN_KEYBOARD_MARKUP
-    )
+    text, keyboard = render_task_page(view, tasks, has_prev, has_next)
+    await update.message.reply_html(text, reply_markup=keyboard)
 
-    for task in tasks:
-        task_id = task['id']
-        task_text = task['task_text']
-        deadline = task['deadline']
+async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #a fresh list always starts outside selection mode
+    context.user_data.pop("selected", None)
+    await send_task_view(get_repo(context), update, "list")
 
-        message_text = f"<b>Завдання ID {task_id}:</b>\n{task_text}"
-        if deadline:
-            message_text += f"\n<i>Дедлайн: {deadline}</i>"
+async def upcoming_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data.pop("selected", None)
+    await send_task_view(get_repo(context), update, "up")
 
-        keyboard_buttons = [
-            InlineKeyboardButton(
-                "✅ Виконати",
-                callback_data=f"task:done:{task_id}"
-            ),
-            InlineKeyboardButton(
-                "✏️ Редагувати",
-                callback_data=f"task:edit:{task_id}"
-            ),
-            InlineKeyboardButton(
-                "🗑️ Видалити",
-                callback_data=f"task:del:{task_id}"
-            ),
-        ]
-        keyboard = InlineKeyboardMarkup([keyboard_buttons])
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text(
+        "📥 Надішли файл із завданнями: CSV, JSON або TXT.\n"
+        "У TXT — одне завдання на рядок, дедлайн після ' | ', "
+        "наприклад 'Купити хліб | завтра о 10:00'.\n"
+        "(або /cancel для скасування)"
+    )
+    return IMPORT_FILE
 
-        await update.message.reply_html(
-            message_text,
-            reply_markup=keyboard
+async def import_receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.effective_user
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await update.message.reply_text("❌ Файл завеликий (максимум 5 МБ).")
+        return IMPORT_FILE
+
+    telegram_file = await document.get_file()
+    content = bytes(await telegram_file.download_as_bytearray())
+    try:
+        rows = await asyncio.to_thread(parse_import, document.file_name, content)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Не вдалося прочитати файл: {e}")
+        return IMPORT_FILE
+    if not rows:
+        await update.message.reply_text("❌ У файлі не знайдено жодного завдання.")
+        return IMPORT_FILE
+    if len(rows) > MAX_IMPORT_TASKS:
+        await update.message.reply_text(f"❌ Забагато завдань: {len(rows)} (максимум {MAX_IMPORT_TASKS}).")
+        return IMPORT_FILE
+
+    #dateparser may be hit for unusual deadlines, keep it off the event loop
+    now = local_now(await get_repo(context).get_user_timezone(user.id))
+    tasks, unparsed = await asyncio.to_thread(resolve_deadlines, rows, now)
+    imported = await get_repo(context).import_tasks(user.id, tasks)
+    if not imported:
+        await update.message.reply_text(
+            "❌ Не вдалося зберегти завдання, спробуй пізніше.",
+            reply_markup=MAIN_KEYBOARD_MARKUP
         )
+        return ConversationHandler.END
+    await get_reminder_scheduler(context).refill()
 
-async def task_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    _, action, task_id_str = data.split(":")
-    task_id = int(task_id_str)
-    user_id = query.from_user.id
-    original_text = query.message.text.split('\n', 1)[-1]
+    message_text = f"✅ Імпортовано завдань: {imported}."
+    if unparsed:
+        message_text += f"\n⚠️ Не розпізнано дедлайнів: {unparsed} — їх текст залишено в назві завдання."
+    await update.message.reply_text(message_text, reply_markup=MAIN_KEYBOARD_MARKUP)
+    return ConversationHandler.END
 
-    if action == "done":
-        rows_affected = mark_task_done(user_id, task_id)
-        if rows_affected > 0:
-            await query.edit_message_text(
-                text=f"✅ <b>Виконано:</b>\n<s>{original_text}</s>",
-                parse_mode="HTML"
-            )
-        else:
-            await query.answer("Помилка: завдання не знайдено.")
-
-    elif action == "del":
-        rows_affected = delete_task_db(user_id, task_id)
-        if rows_affected > 0:
-            await query.edit_message_text(
-                text=f"🗑️ <b>Видалено:</b>\n<s>{original_text}</s>",
-                parse_mode="HTML"
-            )
-        else:
-            await query.answer("Помилка: завдання не знайдено.")
+async def import_expect_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("Чекаю на файл 📎 (або /cancel для скасування).")
+    return IMPORT_FILE
 
-async def done_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def export_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    if not context.args:
+    fd, path = tempfile.mkstemp(prefix="tasks_", suffix=".csv")
+    os.close(fd)
+    try:
+        #rows go from the cursor straight into the file, the list is never built in memory
+        count = await asyncio.to_thread(write_csv, path, get_repo(context).iter_user_tasks(user.id))
+        if not count:
+            await update.message.reply_text("У тебе ще немає завдань для експорту.")
+            return
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"tasks_{datetime.now():%Y-%m-%d}.csv",
+                caption=f"📤 Експортовано завдань: {count}"
+            )
+    except Exception as e:
+        logger.error(f"Помилка при експорті завдань юзера {user.id}: {e}")
+        await update.message.reply_text("❌ Не вдалося експортувати завдання.")
+    finally:
+        os.remove(path)
+
+def highlight_html(text: str) -> str:
+    #escape first, the markers from highlight() survive it and become tags
+    return html.escape(text).replace(HIGHLIGHT_START, "<b>").replace(HIGHLIGHT_END, "</b>")
+
+async def render_search_page(repo: Repository, user_id: int, search_query: str, page: int):
+    rows = await repo.search_tasks(user_id, search_query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    tasks = rows[:SEARCH_PAGE_SIZE]
+    if not tasks:
+        return None, None
+    lines = [f"🔎 <b>Знайдено за запитом «{html.escape(search_query)}»:</b>", ""]
+    buttons = []
+    for number, task in enumerate(tasks, start=page * SEARCH_PAGE_SIZE + 1):
+        lines.append(f"{number}. {highlight_html(task['highlighted'])} <code>#{task['id']}</code>")
+        if task['deadline']:
+            lines.append(f"    <i>Дедлайн: {task['deadline']}</i>")
+        buttons.append(InlineKeyboardButton(f"✏️ {number}", callback_data=f"task:edit:{task['id']}"))
+
+    #edit buttons four in a row, navigation under them
+    keyboard = [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search:{page - 1}"))
+    if len(rows) > SEARCH_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Далі ➡️", callback_data=f"search:{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def search_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    search_query = " ".join(context.args or []).strip()
+    if not search_query:
         await update.message.reply_text(
-            "Будь ласка, вкажіть ID завдання.\n"
-            "Наприклад: <code>/done 123</code>",
+            "Вкажіть, що шукати.\n"
+            "Наприклад: <code>/search хліб</code>",
             parse_mode="HTML",
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
         return
-    try:
-        task_id = int(context.args[0])
-    except ValueError:
+
+    #the query is kept per user, page buttons only carry the page number
+    context.user_data["search_query"] = search_query
+    text, keyboard = await render_search_page(get_repo(context), update.effective_user.id, search_query, 0)
+    if text is None:
         await update.message.reply_text(
-            "ID завдання має бути числом.",
+            f"Нічого не знайдено за запитом «{search_query}».",
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
         return
+    await update.message.reply_html(text, reply_markup=keyboard)
 
-    rows_affected =mark_task_done(user.id, task_id)
-
-    if rows_affected:
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if not context.args:
+        tz = await get_repo(context).get_user_timezone(user.id)
         await update.message.reply_text(
-            f"✅ Завдання (ID: {task_id}) позначено як виконане!",
+            f"🕒 Часовий пояс: {tz or 'час сервера'} (зараз {local_now(tz):%H:%M}).\n"
+            "Змінити: <code>/timezone Europe/Kyiv</code>, <code>/timezone Київ</code> або <code>/timezone +3</code>",
+            parse_mode="HTML",
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
-    else:
+        return
+
+    tz = parse_timezone(" ".join(context.args))
+    if tz is None:
         await update.message.reply_text(
-            f"❌ Завдання з ID {task_id} не знайдено серед ваших активних завдань.",
+            "❌ Невідомий часовий пояс. Вкажіть місто (Europe/Kyiv, Warsaw) або зсув від UTC (+3).",
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
+        return
+    if not await get_repo(context).set_user_timezone(user.id, tz):
+        await update.message.reply_text("❌ Не вдалося зберегти, спробуй пізніше.", reply_markup=MAIN_KEYBOARD_MARKUP)
+        return
+    await update.message.reply_text(
+        f"✅ Часовий пояс: {tz} (зараз {local_now(tz):%H:%M}).\n"
+        f"Дедлайни показуються за цим часом, ранковий дайджест — о {DIGEST_TIME:%H:%M}.",
+        reply_markup=MAIN_KEYBOARD_MARKUP
+    )
 
+async def search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    search_query = context.user_data.get("search_query")
+    if not search_query:
+        await query.edit_message_text("Пошук застарів, повторіть /search.")
+        return
+    page = int(query.data.split(":")[1])
+    text, keyboard = await render_search_page(get_repo(context), query.from_user.id, search_query, page)
+    if text is None and page > 0:
+        #the tasks of this page were completed meanwhile
+        text, keyboard = await render_search_page(get_repo(context), query.from_user.id, search_query, 0)
+    if text is None:
+        await query.edit_message_text(f"Нічого не знайдено за запитом «{search_query}».")
+        return
+    try:
+        await query.edit_message_text(text=text, reply_markup=keyboard, parse_mode="HTML")
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
 
-async def delete_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
+async def list_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    _, view, action, raw_cursor = query.data.split(":")
+    direction = "after" if action == "next" else "before"
+    await show_task_page(
+        get_repo(context), query, query.from_user.id, view, direction, decode_cursor(view, raw_cursor),
+        context.user_data.get("selected")
+    )
+
+async def selection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # sel:start / sel:toggle:<id> / sel:done / sel:del / sel:cancel, each followed by <view>:<anchor>;
+    # the picked ids live in user_data["selected"] (a list, so it survives json persistence)
+    query = update.callback_query
+    parts = query.data.split(":")
+    action = parts[1]
+    view, raw_cursor = parts[-2], parts[-1]
+    cursor = decode_cursor(view, raw_cursor)
+    user_id = query.from_user.id
+    selected = context.user_data.get("selected")
+
+    if action == "start":
+        selected = context.user_data["selected"] = []
+        await query.answer("Позначте завдання і оберіть дію")
+    elif selected is None:
+        #selection was finished from another message
+        await query.answer()
+    elif action == "toggle":
+        task_id = int(parts[2])
+        if task_id in selected:
+            selected.remove(task_id)
+        else:
+            selected.append(task_id)
+        await query.answer()
+    elif action == "cancel":
+        context.user_data.pop("selected")
+        selected = None
+        await query.answer()
+    elif not selected:
+        await query.answer("Нічого не вибрано")
+    else:
+        if action == "done":
+            changed = await sync_completed_tasks(context, await get_repo(context).mark_tasks_done(user_id, selected))
+            notice = f"✅ Виконано: {len(changed)}"
+        else:
+            changed = await get_repo(context).delete_tasks(user_id, selected)
+            notice = f"🗑️ Видалено: {len(changed)}"
+            scheduler = get_reminder_scheduler(context)
+            for task_id in changed:
+                scheduler.discard_task(task_id)
+        context.user_data.pop("selected")
+        selected = None
+        await query.answer(notice)
+
+    #one edit for the whole batch
+    await show_task_page(get_repo(context), query, user_id, view, "from", cursor, selected)
+
+async def sync_completed_tasks(context: ContextTypes.DEFAULT_TYPE, completed: list[tuple[int, str | None]]) -> list[int]:
+    # completed comes from mark_tasks_done: recurring tasks got reminders for their next
+    # occurrence, the others have none left. -> the task ids
+    scheduler = get_reminder_scheduler(context)
+    for task_id, next_deadline in completed:
+        if next_deadline is None:
+            scheduler.discard_task(task_id)
+        else:
+            await scheduler.sync_task(task_id)
+    return [task_id for task_id, _ in completed]
+
+async def task_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    parts = query.data.split(":")
+    action = parts[1]
+    task_id = int(parts[2])
+    user_id = query.from_user.id
+    #buttons from older list messages carry no page, they re-render the first one
+    view, cursor = "list", None
+    if len(parts) == 5:
+        view, cursor = parts[3], decode_cursor(parts[3], parts[4])
 
+    if action == "done":
+        completed = await get_repo(context).mark_tasks_done(user_id, [task_id])
+        rows_affected = len(await sync_completed_tasks(context, completed))
+        next_deadline = completed[0][1] if completed else None
+        notice = f"🔁 Наступне: {next_deadline[:16]}" if next_deadline else "✅ Виконано"
+    else:
+        rows_affected = await get_repo(context).delete_task_db(user_id, task_id)
+        get_reminder_scheduler(context).discard_task(task_id)
+        notice = "🗑️ Видалено"
+
+    if rows_affected > 0:
+        await query.answer(notice)
+    else:
+        await query.answer("Помилка: завдання не знайдено.")
+
+    await show_task_page(get_repo(context), query, user_id, view, "from", cursor)
+
+def parse_task_ids(args: list[str]) -> list[int]:
+    # "1 2 5-9" (commas work too) -> [1, 2, 5, 6, 7, 8, 9]; ValueError for anything else
+    task_ids = []
+    for part in " ".join(args).replace(",", " ").split():
+        first, dash, last = part.partition("-")
+        if dash:
+            first, last = int(first), int(last)
+            if last < first or last - first >= MAX_BULK_TASKS:
+                raise ValueError(part)
+            task_ids.extend(range(first, last + 1))
+        else:
+            task_ids.append(int(part))
+    if len(task_ids) > MAX_BULK_TASKS:
+        raise ValueError("too many ids")
+    return task_ids
+
+def format_task_ids(task_ids: list[int], limit: int = 20) -> str:
+    shown = ", ".join(str(task_id) for task_id in task_ids[:limit])
+    return shown + (f" … (+{len(task_ids) - limit})" if len(task_ids) > limit else "")
+
+async def apply_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> None:
+    # /done and /delete with one or many ids, one statement for all of them
+    user = update.effective_user
     if not context.args:
         await update.message.reply_text(
-            "Будь ласка, вкажіть ID завдання для видалення.\n"
-            "Наприклад: <code>/delete 123</code>",
+            "Будь ласка, вкажіть ID завдання.\n"
+            f"Наприклад: <code>/{action} 123</code> або <code>/{action} 1 2 5-9</code>",
             parse_mode="HTML",
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
         return
-
     try:
-        task_id = int(context.args[0])
+        task_ids = parse_task_ids(context.args)
     except ValueError:
         await update.message.reply_text(
-            "ID завдання має бути числом.",
+            f"ID завдань мають бути числами або діапазонами на кшталт 5-9 (до {MAX_BULK_TASKS} за раз).",
             reply_markup=MAIN_KEYBOARD_MARKUP
         )
         return
 
-    rows_affected = delete_task_db(user.id, task_id)
+    repeating = []
+    if action == "done":
+        completed = await get_repo(context).mark_tasks_done(user.id, task_ids)
+        changed = await sync_completed_tasks(context, completed)
+        repeating = [(task_id, next_deadline) for task_id, next_deadline in completed if next_deadline]
+        success, missing = "✅ Позначено як виконані", "❌ Не знайдено серед ваших активних завдань"
+    else:
+        changed = await get_repo(context).delete_tasks(user.id, task_ids)
+        scheduler = get_reminder_scheduler(context)
+        for task_id in changed:
+            scheduler.discard_task(task_id)
+        success, missing = "🗑️ Видалено", "❌ Не знайдено"
+
+    not_found = sorted(set(task_ids) - set(changed))
+    lines = []
+    if changed:
+        lines.append(f"{success}: {len(changed)} (ID: {format_task_ids(changed)})")
+    for task_id, next_deadline in repeating[:5]:
+        lines.append(f"🔁 #{task_id} наступне: {next_deadline[:16]}")
+    if not_found:
+        lines.append(f"{missing}: ID {format_task_ids(not_found)}")
+    await update.message.reply_text("\n".join(lines), reply_markup=MAIN_KEYBOARD_MARKUP)
 
-    if rows_affected > 0:
-        await update.message.reply_text(
-            f"🗑️ Завдання (ID: {task_id}) успішно видалено.",
-            reply_markup=MAIN_KEYBOARD_MARKUP
+async def done_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await apply_task_command(update, context, "done")
+
+async def delete_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await apply_task_command(update, context, "delete")
+
+async def send_morning_digest(context: ContextTypes.DEFAULT_TYPE):
+    with JOB_SECONDS.time(job="send_morning_digest"):
+        await _send_morning_digest(context)
+
+def digest_zones(zones: list[str], run_ts: int) -> list[tuple[str | None, date]]:
+    # (zone, local date) for every zone whose DIGEST_TIME falls into the run starting at run_ts;
+    # None is everybody who never set a timezone (server time)
+    digest_minute = DIGEST_TIME.hour * 60 + DIGEST_TIME.minute
+    due = []
+    for tz in (None, *zones):
+        local = from_epoch(run_ts, tz)
+        if 0 <= local.hour * 60 + local.minute - digest_minute < DIGEST_INTERVAL // 60:
+            due.append((tz, local.date()))
+    return due
+
+async def _send_morning_digest(context: ContextTypes.DEFAULT_TYPE):
+    now_ts = int(datetime.now().timestamp())
+    run_ts = now_ts - now_ts % DIGEST_INTERVAL
+    due = digest_zones(await get_repo(context).get_timezones(), run_ts)
+    if not due:
+        return
+    shards = get_shard_key(context)
+    if shards is not None:
+        #each shard gets every run once, whichever worker owns it at the time
+        count, owned = shards
+        claimed = await get_repo(context).claim_shard_digest(
+            context.application.bot_data["shard_set"].owner, list(owned), str(run_ts)
         )
-    else:
-        await update.message.reply_text(
-            f"❌ Завдання з ID {task_id} не знайдено.",
-            reply_markup=MAIN_KEYBOARD_MARKUP
+        if not claimed:
+            return
+        shards = (count, tuple(claimed))
+    for tz, day in due:
+        await send_zone_digest(context, tz, day, shards)
+
+async def send_zone_digest(context: ContextTypes.DEFAULT_TYPE, tz: str | None, day: date,
+                           shards: tuple | None = None):
+    day_start = datetime.combine(day, time.min)
+    todays_tasks = await get_repo(context).get_tasks_due_between(
+        to_epoch(day_start, tz), to_epoch(day_start + timedelta(days=1), tz), tz, shards=shards
+    )
+
+    def format_digest(user_tasks: list) -> str:
+        message_text = (
+            f"☀️ <b>Доброго ранку! Твій план на сьогодні:</b>\n\n"
         )
 
-async def send_morning_digest(context: ContextTypes.DEFAULT_TYPE):
-    users = get_all_users_with_tasks()
-    for user_id in users:
-        todays_tasks = get_tasks_for_today(user_id)
+        for task in user_tasks:
+            time_str = from_epoch(task['deadline_at'], tz).strftime('%H:%M')
+            message_text += f"▫️ <b>{time_str}</b> — {task['task_text']}\n"
 
-        if todays_tasks:
-            message_text = (
-                f"☀️ <b>Доброго ранку! Твій план на сьогодні:</b>\n\n"
-            )
+        message_text += "\nБажаю продуктивного дня! 🚀"
+        return message_text
 
-            for task in todays_tasks:
-                time_str = task['deadline'].split(' ')[1][:5]
-                message_text += f"▫️ <b>{time_str}</b> — {task['task_text']}\n"
+    #rows are ordered by user_id, so each group is one user's day; one digest per user and day
+    #whatever happens to the shard claims
+    now_ts = int(datetime.now().timestamp())
+    messages = [
+        (f"digest:{user_id}:{day.isoformat()}", "digest", user_id, format_digest(list(user_tasks)), "HTML", now_ts)
+        for user_id, user_tasks in groupby(todays_tasks, key=itemgetter('user_id'))
+    ]
+    JOB_BATCH_SIZE.observe(len(messages), job="send_morning_digest")
+    if messages and await get_repo(context).enqueue_messages(messages) is not None:
+        get_outbox(context).wake()
 
-            message_text += "\nБажаю продуктивного дня! 🚀"
 
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logger.error(f"Не вдалося надіслати дайджест юзеру {user_id}: {e}")
+async def log_cache_stats(context: ContextTypes.DEFAULT_TYPE):
+    stats = get_repo(context).get_cache_stats()
+    logger.info(
+        f"Кеш завдань: users={stats['users']}, hits={stats['hits']}, misses={stats['misses']}, "
+        f"evictions={stats['evictions']}, invalidations={stats['invalidations']}"
+    )
 
 
-def main() -> None:
-    #init db
-    init_db()
-    logger.info("Базу даних ініціалізовано.")
-    #build app
-    application = Application.builder().token(TOKEN).build()
+async def archive_tasks(context: ContextTypes.DEFAULT_TYPE):
+    with JOB_SECONDS.time(job="archive_tasks"):
+        #before the vacuum, so the pages of old outbox rows are returned too
+        purged = await get_repo(context).purge_outbox(OUTBOX_KEEP_DAYS)
+        stats = await get_repo(context).archive_done_tasks(ARCHIVE_AFTER_DAYS)
+    ARCHIVED_TASKS.inc(stats["archived"])
+    VACUUM_PAGES.inc(stats["pages_freed"])
+    logger.info(
+        f"Архівація: перенесено завдань={stats['archived']} ({stats['batches']} пакетів), "
+        f"звільнено сторінок={stats['pages_freed']}, вільних у файлі={stats['pages_left']}, "
+        f"видалено з outbox={purged}"
+    )
+    if not stats["incremental"] and stats["pages_left"]:
+        logger.warning("auto_vacuum не увімкнено для цієї бази: виконайте один раз VACUUM, щоб файл зменшувався")
+
+
+async def dump_metrics(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(metrics.dump, context.job.data)
+
+
+def start_metrics_export(application: Application) -> None:
+    repo = application.bot_data["repo"]
+    metrics.UPDATE_QUEUE.set_function(application.update_queue.qsize)
+    if isinstance(application.update_processor, SheddingUpdateProcessor):
+        metrics.UPDATES_IN_FLIGHT.set_function(application.update_processor.stats)
+    metrics.TASK_CACHE.set_function(lambda: {(stat,): value for stat, value in repo.get_cache_stats().items()})
+    #sharded workers are separate processes: one port / file each
+    shard_set = application.bot_data.get("shard_set")
+    metrics.OUTBOX_DEPTH.set_function(lambda: {
+        (state,): value
+        for state, value in repo.get_outbox_depth(
+            int(datetime.now().timestamp()), shard_set.key if shard_set else None
+        ).items()
+    })
+    if METRICS_PORT:
+        port = METRICS_PORT + (shard_set.home + 1 if shard_set else 0)
+        metrics.serve(METRICS_HOST, port)
+    if METRICS_FILE:
+        path = f"{METRICS_FILE}.{shard_set.owner}" if shard_set else METRICS_FILE
+        application.job_queue.run_repeating(
+            dump_metrics, interval=METRICS_DUMP_INTERVAL, first=METRICS_DUMP_INTERVAL, data=path
+        )
+
+
+async def on_startup(application: Application) -> None:
+    scheduler = ReminderScheduler(application, check_deadlines)
+    application.bot_data["reminder_scheduler"] = scheduler
+    outbox = Outbox(application)
+    application.bot_data["outbox"] = outbox
+    #messages left over from the last run go out first
+    outbox.start()
+    await scheduler.start()
+    start_metrics_export(application)
+
+
+async def on_stop(application: Application) -> None:
+    #the bot still works here, after post_shutdown it does not
+    outbox = application.bot_data.get("outbox")
+    if outbox is not None:
+        await outbox.stop()
+
+
+async def on_shutdown(application: Application) -> None:
+    application.bot_data["repo"].close_db()
+
+
+async def on_shards_changed(application: Application, added: frozenset, removed: frozenset) -> None:
+    #a shard that was here before may have been changed by another worker in the meantime
+    if added:
+        application.bot_data["repo"].clear_cache()
+    scheduler = application.bot_data.get("reminder_scheduler")
+    if scheduler is not None:
+        await scheduler.refill()
+    #taken over in the middle of a digest run: send what the previous owner did not
+    if added:
+        application.job_queue.run_once(send_morning_digest, when=0)
+
+
+def build_application(shard_set: ShardSet | None = None, bot: Bot | None = None,
+                      repo: Repository | None = None) -> Application:
+    #sharded workers open their own sqlite pool in their own process
+    repo = repo or create_repository()
+    flood_guard = FloodGuard()
+    builder = (
+        Application.builder()
+        .concurrent_updates(SheddingUpdateProcessor(flood_guard))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    #a ready-made bot is used by benchmarks/load_test.py
+    if bot is not None:
+        builder = builder.bot(bot)
+    else:
+        builder = builder.token(TOKEN).request(InstrumentedRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+        if TELEGRAM_RATE_LIMIT:
+            builder = builder.rate_limiter(TelegramRateLimiter(TELEGRAM_RATE_LIMIT / max(SHARDS, 1)))
+    if PERSIST_DIALOGS:
+        builder = builder.persistence(RepositoryPersistence(repo))
+    if shard_set is not None:
+        #sharded worker: updates come from the supervisor, not from Telegram
+        builder = builder.updater(None)
+    application = builder.build()
+    application.bot_data["repo"] = repo
+    if shard_set is not None:
+        shard_set.on_change = on_shards_changed
+        application.bot_data["shard_set"] = shard_set
 
     new_conv_handler = ConversationHandler(
         entry_points=[
@@ -550,6 +1169,8 @@ def main() -> None:
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="new_task",
+        persistent=PERSIST_DIALOGS,
     )
     edit_conv_handler = ConversationHandler(
         entry_points=[
@@ -585,37 +1206,141 @@ def main() -> None:
             CommandHandler("cancel", cancel),
             CallbackQueryHandler(edit_cancel, pattern=r"^edit:cancel$")
         ],
+        name="edit_task",
+        persistent=PERSIST_DIALOGS,
+    )
+
+    import_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("import", import_start)],
+        states={
+            IMPORT_FILE: [
+                MessageHandler(filters.Document.ALL, import_receive_file),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, import_expect_file),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="import_tasks",
+        persistent=PERSIST_DIALOGS,
     )
 
+    #flood protection runs before every other group and stops updates over the user's limit
+    application.add_handler(TypeHandler(Update, flood_guard.limit_update), group=-1)
     application.add_handler(new_conv_handler)
     application.add_handler(edit_conv_handler)
+    application.add_handler(import_conv_handler)
     #start
     application.add_handler(CommandHandler("start", start))
     #list
     application.add_handler(CommandHandler("list", list_tasks))
     application.add_handler(MessageHandler(filters.Regex("^Список завдань 📋$"), list_tasks))
 
+    application.add_handler(CommandHandler("upcoming", upcoming_tasks))
+    application.add_handler(CommandHandler("export", export_tasks))
+    application.add_handler(CommandHandler("search", search_tasks))
+    application.add_handler(CommandHandler("timezone", set_timezone))
+    application.add_handler(CommandHandler("done", done_task))
+    application.add_handler(CommandHandler("delete", delete_task))
+
     application.add_handler(CallbackQueryHandler(
         task_button_callback,
-        pattern=r"^task:done:\d+$"
+        pattern=r"^task:(done|del):\d+(:(list|up):\d+_\d+)?$"
     ))
     application.add_handler(CallbackQueryHandler(
-        task_button_callback,
-        pattern=r"^task:del:\d+$"
+        list_page_callback,
+        pattern=r"^list:(list|up):(prev|next):\d+_\d+$"
     ))
+    application.add_handler(CallbackQueryHandler(
+        selection_callback,
+        pattern=r"^sel:(start|toggle:\d+|done|del|cancel):(list|up):\d+_\d+$"
+    ))
+    application.add_handler(CallbackQueryHandler(search_page_callback, pattern=r"^search:\d+$"))
 
     application.add_handler(CommandHandler("cancel", cancel))
 
+    application.add_handler(TypeHandler(Update, record_first_update), group=99)
+
     job_queue = application.job_queue
-    job_queue.run_repeating(check_deadlines, interval=60, first=10)
-    job_queue.run_daily(
+    #on the quarter hours, that is when DIGEST_TIME comes in some timezone
+    now_ts = int(datetime.now().timestamp())
+    job_queue.run_repeating(
         send_morning_digest,
-        time=time(hour=7, minute=0),
-        days=(0, 1, 2, 3, 4, 5, 6)
+        interval=DIGEST_INTERVAL,
+        first=DIGEST_INTERVAL - now_ts % DIGEST_INTERVAL
     )
+    job_queue.run_repeating(log_cache_stats, interval=CACHE_STATS_INTERVAL, first=CACHE_STATS_INTERVAL)
+    #the archive is shared by all shards, one worker is enough
+    if ARCHIVE_AFTER_DAYS and (shard_set is None or shard_set.home == 0):
+        job_queue.run_daily(archive_tasks, time=ARCHIVE_TIME)
+    if WARMUP_PARSER:
+        #first job tick comes after polling has started
+        job_queue.run_once(start_parser_warmup, when=0)
+
+    metrics.instrument_handlers(application)
+    return application
+
+
+async def run_webhook(application: Application) -> None:
+    # same lifecycle as run_polling, but updates come from WebhookServer instead of getUpdates
+    server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    application.bot_data["webhook_server"] = server
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            #windows, Ctrl+C still raises KeyboardInterrupt
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"Webhook встановлено: {WEBHOOK_URL}")
+        await application.start()
+        await server.start()
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def main() -> None:
+    if SHARDS > 1 and STORAGE_BACKEND != "sqlite":
+        #workers are separate processes, the sqlite file is what they share
+        raise ValueError(f"SHARDS={SHARDS} працює лише зі STORAGE_BACKEND=sqlite")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise ValueError("BOT_MODE=webhook потребує WEBHOOK_SECRET")
+    repo = create_repository()
+    #init db
+    with startup_phase("init_db"):
+        repo.init_db()
+    logger.info(f"Базу даних ініціалізовано ({STORAGE_BACKEND}).")
+    #build app
+    with startup_phase("handlers"):
+        if SHARDS > 1:
+            #the supervisor only routes updates, the bot itself runs in the workers
+            application = Supervisor(SHARDS, build_application).build_application(TOKEN)
+        else:
+            application = build_application(repo=repo)
 
     print("Бот запускається... Натисніть Ctrl+C для зупинки.")
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
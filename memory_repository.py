@@ -0,0 +1,629 @@
+import itertools
+import math
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from dates import from_epoch, next_occurrence, to_epoch
+from tasks_model import (
+    DEADLINE_FORMAT,
+    HIGHLIGHT_END,
+    HIGHLIGHT_START,
+    SEARCH_WORD_RE,
+    deadline_to_epoch,
+    reminder_offsets,
+    reminder_times,
+    with_occurrences,
+)
+
+CLAIMED_TASK_COLUMNS = ("id", "user_id", "task_text", "deadline", "deadline_at")
+DUE_COLUMNS = ("id", "user_id", "task_text", "deadline", "deadline_at", "rrule")
+OUTBOX_COLUMNS = ("id", "key", "kind", "chat_id", "text", "parse_mode", "due_at", "attempts")
+EMPTY_CACHE_STATS = {"users": 0, "hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+#keys per chunk of a SortedKeys, see there
+CHUNK_SIZE = 1000
+
+
+def _in_shards(user_id: int, shards: tuple | None) -> bool:
+    # same rule as database._shard_filter
+    if shards is None:
+        return True
+    count, owned = shards
+    return user_id % count in owned
+
+def _now_ts() -> int:
+    return int(datetime.now().timestamp())
+
+def _pick(row: dict, columns) -> dict:
+    return {column: row[column] for column in columns}
+
+def _reminder_row(reminder: dict) -> dict:
+    #a leased reminder is due again when its lease runs out
+    return {
+        "id": reminder["id"], "task_id": reminder["task_id"],
+        "fire_at": max(reminder["fire_at"], reminder["claimed_until"] or 0),
+    }
+
+def _discard(index: list, key: tuple):
+    position = bisect_left(index, key)
+    if position < len(index) and index[position] == key:
+        del index[position]
+
+
+class SortedKeys:
+    # sorted (value, id) keys for the indexes over all users, unique thanks to the id. One flat
+    # list would move up to a million entries per insert; here the keys are split into chunks
+    # of about CHUNK_SIZE and an insert or delete only touches one chunk.
+    def __init__(self):
+        self._chunks = []
+        #last key of every chunk, bisected to find the chunk a key belongs in
+        self._maxes = []
+
+    def __len__(self) -> int:
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def add(self, key: tuple):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        i = min(bisect_left(self._maxes, key), len(self._maxes) - 1)
+        chunk = self._chunks[i]
+        insort(chunk, key)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def discard(self, key: tuple):
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return
+        chunk = self._chunks[i]
+        position = bisect_left(chunk, key)
+        if position < len(chunk) and chunk[position] == key:
+            del chunk[position]
+            if chunk:
+                self._maxes[i] = chunk[-1]
+            else:
+                del self._chunks[i], self._maxes[i]
+
+    def irange(self, start: tuple | None = None, stop: tuple | None = None):
+        # keys with start <= key < stop in order; (ts,) sorts before every (ts, id).
+        # works on copies of the chunks, so the index may change while this is consumed
+        i = 0 if start is None else bisect_left(self._maxes, start)
+        for chunk in self._chunks[i:]:
+            for key in chunk[bisect_left(chunk, start) if start is not None else 0:]:
+                if stop is not None and key >= stop:
+                    return
+                yield key
+
+
+class MemoryRepository:
+    # the whole store in dicts, with sorted (value, id) keys standing in for the sqlite indexes:
+    # every query of database.py is a bisect + scan over one of them, not a pass over all rows.
+    # Indexes of one user are plain sorted lists, the ones over all users SortedKeys.
+    # Everything runs on the event loop, so the async methods never await and need no locks;
+    # rows are returned as copies, like sqlite rows. Nothing survives a restart.
+    def __init__(self):
+        self._task_ids = itertools.count(1)
+        self._reminder_ids = itertools.count(1)
+        self._outbox_ids = itertools.count(1)
+        self._tasks = {}
+        self._user_tasks = defaultdict(set)
+        #pending tasks per user: (created_at, id) and (deadline_at, id), the two list views
+        self._by_created = defaultdict(list)
+        self._by_deadline = defaultdict(list)
+        #pending tasks with a deadline, (deadline_at, id): one-off ones for the digest, recurring ones apart
+        self._due = SortedKeys()
+        self._recurring = SortedKeys()
+        #(completed_at, id) of done tasks, for the archive
+        self._done = SortedKeys()
+        self._archive = defaultdict(list)
+        #prefix search: sorted words of each user's pending tasks and the tasks they occur in
+        self._words = defaultdict(list)
+        self._postings = defaultdict(dict)
+        self._reminders = {}
+        self._task_reminders = defaultdict(set)
+        #(fire_at, id) of unsent reminders
+        self._reminder_queue = SortedKeys()
+        self._timezones = {}
+        self._outbox = {}
+        self._outbox_keys = {}
+        #(send_after, id) of waiting messages, (sent_at, id) of finished ones
+        self._outbox_waiting = SortedKeys()
+        self._outbox_finished = SortedKeys()
+        self._user_data = {}
+        self._conversations = defaultdict(dict)
+        #shard -> key of the last digest run claimed for it
+        self._digest_runs = {}
+
+    def init_db(self):
+        pass
+
+    def close_db(self):
+        pass
+
+    def get_cache_stats(self) -> dict:
+        #no cache in front of dicts
+        return dict(EMPTY_CACHE_STATS)
+
+    def clear_cache(self):
+        pass
+
+    #indexes
+
+    def _index(self, task: dict):
+        task_id = task["id"]
+        if task["status"] == "done":
+            self._done.add((task["completed_at"], task_id))
+            return
+        insort(self._by_created[task["user_id"]], (task["created_at"], task_id))
+        if task["deadline_at"] is not None:
+            insort(self._by_deadline[task["user_id"]], (task["deadline_at"], task_id))
+            (self._recurring if task["rrule"] else self._due).add((task["deadline_at"], task_id))
+        words, postings = self._words[task["user_id"]], self._postings[task["user_id"]]
+        for word in set(SEARCH_WORD_RE.findall(task["task_text"].lower())):
+            if word not in postings:
+                postings[word] = set()
+                insort(words, word)
+            postings[word].add(task_id)
+
+    def _unindex(self, task: dict):
+        task_id = task["id"]
+        if task["status"] == "done":
+            self._done.discard((task["completed_at"], task_id))
+            return
+        _discard(self._by_created[task["user_id"]], (task["created_at"], task_id))
+        if task["deadline_at"] is not None:
+            _discard(self._by_deadline[task["user_id"]], (task["deadline_at"], task_id))
+            (self._recurring if task["rrule"] else self._due).discard((task["deadline_at"], task_id))
+        words, postings = self._words[task["user_id"]], self._postings[task["user_id"]]
+        for word in set(SEARCH_WORD_RE.findall(task["task_text"].lower())):
+            postings[word].discard(task_id)
+            if not postings[word]:
+                del postings[word]
+                _discard(words, word)
+
+    def _update_task(self, task: dict, **changes):
+        self._unindex(task)
+        task.update(changes)
+        self._index(task)
+
+    def _insert_task(self, user_id: int, task_text: str, deadline: str | None, deadline_at: int | None,
+                     status: str = "pending", reminder_offset: int = 30, completed_at: int | None = None,
+                     rrule: str | None = None) -> dict:
+        task = {
+            "id": next(self._task_ids),
+            "user_id": user_id,
+            "task_text": task_text,
+            "deadline": deadline,
+            "deadline_at": deadline_at,
+            #CURRENT_TIMESTAMP: utc, second precision
+            "created_at": datetime.now(timezone.utc).strftime(DEADLINE_FORMAT),
+            "status": status,
+            "reminder_sent": 0,
+            "reminder_offset": reminder_offset,
+            "completed_at": completed_at,
+            "rrule": rrule,
+        }
+        self._tasks[task["id"]] = task
+        self._user_tasks[user_id].add(task["id"])
+        self._index(task)
+        return task
+
+    def _delete_task(self, task: dict):
+        self._unindex(task)
+        self._delete_reminders(task["id"])
+        self._task_reminders.pop(task["id"], None)
+        del self._tasks[task["id"]]
+        self._user_tasks[task["user_id"]].discard(task["id"])
+
+    def _owned_task(self, user_id: int, task_id: int) -> dict | None:
+        task = self._tasks.get(task_id)
+        return task if task is not None and task["user_id"] == user_id else None
+
+    #reminders
+
+    def _add_reminder(self, task_id: int, fire_at: int, kind: str):
+        reminder = {
+            "id": next(self._reminder_ids), "task_id": task_id, "fire_at": fire_at, "kind": kind,
+            "sent": 0, "claimed_until": None, "attempts": 0,
+        }
+        self._reminders[reminder["id"]] = reminder
+        self._task_reminders[task_id].add(reminder["id"])
+        self._reminder_queue.add((fire_at, reminder["id"]))
+
+    def _delete_reminder(self, reminder_id: int):
+        reminder = self._reminders.pop(reminder_id)
+        self._task_reminders[reminder["task_id"]].discard(reminder_id)
+        if reminder["sent"] == 0:
+            self._reminder_queue.discard((reminder["fire_at"], reminder_id))
+
+    def _delete_reminders(self, task_id: int, unsent_only: bool = False):
+        for reminder_id in list(self._task_reminders.get(task_id, ())):
+            if not unsent_only or self._reminders[reminder_id]["sent"] == 0:
+                self._delete_reminder(reminder_id)
+
+    def _insert_reminders(self, task_id: int, deadline_at: int | None, offsets: list[int],
+                          rrule: str | None = None, tz: str | None = None):
+        for fire_at, kind in reminder_times(deadline_at, offsets, rrule, tz):
+            self._add_reminder(task_id, fire_at, kind)
+
+    def _task_offsets(self, task: dict) -> list[int]:
+        offsets = [
+            (task["deadline_at"] - self._reminders[reminder_id]["fire_at"]) // 60
+            for reminder_id in self._task_reminders.get(task["id"], ())
+            if self._reminders[reminder_id]["kind"] == "before" and task["deadline_at"] is not None
+        ] or [task["reminder_offset"] or 0]
+        return reminder_offsets(offsets)
+
+    def _due_reminders(self, until_ts: int, shards: tuple | None):
+        # unsent reminders with fire_at <= until_ts of pending tasks, in fire_at order
+        for _, reminder_id in self._reminder_queue.irange(stop=(until_ts + 1,)):
+            reminder = self._reminders[reminder_id]
+            task = self._tasks[reminder["task_id"]]
+            if task["status"] == "pending" and _in_shards(task["user_id"], shards):
+                yield reminder, task
+
+    def _advance_recurring(self, task: dict, now_ts: int, tz: str | None) -> str | None:
+        # see database._advance_recurring
+        current = from_epoch(task["deadline_at"], tz)
+        occurrence = next_occurrence(task["rrule"], current, from_epoch(now_ts, tz))
+        if occurrence is None:
+            return None
+        offsets = self._task_offsets(task)
+        deadline, next_at = occurrence.strftime(DEADLINE_FORMAT), to_epoch(occurrence, tz)
+        self._update_task(task, status="pending", completed_at=None, deadline=deadline, deadline_at=next_at,
+                          reminder_sent=0)
+        self._delete_reminders(task["id"])
+        self._insert_reminders(task["id"], next_at, offsets, task["rrule"], tz)
+        return deadline
+
+    #tasks
+
+    async def add_task(self, user_id: int, task_text: str, deadline: str = None, reminder_offset: int | list[int] = 30,
+                       rrule: str | None = None) -> int | None:
+        offsets = reminder_offsets(reminder_offset)
+        tz = self._timezones.get(user_id)
+        deadline_at = deadline_to_epoch(deadline, tz)
+        rrule = rrule if deadline_at is not None else None
+        task = self._insert_task(
+            user_id, task_text, deadline, deadline_at, reminder_offset=offsets[-1] if offsets else 0, rrule=rrule
+        )
+        self._insert_reminders(task["id"], deadline_at, offsets, rrule, tz)
+        return task["id"]
+
+    def _get_task_page(self, index: list, cursor: tuple | None, direction: str | None, limit: int) -> list:
+        # keyset pagination over a sorted (value, id) list, same directions as database.PAGE_DIRECTIONS
+        if direction == "before" and cursor is not None:
+            end = bisect_left(index, tuple(cursor))
+            keys = index[0 if limit < 0 else max(end - limit, 0):end][::-1]
+        else:
+            if cursor is None or direction is None:
+                start = 0
+            elif direction == "from":
+                start = bisect_left(index, tuple(cursor))
+            else:
+                start = bisect_right(index, tuple(cursor))
+            keys = index[start:] if limit < 0 else index[start:start + limit]
+        return [dict(self._tasks[task_id]) for _, task_id in keys]
+
+    async def get_tasks(self, user_id: int, cursor: tuple | None = None, direction: str | None = "after",
+                        limit: int = -1) -> list:
+        return self._get_task_page(self._by_created.get(user_id, []), cursor, direction, limit)
+
+    async def get_upcoming_tasks(self, user_id: int, cursor: tuple | None = None, direction: str | None = "after",
+                                 limit: int = -1) -> list:
+        return self._get_task_page(self._by_deadline.get(user_id, []), cursor, direction, limit)
+
+    async def get_single_task(self, user_id: int, task_id: int):
+        task = self._owned_task(user_id, task_id)
+        return dict(task) if task is not None else None
+
+    async def mark_tasks_done(self, user_id: int, task_ids: list[int]) -> list[tuple[int, str | None]]:
+        now_ts = _now_ts()
+        completed = []
+        for task_id in sorted(set(task_ids)):
+            task = self._owned_task(user_id, task_id)
+            if task is None or task["status"] != "pending":
+                continue
+            next_deadline = None
+            if task["rrule"]:
+                next_deadline = self._advance_recurring(task, now_ts, self._timezones.get(user_id))
+            if next_deadline is None:
+                self._update_task(task, status="done", completed_at=now_ts)
+                self._delete_reminders(task_id, unsent_only=True)
+            completed.append((task_id, next_deadline))
+        return completed
+
+    async def mark_task_done(self, user_id: int, task_id: int) -> int:
+        return len(await self.mark_tasks_done(user_id, [task_id]))
+
+    async def delete_tasks(self, user_id: int, task_ids: list[int]) -> list[int]:
+        deleted_ids = []
+        for task_id in sorted(set(task_ids)):
+            task = self._owned_task(user_id, task_id)
+            if task is not None:
+                self._delete_task(task)
+                deleted_ids.append(task_id)
+        return deleted_ids
+
+    async def delete_task_db(self, user_id: int, task_id: int) -> int:
+        return len(await self.delete_tasks(user_id, [task_id]))
+
+    async def update_task_text(self, user_id: int, task_id: int, new_text: str) -> bool:
+        task = self._owned_task(user_id, task_id)
+        if task is None:
+            return False
+        self._update_task(task, task_text=new_text)
+        return True
+
+    async def update_task_deadline(self, user_id: int, task_id: int, new_deadline: str | None,
+                                   rrule: str | None = None) -> bool:
+        task = self._owned_task(user_id, task_id)
+        if task is None:
+            return False
+        tz = self._timezones.get(user_id)
+        deadline_at = deadline_to_epoch(new_deadline, tz)
+        rrule = rrule if deadline_at is not None else None
+        offsets = self._task_offsets(task)
+        self._update_task(task, deadline=new_deadline, deadline_at=deadline_at, rrule=rrule, reminder_sent=0)
+        self._delete_reminders(task_id)
+        self._insert_reminders(task_id, deadline_at, offsets, rrule, tz)
+        return True
+
+    async def roll_over_recurring(self, now_ts: int, shards: tuple | None = None) -> list[int]:
+        rolled = []
+        due = [
+            (reminder, task) for reminder, task in self._due_reminders(now_ts, shards)
+            if reminder["kind"] == "rollover"
+        ]
+        for reminder, task in due:
+            if self._advance_recurring(task, now_ts, self._timezones.get(task["user_id"])) is None:
+                self._delete_reminder(reminder["id"])
+            else:
+                rolled.append(task["id"])
+        return rolled
+
+    async def claim_due_reminders(self, now_ts: int, limit: int, lease_seconds: int = 120,
+                                  shards: tuple | None = None) -> list:
+        reminders = []
+        for reminder, task in self._due_reminders(now_ts, shards):
+            if len(reminders) >= limit:
+                break
+            if reminder["kind"] == "rollover" or (reminder["claimed_until"] or 0) > now_ts:
+                continue
+            reminder["claimed_until"] = now_ts + lease_seconds
+            reminder["attempts"] += 1
+            reminders.append({
+                "reminder_id": reminder["id"], "fire_at": reminder["fire_at"], "kind": reminder["kind"],
+                "attempts": reminder["attempts"], **_pick(task, CLAIMED_TASK_COLUMNS),
+            })
+        return reminders
+
+    async def get_upcoming_reminders(self, until_ts: int, shards: tuple | None = None) -> list:
+        return [
+            _reminder_row(reminder) for reminder, _ in self._due_reminders(until_ts, shards)
+        ]
+
+    async def get_task_reminders(self, task_id: int) -> list:
+        reminders = (self._reminders[reminder_id] for reminder_id in self._task_reminders.get(task_id, ()))
+        return [
+            _reminder_row(reminder) for reminder in reminders if reminder["sent"] == 0
+        ]
+
+    async def get_tasks_due_between(self, start_ts: int, end_ts: int, tz: str | None,
+                                    shards: tuple | None = None) -> list:
+        def wanted(task):
+            return self._timezones.get(task["user_id"]) == tz and _in_shards(task["user_id"], shards)
+
+        one_off = (self._tasks[task_id] for _, task_id in self._due.irange((start_ts,), (end_ts,)))
+        tasks = sorted(
+            (_pick(task, DUE_COLUMNS) for task in one_off if wanted(task)),
+            key=lambda task: (task["user_id"], task["deadline_at"])
+        )
+        recurring = (self._tasks[task_id] for _, task_id in self._recurring.irange(stop=(end_ts,)))
+        return with_occurrences(tasks, [_pick(task, DUE_COLUMNS) for task in recurring if wanted(task)],
+                                 start_ts, end_ts, tz)
+
+    async def import_tasks(self, user_id: int, tasks: list[tuple[str, str | None, str]],
+                           reminder_offset: int = 30) -> int:
+        now_ts = _now_ts()
+        tz = self._timezones.get(user_id)
+        for task_text, deadline, status in tasks:
+            deadline_at = deadline_to_epoch(deadline, tz)
+            task = self._insert_task(user_id, task_text, deadline, deadline_at, status, reminder_offset,
+                                     now_ts if status == "done" else None)
+            if (reminder_offset > 0 and status == "pending" and deadline_at is not None
+                    and deadline_at - reminder_offset * 60 > now_ts):
+                self._add_reminder(task["id"], deadline_at - reminder_offset * 60, "before")
+        return len(tasks)
+
+    def iter_user_tasks(self, user_id: int):
+        # a snapshot taken now: the export writes it from another thread
+        columns = ("task_text", "deadline", "status", "created_at")
+        archived = sorted(self._archive.get(user_id, []), key=lambda task: (task["created_at"], task["id"]))
+        tasks = sorted(
+            (self._tasks[task_id] for task_id in self._user_tasks.get(user_id, ())),
+            key=lambda task: (task["status"], task["created_at"], task["id"])
+        )
+        return iter([_pick(task, columns) for task in archived + tasks])
+
+    async def search_tasks(self, user_id: int, text: str, limit: int = -1, offset: int = 0) -> list:
+        # every word is a prefix, like the fts5 query; the rank stands in for bm25:
+        # the bigger the share of the task's words that matched, the better
+        terms = SEARCH_WORD_RE.findall(text.lower())
+        if not terms:
+            return []
+        words, postings = self._words.get(user_id, []), self._postings.get(user_id, {})
+        found = None
+        for term in terms:
+            matches = set()
+            position = bisect_left(words, term)
+            while position < len(words) and words[position].startswith(term):
+                matches |= postings[words[position]]
+                position += 1
+            found = matches if found is None else found & matches
+            if not found:
+                return []
+
+        def highlight(match):
+            word = match.group()
+            if any(word.lower().startswith(term) for term in terms):
+                return f"{HIGHLIGHT_START}{word}{HIGHLIGHT_END}"
+            return word
+
+        tasks = []
+        for task_id in found:
+            task = self._tasks[task_id]
+            task_words = SEARCH_WORD_RE.findall(task["task_text"].lower())
+            matched = sum(1 for word in task_words if any(word.startswith(term) for term in terms))
+            tasks.append((-matched / len(task_words), task_id, {
+                **_pick(task, ("id", "task_text", "deadline")),
+                "highlighted": SEARCH_WORD_RE.sub(highlight, task["task_text"]),
+            }))
+        tasks.sort(key=lambda item: item[:2])
+        tasks = tasks[offset:] if limit < 0 else tasks[offset:offset + limit]
+        return [task for _, _, task in tasks]
+
+    async def archive_done_tasks(self, older_than_days: int, batch_size: int = 1000) -> dict:
+        now_ts = _now_ts()
+        cutoff = now_ts - older_than_days * 86400
+        old = list(self._done.irange(stop=(cutoff,)))
+        for _, task_id in old:
+            task = self._tasks[task_id]
+            self._archive[task["user_id"]].append({
+                **_pick(task, ("id", "user_id", "task_text", "deadline", "deadline_at", "created_at", "completed_at")),
+                "status": "done", "archived_at": now_ts,
+            })
+            self._delete_task(task)
+        #no file, so no pages to give back
+        return {
+            "archived": len(old), "batches": math.ceil(len(old) / batch_size), "pages_freed": 0, "pages_left": 0,
+            "incremental": True,
+        }
+
+    #timezones
+
+    async def get_user_timezone(self, user_id: int) -> str | None:
+        return self._timezones.get(user_id)
+
+    async def set_user_timezone(self, user_id: int, tz: str) -> bool:
+        self._timezones[user_id] = tz
+        #deadline_at is unchanged, so the indexes are too
+        for deadline_at, task_id in self._by_deadline.get(user_id, []):
+            self._tasks[task_id]["deadline"] = from_epoch(deadline_at, tz).strftime(DEADLINE_FORMAT)
+        return True
+
+    async def get_timezones(self) -> list[str]:
+        return list(set(self._timezones.values()))
+
+    async def claim_shard_digest(self, owner: str, shards: list[int], day: str) -> list[int]:
+        #one process owns every shard; like shard_leases.digest_date, each run is claimed once per shard
+        claimed = sorted(shard for shard in set(shards) if self._digest_runs.get(shard) != day)
+        for shard in claimed:
+            self._digest_runs[shard] = day
+        return claimed
+
+    #outbox
+
+    async def enqueue_messages(self, messages: list[tuple], reminder_ids: list[int] = ()) -> int | None:
+        now_ts = _now_ts()
+        added = 0
+        for key, kind, chat_id, text, parse_mode, due_at in messages:
+            if key in self._outbox_keys:
+                continue
+            message = {
+                "id": next(self._outbox_ids), "key": key, "kind": kind, "chat_id": chat_id, "text": text,
+                "parse_mode": parse_mode, "due_at": due_at, "send_after": now_ts, "attempts": 0, "sent": 0,
+                "sent_at": None,
+            }
+            self._outbox[message["id"]] = message
+            self._outbox_keys[key] = message["id"]
+            self._outbox_waiting.add((now_ts, message["id"]))
+            added += 1
+        for reminder_id in reminder_ids:
+            reminder = self._reminders.get(reminder_id)
+            if reminder is not None and reminder["sent"] == 0:
+                self._reminder_queue.discard((reminder["fire_at"], reminder_id))
+                reminder["sent"], reminder["claimed_until"] = 1, None
+        return added
+
+    async def claim_outbox(self, now_ts: int, limit: int, lease_seconds: int = 120,
+                           shards: tuple | None = None) -> list:
+        claimed = []
+        for _, message_id in self._outbox_waiting.irange(stop=(now_ts + 1,)):
+            if len(claimed) >= limit:
+                break
+            if _in_shards(self._outbox[message_id]["chat_id"], shards):
+                claimed.append(self._outbox[message_id])
+        for message in claimed:
+            self._outbox_waiting.discard((message["send_after"], message["id"]))
+            message["send_after"] = now_ts + lease_seconds
+            message["attempts"] += 1
+            self._outbox_waiting.add((message["send_after"], message["id"]))
+        return sorted((_pick(message, OUTBOX_COLUMNS) for message in claimed), key=lambda row: row["due_at"])
+
+    async def finish_outbox(self, message_id: int, sent: int, send_after: int | None = None) -> bool:
+        message = self._outbox.get(message_id)
+        if message is None:
+            return True
+        if message["sent"] == 0:
+            self._outbox_waiting.discard((message["send_after"], message_id))
+        else:
+            self._outbox_finished.discard((message["sent_at"], message_id))
+        message["sent"] = sent
+        message["send_after"] = send_after if send_after is not None else message["send_after"]
+        message["sent_at"] = _now_ts() if sent != 0 else None
+        if sent == 0:
+            self._outbox_waiting.add((message["send_after"], message_id))
+        else:
+            self._outbox_finished.add((message["sent_at"], message_id))
+        return True
+
+    def get_outbox_depth(self, now_ts: int, shards: tuple | None = None) -> dict:
+        # called from the metrics thread, irange reads copies of the index
+        depth = {"due": 0, "scheduled": 0}
+        for send_after, message_id in self._outbox_waiting.irange():
+            message = self._outbox.get(message_id)
+            if message is not None and _in_shards(message["chat_id"], shards):
+                depth["due" if send_after <= now_ts else "scheduled"] += 1
+        return depth
+
+    async def get_next_outbox_send(self, shards: tuple | None = None) -> int | None:
+        for send_after, message_id in self._outbox_waiting.irange():
+            if _in_shards(self._outbox[message_id]["chat_id"], shards):
+                return send_after
+        return None
+
+    async def purge_outbox(self, older_than_days: int) -> int:
+        cutoff = int((datetime.now() - timedelta(days=older_than_days)).timestamp())
+        old = list(self._outbox_finished.irange(stop=(cutoff,)))
+        for key in old:
+            self._outbox_finished.discard(key)
+        for _, message_id in old:
+            del self._outbox_keys[self._outbox.pop(message_id)["key"]]
+        return len(old)
+
+    #dialog state
+
+    async def get_user_data(self, user_id: int) -> str | None:
+        return self._user_data.get(user_id)
+
+    async def get_conversations(self, name: str) -> list:
+        return [{"key": key, "state": state} for key, state in self._conversations.get(name, {}).items()]
+
+    async def save_dialog_state(self, users: list[tuple[int, str | None]],
+                                conversations: list[tuple[str, str, str | None]]) -> bool:
+        for user_id, data in users:
+            if data is None:
+                self._user_data.pop(user_id, None)
+            else:
+                self._user_data[user_id] = data
+        for name, key, state in conversations:
+            if state is None:
+                self._conversations[name].pop(key, None)
+            else:
+                self._conversations[name][key] = state
+        return True
@@ -0,0 +1,258 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+#prometheus text exposition format, no client library needed
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (0, 1, 5, 10, 50, 100, 250, 500, 1000, 5000)
+
+_registry = []
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    # either set() directly or computed on every scrape by set_function()
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        # function() returns a number, or {label values tuple: number} for labelled gauges
+        self._function = function
+
+    def render(self) -> list[str]:
+        if self._function is not None:
+            try:
+                values = self._function()
+            except Exception as e:
+                logger.error(f"Помилка при обчисленні метрики {self.name}: {e}")
+                values = {}
+            with self._lock:
+                self._values = values if isinstance(values, dict) else {(): values}
+        return super().render()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                #per-bucket (not cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+#everything the bot exports; instrumented modules import these directly
+HANDLER_SECONDS = Histogram("todo_bot_handler_seconds", "Handler callback duration", ("handler",))
+HANDLER_ERRORS = Counter("todo_bot_handler_errors_total", "Handler callbacks that raised", ("handler",))
+DB_SECONDS = Histogram("todo_bot_db_seconds", "database.py function duration on the db pool", ("function",))
+DB_WAIT_SECONDS = Histogram("todo_bot_db_wait_seconds", "Time a database call waited for a db pool thread")
+DB_COMMIT_BATCH = Histogram("todo_bot_db_commit_batch_size", "Writes committed together by one group commit", buckets=SIZE_BUCKETS)
+JOB_SECONDS = Histogram("todo_bot_job_seconds", "Background job run duration", ("job",))
+JOB_BATCH_SIZE = Histogram("todo_bot_job_batch_size", "Items handled per job batch", ("job",), SIZE_BUCKETS)
+REMINDERS = Counter("todo_bot_reminders_total", "Reminder send outcomes", ("outcome",))
+REMINDER_LAG = Histogram("todo_bot_reminder_lag_seconds", "Actual send time minus the intended fire time", buckets=LAG_BUCKETS)
+TELEGRAM_SECONDS = Histogram("todo_bot_telegram_seconds", "Bot API request duration", ("method",))
+TELEGRAM_REQUESTS = Counter("todo_bot_telegram_requests_total", "Bot API requests by HTTP status", ("method", "status"))
+TELEGRAM_THROTTLE_SECONDS = Histogram("todo_bot_telegram_throttle_seconds", "Time a Bot API call waited for the rate limiter", ("method",), LAG_BUCKETS)
+TELEGRAM_FLOOD_WAITS = Counter("todo_bot_telegram_flood_waits_total", "RetryAfter (flood control) responses", ("method",))
+OUTBOX_MESSAGES = Counter("todo_bot_outbox_messages_total", "Outbox send outcomes", ("kind", "outcome"))
+OUTBOX_DEPTH = Gauge("todo_bot_outbox_depth", "Messages waiting in the outbox: due now or scheduled for a retry", ("state",))
+PARSE_DATE_SECONDS = Histogram("todo_bot_parse_date_seconds", "parse_date duration", ("path",))
+LOG_ERRORS = Counter("todo_bot_log_errors_total", "ERROR log records", ("logger",))
+UPDATE_QUEUE = Gauge("todo_bot_update_queue", "Updates waiting in application.update_queue")
+UPDATES_IN_FLIGHT = Gauge("todo_bot_updates_in_flight", "Updates admitted by the update processor: running handlers or waiting for a slot", ("state",))
+UPDATES_SHED = Counter("todo_bot_updates_shed_total", "Updates dropped by flood protection or load shedding", ("reason",))
+UPDATE_WAIT_SECONDS = Histogram("todo_bot_update_wait_seconds", "Time an update waited for its user and a processing slot", buckets=LAG_BUCKETS)
+ARCHIVED_TASKS = Counter("todo_bot_archived_tasks_total", "Done tasks moved to tasks_archive")
+VACUUM_PAGES = Counter("todo_bot_vacuum_pages_total", "Database pages returned to the filesystem by incremental vacuum")
+TASK_CACHE = Gauge("todo_bot_task_cache", "Task cache counters", ("stat",))
+
+
+def time_handler(callback):
+    @wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            #ApplicationHandlerStop is control flow, not a failure
+            if type(e).__name__ != "ApplicationHandlerStop":
+                HANDLER_ERRORS.inc(handler=callback.__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=callback.__name__)
+    return wrapper
+
+
+def instrument_handlers(application):
+    # wraps the callback of every registered handler, conversation states included
+    def walk(handlers):
+        for handler in handlers:
+            if hasattr(handler, "entry_points"):
+                walk(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+                walk(handler.fallbacks)
+            elif not getattr(handler.callback, "__wrapped__", None):
+                handler.callback = time_handler(handler.callback)
+
+    for group in application.handlers.values():
+        walk(group)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # counts Bot API calls per method and HTTP status; error statuses (403, 429 ...) are turned
+    # into exceptions later by PTB, so they are seen here as plain status codes
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        status = "network_error"
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - start, method=api_method)
+            TELEGRAM_REQUESTS.inc(method=api_method, status=status)
+
+
+class ErrorLogCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record: logging.LogRecord):
+        LOG_ERRORS.inc(logger=record.name)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    # standalone GET /metrics on a daemon thread (polling mode has no http server of its own)
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Метрики доступні на http://{host}:{port}/metrics")
+    return server
+
+
+def dump(path: str):
+    # atomic write, suitable for node_exporter's textfile collector
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
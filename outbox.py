@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import Application
+
+from metrics import OUTBOX_MESSAGES, REMINDERS, REMINDER_LAG
+from ratelimit import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+#enough concurrent sends to keep the rate limiter's 30/s busy at ~1 s Bot API latency
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "30"))
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_LEASE = 120
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 60 * 60
+MAX_ATTEMPTS = 8
+#due messages nobody woke us for: another worker's enqueue, retries, a restart
+POLL_INTERVAL = 30
+STOP_TIMEOUT = 5
+
+
+class Outbox:
+    # sender for the outbox table. Producers enqueue in the repository (enqueue_messages)
+    # and call wake(); the loop claims due messages with a lease and OUTBOX_SENDERS workers
+    # send them through the bot, so its rate limiter does the pacing. Each message is
+    # marked right after its own send: a crash repeats at most the messages in flight.
+    def __init__(self, application: Application, senders: int = OUTBOX_SENDERS):
+        self.application = application
+        self._repo = application.bot_data["repo"]
+        self._senders = senders
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # stops claiming, the messages already claimed get STOP_TIMEOUT to go out
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Outbox: не всі повідомлення встигли піти, вони повторяться після оренди")
+            self._task = None
+
+    def wake(self):
+        self._idle.clear()
+        self._wake.set()
+
+    async def wait_idle(self):
+        # until everything due has been handled, used by benchmarks/load_test.py
+        await self._idle.wait()
+
+    def _shards(self):
+        shard_set = self.application.bot_data.get("shard_set")
+        return shard_set.key if shard_set else None
+
+    async def _run(self):
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                next_at = await self.deliver()
+            except Exception as e:
+                logger.error(f"Помилка outbox: {e}")
+                next_at = None
+            if not self._wake.is_set():
+                self._idle.set()
+            timeout = POLL_INTERVAL if next_at is None else min(max(next_at - time.time(), 0), POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def deliver(self) -> int | None:
+        # sends everything due now -> when the next waiting message is due, None if there is none
+        queue = asyncio.Queue(maxsize=self._senders)
+        workers = [asyncio.create_task(self._send_worker(queue)) for _ in range(self._senders)]
+        try:
+            while not self._stopping:
+                batch = await self._repo.claim_outbox(int(time.time()), OUTBOX_BATCH_SIZE, OUTBOX_LEASE, shards=self._shards())
+                for message in batch:
+                    await queue.put(message)
+                if len(batch) < OUTBOX_BATCH_SIZE:
+                    break
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return await self._repo.get_next_outbox_send(shards=self._shards())
+
+    async def _send_worker(self, queue: asyncio.Queue):
+        while (message := await queue.get()) is not None:
+            await self._send(message)
+
+    async def _send(self, message):
+        now = time.time()
+        send_after = None
+        try:
+            await self.application.bot.send_message(
+                chat_id=message["chat_id"], text=message["text"], parse_mode=message["parse_mode"]
+            )
+            outcome, sent = "sent", 1
+        except RetryAfter as e:
+            #the rate limiter already waited and retried; flood control is no reason to give up on it
+            outcome, sent = "retry", 0
+            send_after = int(now + retry_after_seconds(e)) + 1
+        except (Forbidden, BadRequest) as e:
+            #blocked bot, deleted chat or a broken message will not get better with retries
+            logger.error(f"Повідомлення {message['key']} відкинуто: {e}")
+            outcome, sent = "dropped", -1
+        except Exception as e:
+            logger.error(f"Не вдалося надіслати {message['key']} (спроба {message['attempts']}): {e}")
+            if message["attempts"] >= MAX_ATTEMPTS:
+                outcome, sent = "dropped", -1
+            else:
+                outcome, sent = "retry", 0
+                send_after = int(now + min(RETRY_DELAY * 2 ** (message["attempts"] - 1), MAX_RETRY_DELAY))
+
+        await self._repo.finish_outbox(message["id"], sent, send_after)
+        OUTBOX_MESSAGES.inc(kind=message["kind"], outcome=outcome)
+        if message["kind"] == "reminder":
+            REMINDERS.inc(outcome=outcome)
+            if sent == 1:
+                REMINDER_LAG.observe(max(time.time() - message["due_at"], 0))
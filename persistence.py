@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from repository import Repository
+
+logger = logging.getLogger(__name__)
+
+#PTB hands over changes every UPDATE_INTERVAL, they reach the repository WRITE_DELAY later in one transaction
+UPDATE_INTERVAL = 2
+WRITE_DELAY = 0.5
+
+
+class RepositoryPersistence(BasePersistence):
+    # user_data as one json row per user, loaded the first time the user shows up
+    # (refresh_user_data) instead of all at startup; conversation states as rows
+    # keyed by (handler name, conversation key). bot_data and chat_data are not stored:
+    # bot_data holds live objects like the reminder scheduler.
+    def __init__(self, repo: Repository, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._repo = repo
+        #last json written or read per user, unchanged user_data is not written again
+        self._stored = {}
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._write_task = None
+        #one save at a time, a later batch must not land before an earlier one
+        self._write_lock = asyncio.Lock()
+        self._writing = None
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # PTB asks for these once per handler at startup, only unfinished dialogs have rows
+        conversations = {}
+        for row in await self._repo.get_conversations(name):
+            conversations[tuple(json.loads(row["key"]))] = json.loads(row["state"])
+        if conversations:
+            logger.info(f"Відновлено {len(conversations)} незавершених діалогів {name}")
+        return conversations
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._stored:
+            return
+        data = await self._repo.get_user_data(user_id)
+        #an update for this user may have been processed while we were reading
+        if user_id in self._stored:
+            return
+        self._stored[user_id] = data
+        if data:
+            user_data.update(json.loads(data))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        try:
+            serialized = json.dumps(data, ensure_ascii=False) if data else None
+        except (TypeError, ValueError) as e:
+            logger.error(f"user_data користувача {user_id} не серіалізується: {e}")
+            return
+        if user_id in self._stored and self._stored[user_id] == serialized:
+            return
+        self._stored[user_id] = serialized
+        self._pending_users[user_id] = serialized
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stored[user_id] = None
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # stops the write-behind loop; a save it already started is shielded from that and
+        # finishes first (re-queueing its batch if it failed), then the rest is written
+        if self._write_task is not None and not self._write_task.done():
+            self._write_task.cancel()
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        await self._write()
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self):
+        #changes arriving during a write are picked up by the next round
+        while self._pending_users or self._pending_conversations:
+            await asyncio.sleep(WRITE_DELAY)
+            self._writing = asyncio.ensure_future(self._write())
+            await asyncio.shield(self._writing)
+
+    async def _write(self):
+        async with self._write_lock:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            if not users and not conversations:
+                return
+            saved = await self._repo.save_dialog_state(
+                list(users.items()),
+                [(name, key, state) for (name, key), state in conversations.items()],
+            )
+            if not saved:
+                #keep the batch for the next round, newer changes win
+                for user_id, data in users.items():
+                    self._pending_users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_FLOOD_WAITS, TELEGRAM_THROTTLE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+#https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+OVERALL_RATE = 30
+#about one message a second per private chat, 20 a minute per group; short bursts are fine
+CHAT_RATE, CHAT_BURST = 1.0, 3
+GROUP_RATE, GROUP_BURST = 20 / 60, 3
+MAX_RETRIES = 3
+#buckets of chats idle this long are full again and can be forgotten
+CHAT_IDLE_SECONDS = 60
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    #int in PTB 22, timedelta once PTB_TIMEDELTA becomes the default
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # takes a token -> seconds to wait before using it; a negative balance is the queue
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self) -> bool:
+        # takes a token only if one is there, for callers that drop instead of waiting
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    # paces every Bot API call that targets a chat: first the chat's bucket, then the
+    # bot-wide one. A RetryAfter (flood control) pauses all calls for the time Telegram asked
+    # and the call is repeated up to max_retries times; rate_limit_args=<int> overrides that
+    # per call. Everything is on one event loop, so the buckets need no locks.
+    def __init__(self, overall_rate: float = OVERALL_RATE, max_retries: int = MAX_RETRIES):
+        self._overall = TokenBucket(overall_rate, overall_rate)
+        self._max_retries = max_retries
+        self._chats = {}
+        self._prune_at = 1000
+        self._paused_until = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._prune_at:
+                self._prune()
+            #channel usernames and negative ids are groups/channels
+            group = isinstance(chat_id, str) or chat_id < 0
+            rate, burst = (GROUP_RATE, GROUP_BURST) if group else (CHAT_RATE, CHAT_BURST)
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        self._chats = {
+            chat_id: bucket for chat_id, bucket in self._chats.items()
+            if now - bucket.updated < CHAT_IDLE_SECONDS
+        }
+        self._prune_at = max(1000, len(self._chats) * 2)
+
+    async def _wait_turn(self, endpoint: str, chat_id):
+        started = time.monotonic()
+        if chat_id is not None:
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+            await asyncio.sleep(self._overall.reserve())
+        #flood control may have started while we were waiting
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+        TELEGRAM_THROTTLE_SECONDS.observe(time.monotonic() - started, method=endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self._max_retries
+        chat_id = data.get("chat_id")
+        for attempt in range(max_retries + 1):
+            await self._wait_turn(endpoint, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                TELEGRAM_FLOOD_WAITS.inc(method=endpoint)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"Flood control Telegram ({endpoint}): пауза {delay:.0f} с, спроба {attempt + 1}")
+                if attempt == max_retries:
+                    raise
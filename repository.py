@@ -0,0 +1,111 @@
+import os
+from typing import Iterator, Protocol
+
+import database
+
+#sqlite: the database file (DB_NAME); memory: nothing leaves the process, for benchmarks and tests
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+
+class Repository(Protocol):
+    # everything the bot stores, one method per operation; rows are mappings with the
+    # column names of database.py. The handlers get an instance from bot_data["repo"].
+    # Shard leases are not part of it: they coordinate processes through the sqlite file;
+    # claim_shard_digest is, so the digest job goes through the repository like the rest.
+    def init_db(self) -> None: ...
+    def close_db(self) -> None: ...
+    def get_cache_stats(self) -> dict: ...
+    def clear_cache(self) -> None: ...
+    #these two run outside the event loop (export thread, metrics scrape)
+    def iter_user_tasks(self, user_id: int) -> Iterator: ...
+    def get_outbox_depth(self, now_ts: int, shards: tuple | None = None) -> dict: ...
+
+    async def add_task(self, user_id: int, task_text: str, deadline: str = None, reminder_offset: int | list[int] = 30,
+                       rrule: str | None = None) -> int | None: ...
+    async def get_tasks(self, user_id: int, cursor: tuple | None = None, direction: str | None = "after",
+                        limit: int = -1) -> list: ...
+    async def get_upcoming_tasks(self, user_id: int, cursor: tuple | None = None, direction: str | None = "after",
+                                 limit: int = -1) -> list: ...
+    async def get_single_task(self, user_id: int, task_id: int): ...
+    async def mark_tasks_done(self, user_id: int, task_ids: list[int]) -> list[tuple[int, str | None]]: ...
+    async def mark_task_done(self, user_id: int, task_id: int) -> int: ...
+    async def delete_tasks(self, user_id: int, task_ids: list[int]) -> list[int]: ...
+    async def delete_task_db(self, user_id: int, task_id: int) -> int: ...
+    async def update_task_text(self, user_id: int, task_id: int, new_text: str) -> bool: ...
+    async def update_task_deadline(self, user_id: int, task_id: int, new_deadline: str | None,
+                                   rrule: str | None = None) -> bool: ...
+    async def roll_over_recurring(self, now_ts: int, shards: tuple | None = None) -> list[int]: ...
+    async def claim_due_reminders(self, now_ts: int, limit: int, lease_seconds: int = 120,
+                                  shards: tuple | None = None) -> list: ...
+    async def get_upcoming_reminders(self, until_ts: int, shards: tuple | None = None) -> list: ...
+    async def get_task_reminders(self, task_id: int) -> list: ...
+    async def get_tasks_due_between(self, start_ts: int, end_ts: int, tz: str | None,
+                                    shards: tuple | None = None) -> list: ...
+    async def import_tasks(self, user_id: int, tasks: list[tuple[str, str | None, str]],
+                           reminder_offset: int = 30) -> int: ...
+    async def search_tasks(self, user_id: int, text: str, limit: int = -1, offset: int = 0) -> list: ...
+    async def archive_done_tasks(self, older_than_days: int) -> dict: ...
+    async def get_user_timezone(self, user_id: int) -> str | None: ...
+    async def set_user_timezone(self, user_id: int, tz: str) -> bool: ...
+    async def get_timezones(self) -> list[str]: ...
+    async def claim_shard_digest(self, owner: str, shards: list[int], day: str) -> list[int]: ...
+    async def enqueue_messages(self, messages: list[tuple], reminder_ids: list[int] = ()) -> int | None: ...
+    async def claim_outbox(self, now_ts: int, limit: int, lease_seconds: int = 120,
+                           shards: tuple | None = None) -> list: ...
+    async def finish_outbox(self, message_id: int, sent: int, send_after: int | None = None) -> bool: ...
+    async def get_next_outbox_send(self, shards: tuple | None = None) -> int | None: ...
+    async def purge_outbox(self, older_than_days: int) -> int: ...
+    async def get_user_data(self, user_id: int) -> str | None: ...
+    async def get_conversations(self, name: str) -> list: ...
+    async def save_dialog_state(self, users: list[tuple[int, str | None]],
+                                conversations: list[tuple[str, str, str | None]]) -> bool: ...
+
+
+class SQLiteRepository:
+    # the functions of database.py; the async ones run on its thread pool
+    init_db = staticmethod(database.init_db)
+    close_db = staticmethod(database.close_db)
+    get_cache_stats = staticmethod(database.get_cache_stats)
+    clear_cache = staticmethod(database.clear_cache)
+    iter_user_tasks = staticmethod(database.iter_user_tasks)
+    get_outbox_depth = staticmethod(database.get_outbox_depth)
+
+    add_task = staticmethod(database.add_task_async)
+    get_tasks = staticmethod(database.get_tasks_async)
+    get_upcoming_tasks = staticmethod(database.get_upcoming_tasks_async)
+    get_single_task = staticmethod(database.get_single_task_async)
+    mark_tasks_done = staticmethod(database.mark_tasks_done_async)
+    mark_task_done = staticmethod(database.mark_task_done_async)
+    delete_tasks = staticmethod(database.delete_tasks_async)
+    delete_task_db = staticmethod(database.delete_task_db_async)
+    update_task_text = staticmethod(database.update_task_text_async)
+    update_task_deadline = staticmethod(database.update_task_deadline_async)
+    roll_over_recurring = staticmethod(database.roll_over_recurring_async)
+    claim_due_reminders = staticmethod(database.claim_due_reminders_async)
+    get_upcoming_reminders = staticmethod(database.get_upcoming_reminders_async)
+    get_task_reminders = staticmethod(database.get_task_reminders_async)
+    get_tasks_due_between = staticmethod(database.get_tasks_due_between_async)
+    import_tasks = staticmethod(database.import_tasks_async)
+    search_tasks = staticmethod(database.search_tasks_async)
+    archive_done_tasks = staticmethod(database.archive_done_tasks_async)
+    get_user_timezone = staticmethod(database.get_user_timezone_async)
+    set_user_timezone = staticmethod(database.set_user_timezone_async)
+    get_timezones = staticmethod(database.get_timezones_async)
+    claim_shard_digest = staticmethod(database.claim_shard_digest_async)
+    enqueue_messages = staticmethod(database.enqueue_messages_async)
+    claim_outbox = staticmethod(database.claim_outbox_async)
+    finish_outbox = staticmethod(database.finish_outbox_async)
+    get_next_outbox_send = staticmethod(database.get_next_outbox_send_async)
+    purge_outbox = staticmethod(database.purge_outbox_async)
+    get_user_data = staticmethod(database.get_user_data_async)
+    get_conversations = staticmethod(database.get_conversations_async)
+    save_dialog_state = staticmethod(database.save_dialog_state_async)
+
+
+def create_repository(backend: str = STORAGE_BACKEND) -> Repository:
+    if backend == "sqlite":
+        return SQLiteRepository()
+    if backend == "memory":
+        from memory_repository import MemoryRepository
+        return MemoryRepository()
+    raise ValueError(f"Невідомий STORAGE_BACKEND: {backend}")
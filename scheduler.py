@@ -0,0 +1,121 @@
+import heapq
+import logging
+import time
+
+from telegram.ext import Application, ContextTypes
+
+logger = logging.getLogger(__name__)
+
+#reminders further away than this are not kept in memory, the refill job loads them later
+LOAD_HORIZON = 2 * 60 * 60
+REFILL_INTERVAL = 60 * 60
+
+
+class ReminderScheduler:
+    # timer heap of upcoming fire times; the repository stays the source of truth,
+    # the heap only decides when the dispatch callback has to run
+    def __init__(self, application: Application, dispatch):
+        self.application = application
+        self._dispatch = dispatch
+        self._heap = []
+        self._live = {}
+        self._job = None
+        self._armed_at = None
+        self._loaded_until = 0
+
+    async def start(self):
+        await self.refill()
+        self.application.job_queue.run_repeating(
+            self._refill_job, interval=REFILL_INTERVAL, first=REFILL_INTERVAL, name="reminders_refill"
+        )
+
+    async def refill(self):
+        self._loaded_until = int(time.time()) + LOAD_HORIZON
+        shard_set = self.application.bot_data.get("shard_set")
+        reminders = await self.application.bot_data["repo"].get_upcoming_reminders(
+            self._loaded_until, shards=shard_set.key if shard_set else None
+        )
+        self._heap = []
+        self._live = {}
+        for reminder in reminders:
+            self._push(reminder["id"], reminder["task_id"], reminder["fire_at"])
+        heapq.heapify(self._heap)
+        logger.info(f"Планувальник нагадувань: завантажено {len(reminders)} нагадувань")
+        self._arm()
+
+    async def sync_task(self, task_id: int):
+        self.discard_task(task_id)
+        for reminder in await self.application.bot_data["repo"].get_task_reminders(task_id):
+            if reminder["fire_at"] <= self._loaded_until:
+                self._push(reminder["id"], task_id, reminder["fire_at"], keep_heap=True)
+        self._arm()
+
+    def schedule(self, reminder_id: int, task_id: int, fire_at: int):
+        if fire_at <= self._loaded_until:
+            self._push(reminder_id, task_id, fire_at, keep_heap=True)
+            self._arm()
+
+    def discard_task(self, task_id: int):
+        #heap entries of discarded tasks are skipped lazily when they reach the top
+        self._live.pop(task_id, None)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._live.values())
+
+    def _push(self, reminder_id: int, task_id: int, fire_at: int, keep_heap: bool = False):
+        self._live.setdefault(task_id, set()).add(reminder_id)
+        entry = (fire_at, reminder_id, task_id)
+        if keep_heap:
+            heapq.heappush(self._heap, entry)
+        else:
+            self._heap.append(entry)
+
+    def _is_live(self, entry) -> bool:
+        _, reminder_id, task_id = entry
+        return reminder_id in self._live.get(task_id, ())
+
+    def _forget(self, entry):
+        _, reminder_id, task_id = entry
+        ids = self._live.get(task_id)
+        if ids is not None:
+            ids.discard(reminder_id)
+            if not ids:
+                del self._live[task_id]
+
+    def _arm(self):
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+
+        next_fire_at = self._heap[0][0] if self._heap else None
+        if next_fire_at == self._armed_at and self._job is not None:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._armed_at = next_fire_at
+        if next_fire_at is None:
+            return
+        delay = max(next_fire_at - time.time(), 0)
+        self._job = self.application.job_queue.run_once(self._on_timer, when=delay, name="reminders")
+
+    async def _on_timer(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = None
+        self._armed_at = None
+        now = time.time()
+        due = False
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_live(entry):
+                self._forget(entry)
+                due = True
+        try:
+            if due:
+                await self._dispatch(context)
+        except Exception as e:
+            #unsent reminders stay in the database and come back with the next refill
+            logger.error(f"Помилка при надсиланні нагадувань: {e}")
+        finally:
+            self._arm()
+
+    async def _refill_job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.refill()
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+from database import (
+    heartbeat_shard_leases_async,
+    release_shard_leases_async,
+    get_shard_owners_async,
+)
+
+logger = logging.getLogger(__name__)
+
+#a dead worker's shards are taken over after this many seconds
+LEASE_TTL = 30
+HEARTBEAT_INTERVAL = 10
+ROUTES_REFRESH_INTERVAL = 5
+WORKER_CHECK_INTERVAL = 5
+WORKER_STOP_TIMEOUT = 15
+INBOX_SIZE = 10000
+INBOX_POLL_TIMEOUT = 1
+STOP = "stop"
+
+
+def shard_of(user_id: int, shard_count: int) -> int:
+    return user_id % shard_count
+
+def worker_name(index: int) -> str:
+    return f"worker-{index}"
+
+def worker_index(owner: str) -> int | None:
+    try:
+        return int(owner.rsplit("-", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class ShardSet:
+    # shards one worker process owns right now, kept alive by the heartbeat job.
+    # on_change(application, added, removed) runs whenever the set changes
+    def __init__(self, home: int, count: int, on_change=None):
+        self.owner = worker_name(home)
+        self.home = home
+        self.count = count
+        self.on_change = on_change
+        self.owned = frozenset()
+        self._valid_until = 0
+
+    @property
+    def key(self) -> tuple[int, tuple[int, ...]]:
+        #after a missed heartbeat the leases may already belong to someone else
+        if time.monotonic() > self._valid_until:
+            return self.count, ()
+        return self.count, tuple(sorted(self.owned))
+
+    async def renew(self, application: Application):
+        started = time.monotonic()
+        shards = await heartbeat_shard_leases_async(self.owner, self.home, self.count, LEASE_TTL)
+        if shards is None:
+            return
+        self._valid_until = started + LEASE_TTL
+        owned = frozenset(shards)
+        added, removed = owned - self.owned, self.owned - owned
+        self.owned = owned
+        if added or removed:
+            logger.info(f"{self.owner}: шарди {sorted(owned)} (+{sorted(added)}, -{sorted(removed)})")
+            if self.on_change:
+                await self.on_change(application, added, removed)
+
+    async def _heartbeat_job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.renew(context.application)
+
+
+def run_worker(index: int, shard_count: int, inbox, build_application):
+    # entry point of a worker process: the bot without an updater, fed from the supervisor's queue
+    shard_set = ShardSet(index, shard_count)
+    application = build_application(shard_set)
+    asyncio.run(_serve_worker(application, shard_set, inbox))
+
+
+def _next_update(inbox):
+    #short timeout so a stopping worker does not keep a thread blocked in get()
+    try:
+        return inbox.get(timeout=INBOX_POLL_TIMEOUT)
+    except queue.Empty:
+        return None
+
+
+async def _pump_updates(application: Application, inbox, stop_event: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        data = await loop.run_in_executor(None, _next_update, inbox)
+        if data is None:
+            continue
+        if data == STOP:
+            stop_event.set()
+            break
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+
+async def _serve_worker(application: Application, shard_set: ShardSet, inbox):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    try:
+        #leases first: the reminder scheduler loads only the owned shards
+        await shard_set.renew(application)
+        if application.post_init:
+            await application.post_init(application)
+        application.job_queue.run_repeating(
+            shard_set._heartbeat_job, interval=HEARTBEAT_INTERVAL, first=HEARTBEAT_INTERVAL,
+            name="shard_heartbeat"
+        )
+        await application.start()
+        pump = asyncio.create_task(_pump_updates(application, inbox, stop_event))
+        await stop_event.wait()
+        await pump
+    finally:
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        #let the other workers take over right away instead of after LEASE_TTL
+        await release_shard_leases_async(shard_set.owner)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+class Supervisor:
+    # receives every update (polling or webhook) and forwards it to the worker
+    # that owns the user's shard according to the lease table
+    def __init__(self, shard_count: int, build_application):
+        self.shard_count = shard_count
+        self.build_worker_application = build_application
+        self._mp = multiprocessing.get_context("spawn")
+        self.inboxes = [self._mp.Queue(INBOX_SIZE) for _ in range(shard_count)]
+        self.processes = [None] * shard_count
+        self.routes = {}
+        self.dropped_updates = 0
+
+    def build_application(self, token: str) -> Application:
+        application = (
+            Application.builder()
+            .token(token)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+            .build()
+        )
+        application.add_handler(TypeHandler(Update, self.route_update))
+        application.job_queue.run_repeating(
+            self._refresh_routes_job, interval=ROUTES_REFRESH_INTERVAL, first=ROUTES_REFRESH_INTERVAL
+        )
+        application.job_queue.run_repeating(
+            self._check_workers_job, interval=WORKER_CHECK_INTERVAL, first=WORKER_CHECK_INTERVAL
+        )
+        return application
+
+    def start_worker(self, index: int):
+        process = self._mp.Process(
+            target=run_worker,
+            args=(index, self.shard_count, self.inboxes[index], self.build_worker_application),
+            name=worker_name(index),
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Запущено {worker_name(index)} (pid {process.pid})")
+
+    async def on_startup(self, application: Application):
+        for index in range(self.shard_count):
+            self.start_worker(index)
+        await self.refresh_routes()
+
+    async def on_shutdown(self, application: Application):
+        for inbox in self.inboxes:
+            inbox.put(STOP)
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"{process.name} не зупинився вчасно, завершуємо примусово")
+                process.terminate()
+
+    async def refresh_routes(self):
+        routes = {}
+        for shard, owner in (await get_shard_owners_async()).items():
+            index = worker_index(owner)
+            if index is not None and index < self.shard_count:
+                routes[shard] = index
+        self.routes = routes
+
+    async def route_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        sender = update.effective_user or update.effective_chat
+        shard = shard_of(sender.id if sender else 0, self.shard_count)
+        #no live owner yet: the home worker picks the shard up when it (re)starts
+        index = self.routes.get(shard, shard)
+        try:
+            self.inboxes[index].put_nowait(update.to_dict())
+        except queue.Full:
+            self.dropped_updates += 1
+            logger.warning(f"Черга {worker_name(index)} переповнена, оновлення {update.update_id} відкинуто")
+
+    async def _refresh_routes_job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.refresh_routes()
+
+    async def _check_workers_job(self, context: ContextTypes.DEFAULT_TYPE):
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.warning(f"{process.name} завершився з кодом {process.exitcode}, перезапускаємо")
+                self.start_worker(index)
@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+
+from dates import parse_date
+from tasks_model import DEADLINE_FORMAT
+
+MAX_IMPORT_TASKS = 20000
+MAX_TASK_LENGTH = 1000
+EXPORT_COLUMNS = ("task_text", "deadline", "status", "created_at")
+
+#accepted column / key names, the first one is what export writes
+TEXT_KEYS = ("task_text", "text", "task", "title", "name", "content")
+DEADLINE_KEYS = ("deadline", "due", "due_date", "date")
+STATUS_KEYS = ("status",)
+DONE_VALUES = {"done", "completed", "complete", "true", "1", "x", "✅"}
+
+
+def decode(content: bytes) -> str:
+    #utf-8 (with or without BOM), otherwise the usual windows cyrillic
+    try:
+        return content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return content.decode("cp1251", errors="replace")
+
+
+def _pick(item: dict, keys: tuple) -> str | None:
+    for key in keys:
+        value = item.get(key)
+        if value not in (None, ""):
+            return str(value).strip()
+    return None
+
+
+def _from_mapping(item: dict) -> tuple | None:
+    item = {str(key).strip().lower(): value for key, value in item.items() if key is not None}
+    text = _pick(item, TEXT_KEYS)
+    if not text:
+        return None
+    status = _pick(item, STATUS_KEYS)
+    return text, _pick(item, DEADLINE_KEYS), status
+
+
+def parse_json(text: str) -> list[tuple]:
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("tasks", [])
+    if not isinstance(data, list):
+        raise ValueError("expected a list of tasks")
+    rows = []
+    for item in data:
+        if isinstance(item, str) and item.strip():
+            rows.append((item.strip(), None, None))
+        elif isinstance(item, dict):
+            row = _from_mapping(item)
+            if row:
+                rows.append(row)
+    return rows
+
+
+def parse_csv(text: str) -> list[tuple]:
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    lines = list(csv.reader(io.StringIO(text), dialect))
+    if not lines:
+        return []
+    header = [cell.strip().lower() for cell in lines[0]]
+    if set(header) & set(TEXT_KEYS):
+        return [row for row in (_from_mapping(dict(zip(header, line))) for line in lines[1:]) if row]
+    #no header: text, deadline, status by position
+    rows = []
+    for line in lines:
+        cells = [cell.strip() for cell in line] + [None, None]
+        if cells[0]:
+            rows.append((cells[0], cells[1] or None, cells[2] or None))
+    return rows
+
+
+def parse_text(text: str) -> list[tuple]:
+    # one task per line, optional deadline after " | " or a tab: "Купити хліб | завтра о 10:00"
+    rows = []
+    for line in text.splitlines():
+        line = line.strip().lstrip("-•*").strip()
+        if not line:
+            continue
+        separator = "\t" if "\t" in line else "|"
+        task_text, _, deadline = line.partition(separator)
+        rows.append((task_text.strip(), deadline.strip() or None, None))
+    return rows
+
+
+def parse_import(filename: str, content: bytes) -> list[tuple]:
+    # -> [(task_text, deadline text or None, status text or None)], ValueError on a broken file
+    text = decode(content)
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".json" or (not extension and text.lstrip()[:1] in ("[", "{")):
+        rows = parse_json(text)
+    elif extension in (".csv", ".tsv"):
+        try:
+            rows = parse_csv(text)
+        except csv.Error as e:
+            raise ValueError(str(e))
+    else:
+        rows = parse_text(text)
+    return [(task_text[:MAX_TASK_LENGTH], deadline, status) for task_text, deadline, status in rows if task_text]
+
+
+def resolve_deadlines(rows: list[tuple], now: datetime | None = None) -> tuple[list[tuple], int]:
+    # every distinct deadline string is parsed once with the same "now";
+    # -> [(task_text, deadline "Y-m-d H:M:S" or None, status)], number of deadlines not understood
+    now = now or datetime.now()
+    parsed = {}
+    for _, deadline, _ in rows:
+        if deadline and deadline not in parsed:
+            result = parse_date(deadline, now)
+            parsed[deadline] = result.strftime(DEADLINE_FORMAT) if result else None
+
+    resolved, unparsed = [], 0
+    for task_text, deadline, status in rows:
+        deadline_value = parsed.get(deadline) if deadline else None
+        if deadline and deadline_value is None:
+            unparsed += 1
+            #keep the original text visible instead of silently dropping it
+            task_text = f"{task_text} ({deadline})"
+        done = status is not None and status.strip().lower() in DONE_VALUES
+        resolved.append((task_text, deadline_value, "done" if done else "pending"))
+    return resolved, unparsed
+
+
+def write_csv(path: str, tasks) -> int:
+    # tasks is any iterable of rows, written as it is consumed
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for task in tasks:
+            writer.writerow([task[column] for column in EXPORT_COLUMNS])
+            count += 1
+    return count
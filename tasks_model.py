@@ -0,0 +1,64 @@
+import re
+from datetime import datetime
+
+from dates import from_epoch, next_occurrence, occurrences_between, to_epoch
+
+#the rules every storage backend follows: deadline strings, reminder times, recurring occurrences,
+#search words. Pure functions, no sqlite, so memory_repository.py does not load database.py
+
+#highlight() markers, replaced with html tags after escaping in main.py
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03"
+DEADLINE_FORMAT = "%Y-%m-%d %H:%M:%S"
+SEARCH_WORD_RE = re.compile(r"\w+")
+#a recurring task shows up in the digest at most this many times a day ("every hour")
+MAX_DIGEST_OCCURRENCES = 24
+
+
+def deadline_to_epoch(deadline: str | None, tz: str | None = None) -> int | None:
+    # deadline strings are wall-clock time of the task owner
+    if not deadline:
+        return None
+    try:
+        return to_epoch(datetime.strptime(deadline, DEADLINE_FORMAT), tz)
+    except ValueError:
+        return None
+
+
+def reminder_offsets(reminder_offset: int | list[int]) -> list[int]:
+    offsets = [reminder_offset] if isinstance(reminder_offset, int) else list(reminder_offset)
+    return sorted({offset for offset in offsets if offset > 0}, reverse=True)
+
+
+def reminder_times(deadline_at: int | None, offsets: list[int], rrule: str | None = None,
+                   tz: str | None = None) -> list[tuple[int, str]]:
+    # -> (fire_at, kind) of the reminders a task with this deadline gets
+    if deadline_at is None:
+        return []
+    reminders = [(deadline_at - offset * 60, "before") for offset in offsets]
+    if not rrule:
+        return reminders
+    #if the task is still not done when the next occurrence's first reminder is due, it rolls over
+    current = from_epoch(deadline_at, tz)
+    following = next_occurrence(rrule, current, current)
+    if following is not None:
+        fire_at = max(to_epoch(following, tz) - max(offsets, default=0) * 60, deadline_at + 1)
+        reminders.append((fire_at, "rollover"))
+    return reminders
+
+
+def with_occurrences(tasks: list, recurring: list, start_ts: int, end_ts: int, tz: str | None) -> list:
+    # one-off tasks plus a row for every occurrence of the recurring ones in [start_ts, end_ts)
+    if not recurring:
+        return tasks
+    tasks = [dict(task) for task in tasks]
+    start, end = from_epoch(start_ts, tz), from_epoch(end_ts, tz)
+    for task in recurring:
+        current = from_epoch(task["deadline_at"], tz)
+        for occurrence in occurrences_between(task["rrule"], current, start, end, MAX_DIGEST_OCCURRENCES):
+            tasks.append({
+                **dict(task),
+                "deadline": occurrence.strftime(DEADLINE_FORMAT),
+                "deadline_at": to_epoch(occurrence, tz),
+            })
+    tasks.sort(key=lambda task: (task["user_id"], task["deadline_at"]))
+    return tasks
@@ -0,0 +1,135 @@
+import asyncio
+import hmac
+import json
+import logging
+from http import HTTPStatus
+
+from telegram import Update
+from telegram.ext import Application
+
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+READ_TIMEOUT = 30
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+class WebhookServer:
+    # minimal HTTP/1.1 server on asyncio streams: POST <path> takes a Telegram
+    # update and puts it on application.update_queue, GET /healthz for probes.
+    # No /metrics here: this listener is public, metrics have their own local port (METRICS_PORT)
+    def __init__(self, application: Application, path: str, secret_token: str,
+                 host: str = "0.0.0.0", port: int = 8080):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.routes = {
+            ("GET", "/healthz"): self._health,
+            ("POST", path): self._receive_update,
+        }
+        self._server = None
+        self.updates_received = 0
+        self.updates_rejected = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"Webhook сервер слухає {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def add_route(self, method: str, path: str, handler):
+        # handler(headers, body) -> (status, content_type, payload bytes)
+        self.routes[(method, path)] = handler
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            #keep-alive: serve requests until the client closes the connection
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), READ_TIMEOUT)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                handler = self.routes.get((method, path.split("?", 1)[0]))
+                if handler is None:
+                    status, content_type, payload = HTTPStatus.NOT_FOUND, "text/plain", b"not found"
+                else:
+                    status, content_type, payload = await handler(headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, content_type, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            self._write_response(writer, HTTPStatus.BAD_REQUEST, "text/plain", str(e).encode(), False)
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ValueError("malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", "0") or 0)
+        if length > MAX_BODY_SIZE:
+            raise ValueError("body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), path, headers, body
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: HTTPStatus, content_type: str,
+                        payload: bytes, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+
+    async def _health(self, headers: dict, body: bytes):
+        payload = {
+            "status": "ok",
+            "update_queue": self.application.update_queue.qsize(),
+            "updates_received": self.updates_received,
+            "updates_rejected": self.updates_rejected,
+        }
+        return HTTPStatus.OK, "application/json", json.dumps(payload).encode()
+
+    async def _receive_update(self, headers: dict, body: bytes):
+        #as bytes: compare_digest raises on non-ascii str, headers were decoded as latin-1
+        if not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode("latin-1"), self.secret_token.encode()
+        ):
+            self.updates_rejected += 1
+            return HTTPStatus.FORBIDDEN, "text/plain", b"invalid secret token"
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.updates_rejected += 1
+            logger.warning(f"Некоректне оновлення у webhook: {e}")
+            return HTTPStatus.BAD_REQUEST, "text/plain", b"invalid update"
+
+        await self.application.update_queue.put(update)
+        self.updates_received += 1
+        return HTTPStatus.OK, "text/plain", b"ok"